@@ -0,0 +1,103 @@
+from typing import Dict, List, Tuple
+import datetime
+import json
+import os
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+
+def save_baseline(report:Dict, name:str, baseline_dir:str = BASELINE_DIR) -> str:
+    """ Keep a benchmark report under name, replacing an older baseline of the same name. """
+    os.makedirs(baseline_dir, exist_ok=True)
+    baseline_file = os.path.join(baseline_dir, f'{name}.json')
+    baseline = dict(report, baseline=name, saved_at=datetime.datetime.now(datetime.timezone.utc).isoformat())
+    temp_file = f'{baseline_file}.tmp'
+    with open(temp_file, 'w') as f:
+        json.dump(baseline, f, indent=2)
+    os.replace(temp_file, baseline_file)
+    return baseline_file
+
+def load_baseline(name:str, baseline_dir:str = BASELINE_DIR) -> Dict:
+    baseline_file = os.path.join(baseline_dir, f'{name}.json')
+    if not os.path.exists(baseline_file):
+        raise ValueError(f'No baseline named {name} in {baseline_dir}.')
+    with open(baseline_file) as f:
+        return json.load(f)
+
+def compare(baseline:Dict, report:Dict, threshold:float = 0.10, memory_threshold:float = 0.25, min_delta_seconds:float = 0.005) -> List[Dict]:
+    """
+    Compare every benchmark of report against the same benchmark and params in baseline. A benchmark
+    regressed when its median time grew by more than threshold (and by more than min_delta_seconds, so
+    timer noise on very fast benchmarks is not reported) or its peak memory grew by more than memory_threshold.
+
+    [
+        {
+            "name" : str, "params" : {str : int, ...},
+            "baseline_median" : float || None, "median" : float || None, "time_delta" : float || None,
+            "baseline_peak_memory_bytes" : int || None, "peak_memory_bytes" : int || None, "memory_delta" : float || None,
+            "status" : "ok" || "regressed" || "improved" || "new" || "missing"
+        },
+        ...
+    ]
+    """
+    baseline_results = {_key(result):result for result in baseline['benchmarks']}
+    current_results = {_key(result):result for result in report['benchmarks']}
+    rows = []
+    for key, current in current_results.items():
+        previous = baseline_results.get(key)
+        row = _make_row(current, previous, current)
+        if previous is None:
+            row['status'] = 'new'
+        else:
+            row['time_delta'] = _relative_delta(previous['median'], current['median'])
+            row['memory_delta'] = _relative_delta(previous.get('peak_memory_bytes'), current.get('peak_memory_bytes'))
+            slower = row['time_delta'] is not None and row['time_delta'] > threshold and current['median'] - previous['median'] > min_delta_seconds
+            larger = row['memory_delta'] is not None and row['memory_delta'] > memory_threshold
+            faster = row['time_delta'] is not None and row['time_delta'] < -threshold and previous['median'] - current['median'] > min_delta_seconds
+            row['status'] = 'regressed' if slower or larger else 'improved' if faster else 'ok'
+        rows.append(row)
+    for key, previous in baseline_results.items():
+        if key not in current_results:
+            row = _make_row(previous, previous, None)
+            row['status'] = 'missing'
+            rows.append(row)
+    return rows
+
+def format_comparison(rows:List[Dict], baseline_name:str) -> str:
+    lines = [f'compared against baseline {baseline_name}:']
+    for row in rows:
+        params = ', '.join(f'{param}={value}' for param, value in row['params'].items())
+        time_part = f"{_format_seconds(row['baseline_median'])} -> {_format_seconds(row['median'])} ({_format_delta(row['time_delta'])})"
+        memory_part = f"{_format_mib(row['baseline_peak_memory_bytes'])} -> {_format_mib(row['peak_memory_bytes'])} ({_format_delta(row['memory_delta'])})"
+        lines.append(f"  {row['status'].upper():9} {row['name']} [{params}]: time {time_part}, peak memory {memory_part}")
+    regressions = sum(1 for row in rows if row['status'] == 'regressed')
+    lines.append(f'{regressions} regression(s) in {len(rows)} benchmark(s)')
+    return '\n'.join(lines)
+
+def _key(result:Dict) -> Tuple:
+    return (result['name'], tuple(sorted(result['params'].items())))
+
+def _make_row(result:Dict, previous:Dict, current:Dict) -> Dict:
+    return {
+        'name' : result['name'],
+        'params' : result['params'],
+        'baseline_median' : previous['median'] if previous is not None else None,
+        'median' : current['median'] if current is not None else None,
+        'time_delta' : None,
+        'baseline_peak_memory_bytes' : previous.get('peak_memory_bytes') if previous is not None else None,
+        'peak_memory_bytes' : current.get('peak_memory_bytes') if current is not None else None,
+        'memory_delta' : None
+    }
+
+def _relative_delta(before:float, after:float) -> float:
+    if before is None or after is None or before == 0:
+        return None
+    return (after - before) / before
+
+def _format_seconds(seconds:float) -> str:
+    return '-' if seconds is None else f'{seconds:.3f}s'
+
+def _format_mib(size:int) -> str:
+    return '-' if size is None else f'{size / 2 ** 20:.1f} MiB'
+
+def _format_delta(delta:float) -> str:
+    return '-' if delta is None else f'{delta:+.1%}'
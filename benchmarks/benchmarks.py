@@ -0,0 +1,223 @@
+"""
+Times the hot paths of the script on synthetic workbooks, ESX projects and orgs and writes the
+results to a JSON file:
+
+python benchmarks/benchmarks.py --output benchmark_results.json
+
+{
+    "created_at" : str,
+    "python" : str,
+    "platform" : str,
+    "benchmarks" : [
+        {"name" : str, "params" : {str : int, ...}, "seconds" : [float, ...], "min" : float, "median" : float, "mean" : float,
+         "peak_memory_bytes" : int},
+        ...
+    ]
+}
+
+Save a run as a named baseline with --save-baseline NAME and compare a later run against it with
+--compare NAME. The comparison exits with status 1 when a benchmark regressed past --threshold.
+"""
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from typing import Dict, List
+import contextlib
+import statistics
+import datetime
+import platform
+import argparse
+import tempfile
+import shutil
+import time
+import json
+import tracemalloc
+import io
+import synthetic
+import baselines
+
+def time_call(function, repeat:int) -> List[float]:
+    """ Seconds each of repeat calls of function took. Anything the function prints is discarded. """
+    timings = []
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            started = time.perf_counter()
+            function()
+            timings.append(time.perf_counter() - started)
+    return timings
+
+def peak_memory(function) -> int:
+    """ Peak bytes allocated by python during one more call of function. Measured apart from the timings since tracing slows every allocation. """
+    with contextlib.redirect_stdout(io.StringIO()):
+        tracemalloc.start()
+        try:
+            function()
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+def make_result(name:str, params:Dict[str,int], timings:List[float], peak_memory_bytes:int) -> Dict:
+    return {
+        'name' : name,
+        'params' : params,
+        'seconds' : timings,
+        'min' : min(timings),
+        'median' : statistics.median(timings),
+        'mean' : statistics.mean(timings),
+        'peak_memory_bytes' : peak_memory_bytes
+    }
+
+def measure(name:str, params:Dict[str,int], function, repeat:int) -> Dict:
+    return make_result(name, params, time_call(function, repeat), peak_memory(function))
+
+def bench_workbook_ingestion(workdir:str, row_counts:List[int], repeat:int) -> List[Dict]:
+    import tasks
+    from file_ops import sheet_cache, EkahauWriter
+    results = []
+    for rows in row_counts:
+        sites = max(1, rows // 200)
+        workbook = synthetic.write_installer_workbook(os.path.join(workdir, f'installer_{rows}.xlsx'), rows, sites)
+        config = synthetic.make_config(workbook, sites, ['assign ap', 'name ap'])
+        config['sites']['workbook_cache'] = False
+        # every call starts without parsed sheets, so these time a cold read of the workbook
+        results.append(measure('workbook.site_mac', {'rows':rows}, lambda: (sheet_cache.clear(), tasks.SiteMac(config).get_data_structure()), repeat))
+        results.append(measure('workbook.site_mac_name', {'rows':rows}, lambda: (sheet_cache.clear(), tasks.SiteMacName(config).get_data_structure()), repeat))
+        def read_for_run():
+            sheet_cache.clear()
+            tasks.SiteMac(config).get_data_structure()
+            tasks.SiteMacName(config).get_data_structure()
+            esx_writer = EkahauWriter(config)
+            esx_writer.ap_names_are_unique_throughout_excel_file()
+            esx_writer.create_ap_naming_dict()
+        results.append(measure('workbook.all_readers', {'rows':rows}, read_for_run, repeat))
+        sidecar_config = dict(config, sites=dict(config['sites'], workbook_cache=True))
+        sidecar_dir = sheet_cache.sidecar_dir
+        sheet_cache.sidecar_dir = os.path.join(workdir, 'workbook_cache')
+        try:
+            sheet_cache.clear()
+            tasks.SiteMac(sidecar_config).get_data_structure()
+            # the sidecar of the workbook is written by the call above, so this times a warm restart
+            results.append(measure('workbook.site_mac_sidecar', {'rows':rows}, lambda: (sheet_cache.clear(), tasks.SiteMac(sidecar_config).get_data_structure()), repeat))
+        finally:
+            sheet_cache.sidecar_dir = sidecar_dir
+    return results
+
+def bench_esx_split(workdir:str, floor_counts:List[int], repeat:int) -> List[Dict]:
+    from file_ops import EkahauWriter
+    results = []
+    esx_writer = EkahauWriter({})
+    for floors in floor_counts:
+        esx_file = synthetic.write_esx_project(os.path.join(workdir, f'project_{floors}.esx'), floors)
+        esx_data = esx_writer.extract_info_from_esx_file(esx_file)
+        results.append(measure('esx.create_floorplan_specific_esx_data', {'floors':floors}, lambda: esx_writer.create_floorplan_specific_esx_data(esx_data), repeat))
+    return results
+
+def bench_esx_export(workdir:str, floor_counts:List[int], repeat:int, projects:int = 5) -> List[Dict]:
+    from file_ops import EkahauWriter
+    results = []
+    esx_writer = EkahauWriter({})
+    for floors in floor_counts:
+        esx_folder = synthetic.write_esx_folder(os.path.join(workdir, f'esx_folder_{floors}'), projects, floors)
+        output_dir = os.path.join(workdir, f'esx_export_{floors}')
+        results.append(measure('esx.export_esx_folder_to_xlsx', {'projects':projects, 'floors':floors}, lambda: esx_writer.export_esx_folder_to_xlsx(esx_folder, output_dir), repeat))
+    return results
+
+def bench_excel_writer(workdir:str, row_counts:List[int], repeat:int) -> List[Dict]:
+    import excel
+    results = []
+    for rows in row_counts:
+        tables = synthetic.make_ap_status_tables(rows)
+        output_file = os.path.join(workdir, f'ap_status_{rows}.xlsx')
+        results.append(measure('excel.write_tables_to_excel_workbook', {'rows':rows}, lambda: excel.write_tables_to_excel_workbook(tables, output_file), repeat))
+    return results
+
+def bench_task_manager(workdir:str, ap_counts:List[int], repeat:int, max_in_flight_values:List[int], latency:float) -> List[Dict]:
+    """ Full assign ap + name ap runs of TaskManager with the real MistAPIHandler against a local stand-in org. """
+    results = []
+    for aps in ap_counts:
+        sites = max(1, aps // 100)
+        workbook = synthetic.write_installer_workbook(os.path.join(workdir, f'run_{aps}.xlsx'), aps, sites, floors_per_site=1)
+        for max_in_flight in max_in_flight_values:
+            # every run gets a fresh org, a second run against the same org would find nothing left to do
+            run = lambda: run_task_manager_against_stub(workbook, sites, aps, max_in_flight, latency)
+            results.append(measure('task_manager.assign_and_name', {'aps':aps, 'sites':sites, 'max_in_flight':max_in_flight}, run, repeat))
+    return results
+
+def run_task_manager_against_stub(workbook:str, sites:int, aps:int, max_in_flight:int, latency:float):
+    from mist_stub_server import MistStubServer, SyntheticOrg
+    from api import MistAPIHandler
+    import tasks
+    org = SyntheticOrg('Stub Org', site_count=sites, aps_per_site=0, unassigned_aps=aps)
+    with MistStubServer(org, latency=latency) as server:
+        config = synthetic.make_config(workbook, sites, ['assign ap', 'name ap'])
+        config['sites']['max_in_flight'] = max_in_flight
+        config['api'] = {'base_url':server.base_url, 'requests_per_hour':10 ** 9, 'pool_maxsize':max(10, max_in_flight)}
+        task_manager = tasks.TaskManager(config=config, handler=MistAPIHandler)
+        task_manager.create_tasks()
+        task_manager.execute_tasks()
+
+def run_benchmarks(workdir:str, groups:List[str], row_counts:List[int], floor_counts:List[int], ap_counts:List[int], max_in_flight_values:List[int], repeat:int, latency:float) -> Dict:
+    """ Run the benchmark groups inside workdir, which gets the data folder the tasks keep their ledgers in. """
+    os.makedirs(os.path.join(workdir, 'data'), exist_ok=True)
+    previous_cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        results = []
+        if 'workbook' in groups:
+            results.extend(bench_workbook_ingestion(workdir, row_counts, repeat))
+        if 'esx' in groups:
+            results.extend(bench_esx_split(workdir, floor_counts, repeat))
+            results.extend(bench_esx_export(workdir, floor_counts, repeat))
+        if 'excel' in groups:
+            results.extend(bench_excel_writer(workdir, row_counts, repeat))
+        if 'api' in groups:
+            results.extend(bench_task_manager(workdir, ap_counts, repeat, max_in_flight_values, latency))
+    finally:
+        os.chdir(previous_cwd)
+    return {
+        'created_at' : datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'python' : platform.python_version(),
+        'platform' : platform.platform(),
+        'benchmarks' : results
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the script on synthetic workbooks, ESX projects and orgs.')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--groups', nargs='+', default=['workbook', 'esx', 'excel', 'api'], choices=['workbook', 'esx', 'excel', 'api'])
+    parser.add_argument('--rows', nargs='+', type=int, default=[10000, 100000], help='installer workbook and AP Status rows')
+    parser.add_argument('--floors', nargs='+', type=int, default=[1, 50, 200], help='floors per ESX project')
+    parser.add_argument('--aps', nargs='+', type=int, default=[1000], help='APs assigned and named in the TaskManager runs')
+    parser.add_argument('--max-in-flight', nargs='+', type=int, default=[1, 8])
+    parser.add_argument('--latency', type=float, default=0.005, help='seconds the stand-in API takes per request')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--workdir', help='keep the generated files here instead of a temporary folder')
+    parser.add_argument('--baseline-dir', default=baselines.BASELINE_DIR)
+    parser.add_argument('--save-baseline', metavar='NAME', help='save this run as the named baseline')
+    parser.add_argument('--compare', metavar='NAME', help='compare this run against the named baseline')
+    parser.add_argument('--threshold', type=float, default=0.10, help='relative slowdown of the median that counts as a regression')
+    parser.add_argument('--memory-threshold', type=float, default=0.25, help='relative growth of the peak memory that counts as a regression')
+    args = parser.parse_args()
+    workdir = args.workdir if args.workdir else tempfile.mkdtemp(prefix='mist_benchmarks_')
+    try:
+        report = run_benchmarks(os.path.abspath(workdir), args.groups, args.rows, args.floors, args.aps, args.max_in_flight, args.repeat, args.latency)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    for result in report['benchmarks']:
+        print(f"{result['name']} {result['params']}: median {result['median']:.3f}s, min {result['min']:.3f}s, peak memory {result['peak_memory_bytes'] / 2 ** 20:.1f} MiB")
+    print(f'results written to {args.output}')
+    if args.save_baseline:
+        print(f'baseline saved to {baselines.save_baseline(report, args.save_baseline, args.baseline_dir)}')
+    if args.compare:
+        comparison = baselines.compare(baselines.load_baseline(args.compare, args.baseline_dir), report, args.threshold, args.memory_threshold)
+        print(baselines.format_comparison(comparison, args.compare))
+        if any(row['status'] == 'regressed' for row in comparison):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+from zipfile import ZipFile
+from typing import Dict, List
+import random
+import pandas
+import json
+import yaml
+import os
+
+EXAMPLE_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'example', 'config.yml')
+
+def load_header_column_names(config_file:str = EXAMPLE_CONFIG) -> Dict[str,str]:
+    """ The installer workbook columns of a config file, with the \\n the config writes in them turned into newlines like the tasks do. """
+    with open(config_file) as f:
+        config_sites = yaml.safe_load(f)['sites']
+    return {item:column.replace('\\n', '\n') for item, column in config_sites['header_column_names'].items()}
+
+# installer workbook layout of example/config.yml
+HEADER_COLUMN_NAMES = load_header_column_names()
+# columns installer workbooks carry that the script never reads
+EXTRA_COLUMNS = ['Switch', 'Switch Port', 'Patch Panel', 'Mount', 'Installer Notes']
+
+def make_installer_rows(rows:int, sites:int, floors_per_site:int = 5, first_mac:int = 0) -> List[List[str]]:
+    """ One row per AP, spread evenly over sites and their floors, with MACs counted up from first_mac. """
+    table = []
+    for num in range(rows):
+        site = num % sites
+        floor = (num // sites) % floors_per_site + 1
+        mac = f'{first_mac + num:012x}'
+        table.append([
+            f'site{site} Flr-{floor:02d}',
+            f'site{site}-flr{floor}-ap-{num}',
+            mac,
+            f'ap-{num}',
+            f'sw-{site}-{floor}', str(num % 48 + 1), f'pp-{floor}', 'ceiling', ''
+        ])
+    return table
+
+def write_installer_workbook(path:str, rows:int, sites:int, floors_per_site:int = 5, first_mac:int = 0, sheet_name:str = 'APs') -> str:
+    columns = [HEADER_COLUMN_NAMES['site_name'], HEADER_COLUMN_NAMES['ap_name'], HEADER_COLUMN_NAMES['ap_mac'], HEADER_COLUMN_NAMES['esx_ap_name']] + EXTRA_COLUMNS
+    dataframe = pandas.DataFrame(make_installer_rows(rows, sites, floors_per_site, first_mac), columns=columns)
+    dataframe.to_excel(path, index=False, sheet_name=sheet_name)
+    return path
+
+def make_config(workbook_path:str, sites:int, tasks:List[str], sheet_name:str = 'APs') -> Dict:
+    """ config.yml contents for a synthetic workbook, with one site entry per synthetic site. """
+    config_sites = {
+        'ap_excel_file' : workbook_path,
+        'sheet_name' : sheet_name,
+        'header_column_names' : dict(HEADER_COLUMN_NAMES),
+        'dropna_header' : HEADER_COLUMN_NAMES['ap_mac'],
+        'groupby' : HEADER_COLUMN_NAMES['site_name'],
+        'tasks' : tasks,
+        'lowercase_ap_names' : False,
+        'max_in_flight' : 1
+    }
+    for site in range(sites):
+        config_sites[f'site{site}'] = {'name':f'site{site}'}
+    return {
+        'org' : 'Stub Org',
+        'sites' : config_sites,
+        'login' : {'username':'benchmark', 'password':'benchmark'}
+    }
+
+def write_esx_project(path:str, floors:int, aps_per_floor:int = 20, surveys_per_floor:int = 1, seed:int = 0) -> str:
+    """ Ekahau project with floors floor plans, their APs, areas, exclusion areas and survey files. """
+    rng = random.Random(seed)
+    floorplans = [{'id':f'floor-{num}', 'name':f'site0 Flr-{num + 1:02d}', 'width':2000.0, 'height':1500.0} for num in range(floors)]
+    access_points = []
+    for floor, floorplan in enumerate(floorplans):
+        for num in range(aps_per_floor):
+            access_points.append({
+                'id' : f'ap-{floor}-{num}',
+                'name' : f'ap-{floor * aps_per_floor + num}',
+                'model' : 'AP43',
+                'location' : {'floorPlanId':floorplan['id'], 'coord':{'x':rng.uniform(0, 2000), 'y':rng.uniform(0, 1500)}}
+            })
+    areas = [{'id':f'area-{floorplan["id"]}', 'floorPlanId':floorplan['id'], 'area':[{'x':0, 'y':0}, {'x':100, 'y':100}]} for floorplan in floorplans]
+    exclusion_areas = [{'id':f'exclusion-{floorplan["id"]}', 'floorPlanId':floorplan['id']} for floorplan in floorplans]
+    with ZipFile(path, 'w') as zf:
+        zf.writestr('project.json', json.dumps({'project':{'name':os.path.basename(path)}}))
+        zf.writestr('floorPlans.json', json.dumps({'floorPlans':floorplans}))
+        zf.writestr('accessPoints.json', json.dumps({'accessPoints':access_points}))
+        zf.writestr('areas.json', json.dumps({'areas':areas}))
+        zf.writestr('exclusionAreas.json', json.dumps({'exclusionAreas':exclusion_areas}))
+        zf.writestr('interferers.json', json.dumps({'interferers':[]}))
+        for floorplan in floorplans:
+            for num in range(surveys_per_floor):
+                samples = [{'x':rng.uniform(0, 2000), 'y':rng.uniform(0, 1500), 'rssi':rng.randint(-90, -30)} for _ in range(50)]
+                survey = {'surveys':[{'id':f'survey-{floorplan["id"]}-{num}', 'floorPlanId':floorplan['id'], 'samples':samples}]}
+                zf.writestr(f'survey-{floorplan["id"]}-{num}.json', json.dumps(survey))
+    return path
+
+def write_esx_folder(folder:str, projects:int, floors:int, aps_per_floor:int = 20) -> str:
+    os.makedirs(folder, exist_ok=True)
+    for num in range(projects):
+        write_esx_project(os.path.join(folder, f'project{num}.esx'), floors, aps_per_floor, seed=num)
+    return folder
+
+def make_ap_status_tables(rows:int) -> Dict[str, List[List[List[str]]]]:
+    """ Tables in the shape inventory_devices writes to the AP Status workbook. """
+    devices = [['NAME', 'MODEL', 'MAC', 'SITE', 'CONNECTED']]
+    for num in range(rows):
+        devices.append([f'ap-{num}', 'AP43', f'{num:012x}', f'site{num % 50}', 'UP' if num % 7 else 'DOWN'])
+    return {'APs':[devices]}
@@ -5,12 +5,39 @@ sys.path.append(os.path.join(os.getcwd(), 'src'))
 from api import MistAPIHandler
 import tasks
 from file_ops import ConfigReader, ExcelWriter, EkahauWriter
+from planner import DryRunPlanner, format_plan
+from batch import run_batch, format_summary
+import argparse
+import json
 
 def main():
-    
-    config_reader = ConfigReader('config.yml')
+
+    parser = argparse.ArgumentParser(description='Configure Mist sites from an AP installation workbook.')
+    parser.add_argument('--config', default='config.yml')
+    parser.add_argument('--dry-run', action='store_true', help='print the API calls and run time a run would take without sending requests')
+    parser.add_argument('--batch', nargs='+', metavar='CONFIG', help='run several config files at once instead of --config')
+    parser.add_argument('--workers', type=int, default=4, help='config files of a batch run at the same time')
+    parser.add_argument('--log-dir', help='write the output of every batch config to its own log file here')
+    parser.add_argument('--summary', help='write the batch results and timings to this JSON file')
+    args = parser.parse_args()
+
+    if args.batch:
+        print(f'running {len(args.batch)} configs, {args.workers} at a time...')
+        batch = run_batch(args.batch, args.workers, args.log_dir)
+        print(format_summary(batch))
+        if args.summary:
+            with open(args.summary, 'w') as f:
+                json.dump(batch, f, indent=2)
+        return
+
+    config_reader = ConfigReader(args.config)
     config = config_reader.extract_information_from_file()
 
+    if args.dry_run:
+        print('planning run...')
+        print(format_plan(DryRunPlanner(config).plan()))
+        return
+
     esx_writer = EkahauWriter(config)
 
     task_manager = tasks.TaskManager(config=config, handler=MistAPIHandler, writer=ExcelWriter, esx_writer=esx_writer)
@@ -19,6 +46,22 @@ def main():
     print('executing tasks...')
     task_manager.execute_tasks()
 
+    if task_manager.handler is not None:
+        connection_stats = task_manager.handler.get_connection_stats()
+        print(f"api requests: {connection_stats['requests']}, connections opened: {connection_stats['connections_opened']}, connections reused: {connection_stats['connections_reused']}")
+        scheduler_stats = task_manager.handler.scheduler.get_stats()
+        print(f"rate limited responses: {scheduler_stats['throttled']}, seconds spent pacing: {scheduler_stats['time_waited']}, remaining hourly budget: {scheduler_stats['remaining_budget']}")
+        for endpoint, retries in task_manager.run_stats['api_retries'].items():
+            print(f'{endpoint} requests retried: {retries}')
+        for endpoint, coalesced in task_manager.run_stats['api_coalesced'].items():
+            print(f'{endpoint} requests joined with an identical one in flight: {coalesced}')
+        for endpoint, endpoint_metrics in task_manager.handler.metrics.to_json().items():
+            print(f"{endpoint}: {endpoint_metrics['count']} requests, {endpoint_metrics['errors']} errors, p50 {endpoint_metrics['p50']:.3f}s, p95 {endpoint_metrics['p95']:.3f}s, p99 {endpoint_metrics['p99']:.3f}s")
+    if 'first_site_seconds' in task_manager.run_stats:
+        print(f"first site configured after {task_manager.run_stats['first_site_seconds']:.1f} seconds")
+    for task, calls_saved in task_manager.run_stats['calls_saved'].items():
+        print(f'{task} calls saved, already up to date: {calls_saved}')
+
 #    print('saving executed tasks to file...')
 #    task_manager.save_success_configs_to_file()
     
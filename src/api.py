@@ -1,19 +1,286 @@
 from subprocess import call
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 import requests
+import threading
+import hashlib
+import random
 import json
-from typing import Dict, List 
+import time
+import copy
+import os
+from typing import Dict, List, Tuple
+from metrics import APIMetrics
+from session_store import SessionStore
+
+def parse_retry_after(retry_after:str, default:float=5.0) -> float:
+    """ Returns the number of seconds to wait from a Retry-After header given either as seconds or as an HTTP date. """
+    if retry_after is None or retry_after == '':
+        return default
+    try:
+        return max(float(retry_after), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return default
+    return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+class APIRequestError(Exception):
+
+    def __init__(self, status_code:int, reason:str):
+        super().__init__(f"Request failed: {status_code} {reason}")
+        self.status_code = status_code
+        self.reason = reason
+
+class RequestScheduler:
+    """
+    Token bucket that every request sent by a MistAPIHandler goes through. Tokens refill at
+    requests_per_hour/3600 per second up to burst. When the bucket is empty, the hourly window
+    already holds requests_per_hour requests, or the API asked us to back off with a 429 and
+    Retry-After, acquire() waits instead of letting the request fail.
+    """
+
+    default_burst = 20
+
+    def __init__(self, requests_per_hour:int=5000, burst:int=None, clock=time.monotonic, sleep=time.sleep):
+        if requests_per_hour <= 0:
+            raise ValueError('requests_per_hour must be greater than 0.')
+        self.requests_per_hour = requests_per_hour
+        self.burst = burst if burst is not None else min(self.default_burst, requests_per_hour)
+        self.rate = requests_per_hour / 3600
+        self.tokens = float(self.burst)
+        self.blocked_until = 0.0
+        self.requests_sent = 0
+        self.throttled = 0
+        self.time_waited = 0.0
+        self._clock = clock
+        self._sleep = sleep
+        self._last_refill = clock()
+        self._window_start = self._last_refill
+        self._window_count = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = self._clock()
+                self._refill(now)
+                wait = self.blocked_until - now
+                self._roll_window(now)
+                if wait <= 0 and self._window_count >= self.requests_per_hour:
+                    # the hourly budget is spent, nothing goes out until the window rolls over
+                    wait = self._window_start + 3600 - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        self._count_request(now)
+                        return
+                    wait = (1 - self.tokens) / self.rate
+                self.time_waited += wait
+            self._sleep(wait)
+
+    def defer(self, retry_after:float):
+        """ Hold back every request until retry_after seconds from now. Called when the API answers with a 429. """
+        with self._lock:
+            self.throttled += 1
+            self.blocked_until = max(self.blocked_until, self._clock() + retry_after)
+
+    def remaining_budget(self) -> int:
+        """ Requests left in the current hourly window before the configured limit is reached. """
+        with self._lock:
+            self._roll_window(self._clock())
+            return max(self.requests_per_hour - self._window_count, 0)
+
+    def get_stats(self) -> Dict[str, float]:
+        return {
+            'requests_sent' : self.requests_sent,
+            'throttled' : self.throttled,
+            'time_waited' : round(self.time_waited, 3),
+            'remaining_budget' : self.remaining_budget()
+        }
+
+    def _refill(self, now:float):
+        self.tokens = min(self.burst, self.tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def _count_request(self, now:float):
+        self._roll_window(now)
+        self._window_count += 1
+        self.requests_sent += 1
+
+    def _roll_window(self, now:float):
+        if now - self._window_start >= 3600:
+            self._window_start = now
+            self._window_count = 0
+
+class ResponseCache:
+    """
+    Read-through cache for GET responses of read-mostly endpoints, keyed by endpoint and request path.
+    Each endpoint has its own TTL; endpoints without one are never cached. With a cache_file the entries
+    are also kept on disk so the next run starts warm.
+    """
+
+    def __init__(self, ttls:Dict[str,float], cache_file:str=None, namespace:str='', clock=time.time):
+        self.ttls = ttls
+        self.cache_file = cache_file
+        self.namespace = namespace
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self._clock = clock
+        self._lock = threading.Lock()
+        if cache_file is not None and os.path.exists(cache_file):
+            self._load()
+
+    def get(self, api_endpoint:str, full_api_path:str):
+        """ Returns (True, response) for a fresh entry and (False, None) otherwise. """
+        if api_endpoint not in self.ttls:
+            return False, None
+        with self._lock:
+            entry = self.entries.get(self._key(full_api_path))
+            if entry is None or entry['expires'] <= self._clock():
+                self.misses += 1
+                return False, None
+            self.hits += 1
+            return True, copy.deepcopy(entry['response'])
+
+    def set(self, api_endpoint:str, full_api_path:str, response):
+        if api_endpoint not in self.ttls:
+            return
+        with self._lock:
+            self.entries[self._key(full_api_path)] = {
+                'endpoint' : api_endpoint,
+                'expires' : self._clock() + self.ttls[api_endpoint],
+                'response' : copy.deepcopy(response)
+            }
+            self._save()
+
+    def invalidate(self, api_endpoints:List[str] = None):
+        """ Drop the entries of the given endpoints, or every entry when no endpoints are given. """
+        with self._lock:
+            if api_endpoints is None:
+                self.entries = {}
+            else:
+                self.entries = {key:entry for key, entry in self.entries.items() if entry['endpoint'] not in api_endpoints}
+            self._save()
+
+    def _key(self, full_api_path:str) -> str:
+        return f'{self.namespace} {full_api_path}'
+
+    def _load(self):
+        try:
+            with open(self.cache_file) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return
+        now = self._clock()
+        self.entries = {key:entry for key, entry in entries.items() if entry['expires'] > now}
+
+    def _save(self):
+        if self.cache_file is None:
+            return
+        temp_file = f'{self.cache_file}.tmp'
+        with open(temp_file, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(temp_file, self.cache_file)
+
+class SiteIndex:
+    """ id to name and name to id lookups for every site in an org, built from a single site list. """
+
+    def __init__(self, sites:List[Dict]):
+        self.id_to_name = {}
+        self.name_to_id = {}
+        for site in sites:
+            self.id_to_name[site['id']] = site['name']
+            self.name_to_id[site['name']] = site['id']
+
+    def get_name(self, site_id:str, default:str=None) -> str:
+        return self.id_to_name.get(site_id, default)
+
+    def get_id(self, site_name:str, default:str=None) -> str:
+        return self.name_to_id.get(site_name, default)
+
+    def __len__(self) -> int:
+        return len(self.id_to_name)
+
+class SingleFlight:
+    """
+    Lets identical calls that overlap in time share one execution. The first caller of a key makes
+    the call, callers that arrive while it is still running wait for it and get a copy of its result
+    (or its exception) instead of making their own. Nothing is kept once the call has finished.
+    Invalidating a label starts a new generation of it, calls that started before that are not joined
+    any more, their result may predate the write that caused the invalidation.
+    """
+
+    def __init__(self):
+        self.coalesced = {}
+        self._calls = {}
+        self._epoch = 0
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def generation(self, label:str):
+        with self._lock:
+            return self._generation(label)
+
+    def invalidate(self, labels:List[str] = None):
+        """ Start a new generation of the given labels, or of every label when none are given. """
+        with self._lock:
+            if labels is None:
+                self._epoch += 1
+            else:
+                for label in labels:
+                    self._generations[label] = self._generations.get(label, 0) + 1
+
+    def do(self, key:str, label:str, call):
+        with self._lock:
+            generation = self._generation(label)
+            flight = self._calls.get(key)
+            leader = flight is None or flight['generation'] != generation
+            if leader:
+                flight = {'done':threading.Event(), 'response':None, 'error':None, 'generation':generation}
+                self._calls[key] = flight
+            else:
+                self.coalesced[label] = self.coalesced.get(label, 0) + 1
+        if not leader:
+            flight['done'].wait()
+            if flight['error'] is not None:
+                raise flight['error']
+            return copy.deepcopy(flight['response'])
+        try:
+            response = call()
+            # snapshot before waking the followers, the leader's caller may change its own response
+            flight['response'] = copy.deepcopy(response)
+            return response
+        except Exception as e:
+            flight['error'] = e
+            raise
+        finally:
+            with self._lock:
+                # a newer generation may have taken the key over already
+                if self._calls.get(key) is flight:
+                    del self._calls[key]
+            flight['done'].set()
+
+    def _generation(self, label:str):
+        return (self._epoch, self._generations.get(label, 0))
 
 class MistAPIHandler:
 
     BASE_URL :str = 'https://api.mist.com/api/v1/'
-    headers :Dict[str,str] = {
+    # copied into every handler, credentials and site maps are never shared between handlers
+    default_headers :Dict[str,str] = {
         'Content-Type':'application/json',
         'X-CSRFTOKEN':''
     }
-    cookies:Dict[str,str] = {'sessionid':'', 'csrftoken':''}
     login_methods :list[str]= [
        'usr_pw',
-       'oauth2'
+       'oauth2',
+       'api_token'
     ]
     api_endpoints:Dict[str,str] = {
         "login":"login",
@@ -41,33 +308,218 @@ class MistAPIHandler:
         "import_map" : "sites/{}/maps/import",
         "org_import_map" : "orgs/{}/maps/import"
     }
-    sites  = {}
-    org_id = ''
-    
-    def __init__(self, login_method:str, login_params:Dict[str,str]) -> None:
+    # actions that can safely be sent again after a transient failure. Anything not listed here,
+    # like claiming or restarting a mist edge, is only ever sent once.
+    idempotent_actions:Dict[str,List[str]] = {
+        "login" : [],
+        "check_login" : ['get'],
+        "mxedges_stats" : ['get'],
+        "mxedge_stats" : ['get'],
+        "mxedge_events" : ['get'],
+        "sites" : ['get'],
+        "site" : ['get', 'put'],
+        "site_group" : ['get'],
+        "site_devices" : ['get'],
+        "site_devices_stats" : ['get'],
+        "device_config" : ['get', 'put'],
+        "device_profiles" : ['get'],
+        # assigning the same MACs to the same profile again leaves the profile as it was
+        "assign_to_device_profile" : ['post'],
+        "inventory" : ['get', 'put'],
+        "bounce_tunterm_data_ports" : [],
+        "mistedge_restart" : [],
+        "claim_mistedge" : [],
+        "assign_mistedge_to_site" : [],
+        "create_mistedge" : [],
+        "get_mxedge_models" : ['get'],
+        "get_mxedge_clusters" : ['get'],
+        "wlan" : ['get'],
+        "import_map" : [],
+        "org_import_map" : []
+    }
+    retry_statuses = {500, 502, 503, 504}
+    # endpoints that return a paginated list and can be read with iter_api_endpoint
+    list_endpoints = {
+        "mxedges_stats",
+        "sites",
+        "site_group",
+        "site_devices",
+        "site_devices_stats",
+        "device_profiles",
+        "inventory",
+        "get_mxedge_clusters",
+        "wlan"
+    }
+    # seconds a GET response stays cached. Override per endpoint with the cache_ttls option.
+    cache_ttls:Dict[str,float] = {
+        "check_login" : 900,
+        "sites" : 900,
+        "site" : 900,
+        "site_group" : 900,
+        "device_profiles" : 900,
+        "get_mxedge_models" : 86400
+    }
+    # cached endpoints to drop after a write to the endpoint used as the key
+    cache_invalidations:Dict[str,List[str]] = {
+        "sites" : ["sites"],
+        "site" : ["sites", "site"],
+        "site_group" : ["site_group"]
+    }
+    def __init__(self, login_method:str, login_params:Dict[str,str], pool_connections:int=10, pool_maxsize:int=10, pool_block:bool=False,
+                 requests_per_hour:int=5000, burst:int=None, max_throttle_retries:int=10, scheduler:RequestScheduler=None,
+                 max_retries:int=3, retry_backoff_base:float=0.5, retry_backoff_max:float=30.0, retry_budget:int=100,
+                 cache_ttls:Dict[str,float]=None, cache_file:str=None, page_limit:int=100, prefetch_pages:bool=False,
+                 latency_file:str=None, base_url:str=None, metrics_file:str=None, metrics_textfile:str=None, session_file:str=None,
+                 request_timeout:float=30.0) -> None:
+        if base_url is not None:
+            self.BASE_URL = base_url
+        self.headers = dict(self.default_headers)
+        self.cookies = {'sessionid':'', 'csrftoken':''}
+        self.sites = {}
+        self.org_id = ''
+        self.session = self._create_session(pool_connections, pool_maxsize, pool_block)
+        ttls = dict(self.cache_ttls)
+        ttls.update(cache_ttls or {})
+        self.cache = ResponseCache({endpoint:ttl for endpoint, ttl in ttls.items() if ttl}, cache_file, self._cache_namespace(login_params))
+        self.site_indexes = {}
+        self._site_index_lock = threading.Lock()
+        self.page_limit = page_limit
+        self.prefetch_pages = prefetch_pages
+        self.scheduler = scheduler if scheduler is not None else RequestScheduler(requests_per_hour, burst)
+        self.max_throttle_retries = max_throttle_retries
+        self.request_timeout = request_timeout
+        self.max_retries = max_retries
+        self.retry_backoff_base = retry_backoff_base
+        self.retry_backoff_max = retry_backoff_max
+        self.retry_budget = retry_budget
+        self.retry_counts = {}
+        self.single_flight = SingleFlight()
+        self.coalesced_counts = self.single_flight.coalesced
+        self._retry_lock = threading.Lock()
+        self.latency_file = latency_file
+        self.latencies = self._load_latencies(latency_file)
+        self._latency_lock = threading.Lock()
+        self.metrics = APIMetrics()
+        self.metrics_file = metrics_file
+        self.metrics_textfile = metrics_textfile
+        self._transfer = threading.local()
+        self.session_store = SessionStore(session_file) if session_file is not None else None
         if login_method not in self.login_methods:
             raise ValueError('Unsupported login method.')
         else:
             try:
                 if login_method == 'usr_pw':
-                    self._login_usr_pw(login_params)
+                    if not self._resume_session(login_params):
+                        self._measured('login', lambda: self._login_usr_pw(login_params))
+                        self._save_session(login_params)
+                elif login_method == 'api_token':
+                    self._login_api_token(login_params)
                 elif login_method == 'oauth2':
                     self._login_oauth2(login_params)
                 print('Login Successful. Tokens set.')
             except Exception as e:
                 print('Login Failed...')
                 print(e)
-                
+
+    def _create_session(self, pool_connections:int, pool_maxsize:int, pool_block:bool) -> requests.Session:
+        """
+        pool_connections : number of per-host connection pools to keep
+        pool_maxsize : max keep-alive connections kept open per host
+        pool_block : if true, never open more than pool_maxsize connections to a host and wait for a free one instead
+        """
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, pool_block=pool_block)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def get_connection_stats(self) -> Dict[str,int]:
+        """ Returns the number of requests sent through the session pools and how many of them reused an open connection. """
+        stats = {'requests':0, 'connections_opened':0, 'connections_reused':0}
+        for adapter in set(self.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for pool_key in pools.keys():
+                pool = pools[pool_key]
+                stats['requests'] += pool.num_requests
+                stats['connections_opened'] += pool.num_connections
+        stats['connections_reused'] = max(stats['requests'] - stats['connections_opened'], 0)
+        return stats
+
+    def get_latency_stats(self) -> Dict[str,float]:
+        """ Mean seconds per request of every endpoint measured in this and earlier runs that share the latency_file. """
+        with self._latency_lock:
+            return {endpoint:latency['total'] / latency['count'] for endpoint, latency in self.latencies.items() if latency['count']}
+
+    def save_latency_stats(self):
+        if self.latency_file is None:
+            return
+        with self._latency_lock:
+            temp_file = f'{self.latency_file}.tmp'
+            with open(temp_file, 'w') as f:
+                json.dump(self.latencies, f)
+            os.replace(temp_file, self.latency_file)
+
+    def _load_latencies(self, latency_file:str) -> Dict[str,Dict[str,float]]:
+        if latency_file is None or not os.path.exists(latency_file):
+            return {}
+        try:
+            with open(latency_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_metrics(self):
+        """ Write this run's per endpoint metrics to the metrics_file (JSON) and metrics_textfile (Prometheus) and update the latency_file. """
+        self.save_latency_stats()
+        if self.metrics_file is not None:
+            self.metrics.save_json(self.metrics_file)
+        if self.metrics_textfile is not None:
+            self.metrics.save_prometheus(self.metrics_textfile)
+
+    def _measured(self, api_endpoint:str, call):
+        """
+        Make one call and record its latency, outcome and the body bytes _send moved for it under api_endpoint.
+        The time _send waited on the scheduler is taken out of the latency and recorded on its own.
+        """
+        self._transfer.bytes_in = 0
+        self._transfer.bytes_out = 0
+        self._transfer.wait_seconds = 0.0
+        started = time.monotonic()
+        try:
+            response = call()
+        except Exception:
+            self._record_call(api_endpoint, time.monotonic() - started, error=True)
+            raise
+        self._record_call(api_endpoint, time.monotonic() - started)
+        return response
+
+    def _record_call(self, api_endpoint:str, seconds:float, error:bool = False):
+        wait_seconds = getattr(self._transfer, 'wait_seconds', 0.0)
+        seconds = max(0.0, seconds - wait_seconds)
+        self.metrics.observe(api_endpoint, seconds, error, getattr(self._transfer, 'bytes_in', 0), getattr(self._transfer, 'bytes_out', 0), wait_seconds)
+        if error:
+            return
+        with self._latency_lock:
+            latency = self.latencies.setdefault(api_endpoint, {'count':0, 'total':0.0})
+            latency['count'] += 1
+            latency['total'] += seconds
+
+    def invalidate_cache(self, api_endpoints:List[str] = None):
+        """ Drop cached responses of the given endpoints, or all cached responses when none are given. """
+        self.cache.invalidate(api_endpoints)
+        self.single_flight.invalidate(api_endpoints)
+        if api_endpoints is None or 'sites' in api_endpoints:
+            with self._site_index_lock:
+                self.site_indexes = {}
+
     def _login_usr_pw(self, login_params:Dict[str,str]) -> bool:
         api_path:str = 'login'
         if 'two_factor' not in login_params:
             body = json.dumps({'email':login_params['username'], 'password':login_params['password']})
             full_api_path = f"{self.BASE_URL}{api_path}"
-            response = requests.post(full_api_path,data=body,headers={'Content-Type':'application/json'})
+            response = self._send('post', full_api_path,data=body,headers={'Content-Type':'application/json'})
             if response.status_code == 200:
-                self.headers['X-CSRFTOKEN'] = response.cookies.get('csrftoken')
-                self.cookies['sessionid'] = response.cookies.get('sessionid')
-                self.cookies['csrftoken'] = response.cookies.get('csrftoken')
+                self._set_session(response.cookies.get('csrftoken'), response.cookies.get('sessionid'))
                 return True
             else:
                 raise ValueError
@@ -75,16 +527,14 @@ class MistAPIHandler:
             if login_params['two_factor'] is None:
                 body = json.dumps({'email':login_params['username'], 'password':login_params['password']})
                 full_api_path = f"{self.BASE_URL}{api_path}"
-                response = requests.post(full_api_path,data=body,headers={'Content-Type':'application/json'})
+                response = self._send('post', full_api_path,data=body,headers={'Content-Type':'application/json'})
                 if response.status_code == 200:
                     full_api_path += '/two_factor'
                     two_factor = input('Enter the two factor code:')
                     body = json.dumps({'two_factor':two_factor})
-                    response = requests.post(full_api_path,data=body,headers={'Content-Type':'application/json'})
+                    response = self._send('post', full_api_path,data=body,headers={'Content-Type':'application/json'})
                     if response.status_code == 200:
-                        self.headers['X-CSRFTOKEN'] = response.cookies.get('csrftoken')
-                        self.cookies['sessionid'] = response.cookies.get('sessionid')
-                        self.cookies['csrftoken'] = response.cookies.get('csrftoken')
+                        self._set_session(response.cookies.get('csrftoken'), response.cookies.get('sessionid'))
                         return True
                     else:
                         raise ValueError
@@ -93,19 +543,67 @@ class MistAPIHandler:
             else:
                 body = json.dumps({'email':login_params['username'], 'password':login_params['password'], 'two_factor':login_params['two_factor']})
                 full_api_path = f"{self.BASE_URL}{api_path}"
-                response = requests.post(full_api_path,data=body,headers={'Content-Type':'application/json'})
+                response = self._send('post', full_api_path,data=body,headers={'Content-Type':'application/json'})
                 if response.status_code == 200:
-                    self.headers['X-CSRFTOKEN'] = response.cookies.get('csrftoken')
-                    self.cookies['sessionid'] = response.cookies.get('sessionid')
-                    self.cookies['csrftoken'] = response.cookies.get('csrftoken')
+                    self._set_session(response.cookies.get('csrftoken'), response.cookies.get('sessionid'))
                     return True
                 else:
                     raise ValueError
 
+    def _set_session(self, csrftoken:str, sessionid:str):
+        # swap in new dicts so a request being sent from another thread never sees half updated credentials
+        self.headers = dict(self.headers, **{'X-CSRFTOKEN':csrftoken})
+        self.cookies = {'sessionid':sessionid, 'csrftoken':csrftoken}
+
+    def _login_api_token(self, login_params:Dict[str,str]) -> bool:
+        """ API tokens are sent with every request, so there is no login call to make. """
+        self.headers = dict(self.headers, Authorization=f"Token {login_params['api_token']}")
+        return True
+
+    def _cache_namespace(self, login_params:Dict[str,str]) -> str:
+        if 'api_token' in login_params:
+            # keep the token itself out of the cache file
+            return hashlib.sha256(login_params['api_token'].encode('utf-8')).hexdigest()[:16]
+        return login_params.get('username', '')
+
+    def _resume_session(self, login_params:Dict[str,str]) -> bool:
+        """ Reuse the session saved by an earlier run of the same user if the API still accepts it. """
+        if self.session_store is None:
+            return False
+        session = self.session_store.load()
+        if session is None or session.get('username') != login_params['username'] or session.get('base_url') != self.BASE_URL:
+            return False
+        cookies = session['cookies']
+        full_api_path = self._make_full_api_uri('check_login', [])
+        headers = dict(self.headers, **{'X-CSRFTOKEN':cookies['csrftoken']})
+        try:
+            response = self._measured('check_login', lambda: self._send('get', full_api_path, headers=headers, cookies=cookies))
+        except (requests.ConnectionError, requests.Timeout):
+            return False
+        if response.status_code != 200:
+            print('Saved session expired, logging in again...')
+            return False
+        self._set_session(cookies['csrftoken'], cookies['sessionid'])
+        # the response doubles as this run's first check_login
+        self.cache.set('check_login', full_api_path, response.json())
+        return True
+
+    def _save_session(self, login_params:Dict[str,str]):
+        if self.session_store is None:
+            return
+        self.session_store.save({'username':login_params['username'], 'base_url':self.BASE_URL, 'cookies':dict(self.cookies)})
+
     def populate_site_id_dict(self):
-        sites = self.get_sites(self.org_id)
-        for site in sites:
-            self.sites[site['name']] = site['id']
+        site_index = self.get_site_index(self.org_id)
+        self.sites.update(site_index.name_to_id)
+
+    def get_site_index(self, org_id:str = '') -> SiteIndex:
+        """ Returns the site index of the org, fetching the site list only the first time it is asked for. """
+        org_id = org_id if org_id != '' else self.org_id
+        with self._site_index_lock:
+            if org_id not in self.site_indexes:
+                self.site_indexes[org_id] = SiteIndex(self.get_sites(org_id))
+            return self.site_indexes[org_id]
 
     def save_org_id_by_name(self, org_name:str):
         login_response = self.check_login()
@@ -123,6 +621,10 @@ class MistAPIHandler:
 
         return self._action_api_endpoint('mxedges_stats',[org_id])
 
+    def iter_mist_edges_stats(self, org_id:str, prefetch:bool=None):
+
+        return self.iter_api_endpoint('mxedges_stats', [org_id], prefetch=prefetch)
+
     def get_mist_edge_stats(self,org_id:str,mist_edge_id:str) -> str:
 
         return self._action_api_endpoint("mxedge_stats",[org_id,mist_edge_id])
@@ -144,6 +646,14 @@ class MistAPIHandler:
 
         return self._action_api_endpoint('sites',[org_id])
 
+    def iter_sites(self, org_id:str, prefetch:bool=None):
+
+        return self.iter_api_endpoint('sites', [org_id], prefetch=prefetch)
+
+    def iter_site_groups(self, org_id:str, prefetch:bool=None):
+
+        return self.iter_api_endpoint('site_group', [org_id], prefetch=prefetch)
+
     def create_site(self, org_id:str, site_info:Dict[str,str]) -> Dict[str,str]:
 
         return self._action_api_endpoint('sites',[org_id],call_body=site_info,action='post')        
@@ -164,6 +674,14 @@ class MistAPIHandler:
 
         return self._action_api_endpoint('site_devices_stats', [site_id])
 
+    def iter_site_devices(self, site_id:str, prefetch:bool=None):
+
+        return self.iter_api_endpoint('site_devices', [site_id], prefetch=prefetch)
+
+    def iter_site_devices_stats(self, site_id:str, prefetch:bool=None):
+
+        return self.iter_api_endpoint('site_devices_stats', [site_id], prefetch=prefetch)
+
     def config_site_device(self, site_id:str, device_id:str, device_info: Dict) -> Dict[str, str]:
 
         return self._action_api_endpoint('device_config', [site_id, device_id], call_body=device_info, action='put')
@@ -172,6 +690,10 @@ class MistAPIHandler:
 
         return self._action_api_endpoint('device_profiles', [org_id])
 
+    def iter_device_profiles(self, org_id:str, prefetch:bool=None):
+
+        return self.iter_api_endpoint('device_profiles', [org_id], prefetch=prefetch)
+
     def assign_devices_to_device_profile(self, org_id:str, deviceprofile_id:str, devices:list[str]):
         """
         {
@@ -189,6 +711,10 @@ class MistAPIHandler:
 
         return self._action_api_endpoint('inventory',[org_id if org_id != '' else self.org_id])
 
+    def iter_inventory(self, org_id:str = '', prefetch:bool=None):
+
+        return self.iter_api_endpoint('inventory', [org_id if org_id != '' else self.org_id], prefetch=prefetch)
+
     def add_inventory_to_org(self, org_id:str, inventory_info:Dict[str,str]) -> Dict[str,str]:
         """
         [
@@ -314,6 +840,10 @@ class MistAPIHandler:
 
         return self._action_api_endpoint('get_mxedge_clusters', [org_id])
 
+    def iter_mxedge_clusters(self, org_id:str, prefetch:bool=None):
+
+        return self.iter_api_endpoint('get_mxedge_clusters', [org_id], prefetch=prefetch)
+
     def create_site_group(self, org_id:str, site_group_info:Dict[str,str]) -> Dict[str, str]:
         """
         {
@@ -326,6 +856,10 @@ class MistAPIHandler:
         
         return self._action_api_endpoint('wlans', [org_id])
 
+    def iter_org_wlans(self, org_id:str, prefetch:bool=None):
+
+        return self.iter_api_endpoint('wlan', [org_id], prefetch=prefetch)
+
     def import_map(self, site_id:str, map, headers:Dict) -> Dict[str, str]:
 
         return self._action_api_endpoint('import_map', [site_id], call_body=map, action='post', multi=True, custom_headers=headers)
@@ -334,10 +868,53 @@ class MistAPIHandler:
     def _action_api_endpoint(self, api_endpoint:str, api_params:list[str], call_body:Dict[str,str]={}, action:str='get', multi:bool=False, custom_headers:Dict={}) -> Dict[str,str]:
         
         full_api_path = self._make_full_api_uri(api_endpoint, api_params)
+        if action == 'get' and not multi:
+            cached, response = self.cache.get(api_endpoint, full_api_path)
+            if cached:
+                return response
+            # identical reads already in flight are joined instead of being sent again
+            return self.single_flight.do(full_api_path, api_endpoint, lambda: self._read_api_endpoint(api_endpoint, full_api_path))
         if multi:
-            return self._make_multi_api_call(full_api_path, call_body, custom_headers)
+            response = self._call_with_retries(api_endpoint, 'post', lambda: self._make_multi_api_call(full_api_path, call_body, custom_headers))
         else:
-            return self._make_api_call(full_api_path, call_body, action)
+            response = self._call_with_retries(api_endpoint, action, lambda: self._make_api_call(full_api_path, call_body, action))
+        if api_endpoint in self.cache_invalidations:
+            self.invalidate_cache(self.cache_invalidations[api_endpoint])
+        return response
+
+    def _read_api_endpoint(self, api_endpoint:str, full_api_path:str) -> Dict[str,str]:
+        generation = self.single_flight.generation(api_endpoint)
+        response = self._call_with_retries(api_endpoint, 'get', lambda: self._make_api_call(full_api_path, {}, 'get'))
+        # a read that raced an invalidation of its endpoint may be older than the write, it is not cached
+        if self.single_flight.generation(api_endpoint) == generation:
+            self.cache.set(api_endpoint, full_api_path, response)
+        return response
+
+    def _call_with_retries(self, api_endpoint:str, action:str, call):
+        attempt = 0
+        while True:
+            try:
+                return self._measured(api_endpoint, call)
+            except (APIRequestError, requests.ConnectionError, requests.Timeout) as e:
+                if not self._take_retry(api_endpoint, action, e, attempt):
+                    raise
+                delay = random.uniform(0, min(self.retry_backoff_max, self.retry_backoff_base * 2 ** attempt))
+                print(f'{api_endpoint} request failed ({e}), retrying in {delay:.1f} seconds...')
+                time.sleep(delay)
+                attempt += 1
+
+    def _take_retry(self, api_endpoint:str, action:str, error:Exception, attempt:int) -> bool:
+        """ Decide if a failed call is retried and if so spend one retry from the run's retry budget. """
+        if isinstance(error, APIRequestError) and error.status_code not in self.retry_statuses:
+            return False
+        if action not in self.idempotent_actions.get(api_endpoint, []) or attempt >= self.max_retries:
+            return False
+        with self._retry_lock:
+            if self.retry_budget <= 0:
+                return False
+            self.retry_budget -= 1
+            self.retry_counts[api_endpoint] = self.retry_counts.get(api_endpoint, 0) + 1
+        return True
 
     def _make_full_api_uri(self, api_endpoint:str, api_params:list[str]) -> str:
 
@@ -348,22 +925,93 @@ class MistAPIHandler:
         else:
             raise ValueError(f"The API endpoint is not currently supported. Add it to the api_endpoints list and try again.")
     
-    def _make_multi_api_call(self, full_api_path:str, call_body, headers:Dict) -> Dict[str,str]:
-        headers['X-CSRFTOKEN'] = self.headers['X-CSRFTOKEN']
-        response = requests.request('post', full_api_path, data=call_body, headers=headers, cookies=self.cookies)
+    def _send(self, action:str, full_api_path:str, **kwargs) -> requests.Response:
+        """ Send a request through the scheduler. A 429 defers every request until Retry-After has passed and then resends. """
+        throttle_retries = 0
+        while True:
+            waiting = time.monotonic()
+            self.scheduler.acquire()
+            self._transfer.wait_seconds = getattr(self._transfer, 'wait_seconds', 0.0) + time.monotonic() - waiting
+            response = self.session.request(action, full_api_path, timeout=self.request_timeout, **kwargs)
+            self._count_transfer(kwargs.get('data'), response)
+            if response.status_code != 429 or throttle_retries >= self.max_throttle_retries:
+                return response
+            throttle_retries += 1
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            print(f'API rate limit reached, waiting {retry_after:.0f} seconds before retrying...')
+            self.scheduler.defer(retry_after)
+
+    def _count_transfer(self, data, response:requests.Response):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self._transfer.bytes_out = getattr(self._transfer, 'bytes_out', 0) + (len(data) if isinstance(data, bytes) else 0)
+        self._transfer.bytes_in = getattr(self._transfer, 'bytes_in', 0) + len(response.content)
+
+    def _make_multi_api_call(self, full_api_path:str, call_body, custom_headers:Dict) -> Dict[str,str]:
+        # the caller's headers are left as they are, they may be reused for the next upload
+        headers = dict(custom_headers)
+        auth_headers = self.headers
+        headers['X-CSRFTOKEN'] = auth_headers['X-CSRFTOKEN']
+        if 'Authorization' in auth_headers:
+            headers['Authorization'] = auth_headers['Authorization']
+        response = self._send('post', full_api_path, data=call_body, headers=headers, cookies=self.cookies)
         if response.status_code == 200:
             return response.json()
         else:
-            raise Exception(f"Request failed: {response.status_code} {response.reason}")
+            raise APIRequestError(response.status_code, response.reason)
+
+    def iter_api_endpoint(self, api_endpoint:str, api_params:list[str], page_limit:int=None, prefetch:bool=None):
+        """
+        Yields the items of a list endpoint one at a time, following the limit/page query parameters
+        and the X-Page-Total response header. With prefetch the next page is requested while the
+        current one is being consumed.
+        """
+        if api_endpoint not in self.list_endpoints:
+            raise ValueError(f'{api_endpoint} is not a list endpoint.')
+        full_api_path = self._make_full_api_uri(api_endpoint, api_params)
+        page_limit = page_limit if page_limit is not None else self.page_limit
+        prefetch = prefetch if prefetch is not None else self.prefetch_pages
+        fetch_page = lambda page: self.single_flight.do(
+            f'{full_api_path} page={page} limit={page_limit}', api_endpoint,
+            lambda: self._call_with_retries(api_endpoint, 'get', lambda: self._make_page_call(full_api_path, page, page_limit))
+        )
+        executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        try:
+            page = 1
+            items, total = fetch_page(page)
+            while True:
+                if total is not None:
+                    has_next_page = page * page_limit < total
+                else:
+                    has_next_page = len(items) == page_limit
+                next_page = executor.submit(fetch_page, page + 1) if has_next_page and executor is not None else None
+                for item in items:
+                    yield item
+                if not has_next_page:
+                    return
+                page += 1
+                items, total = next_page.result() if next_page is not None else fetch_page(page)
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True)
+
+    def _make_page_call(self, full_api_path:str, page:int, page_limit:int) -> Tuple[List[Dict], int]:
+        """ Returns the items of one page and the total item count reported by the API, if any. """
+        response = self._send('get', full_api_path, params={'limit':page_limit, 'page':page}, headers=self.headers, cookies=self.cookies)
+        if response.status_code == 200:
+            total = response.headers.get('X-Page-Total')
+            return response.json(), int(total) if total is not None else None
+        else:
+            raise APIRequestError(response.status_code, response.reason)
 
     def _make_api_call(self, full_api_path:str, call_body:Dict[str,str], action:str) -> Dict[str,str]:
 
-        if action != 'get' or action != 'delete':
+        if action not in ('get', 'delete'):
             data = json.dumps(call_body)
-            response = requests.request(action,full_api_path,data=data,headers=self.headers,cookies=self.cookies)
+            response = self._send(action,full_api_path,data=data,headers=self.headers,cookies=self.cookies)
         else:
-            response = requests.request(action,full_api_path,headers=self.headers,cookies=self.cookies)
+            response = self._send(action,full_api_path,headers=self.headers,cookies=self.cookies)
         if response.status_code == 200:
             return response.json()
         else:
-            raise Exception(f"Request failed: {response.status_code} {response.reason}")
\ No newline at end of file
+            raise APIRequestError(response.status_code, response.reason)
\ No newline at end of file
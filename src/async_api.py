@@ -0,0 +1,46 @@
+from concurrent.futures import ThreadPoolExecutor
+from api import MistAPIHandler
+import asyncio
+import functools
+
+class AsyncMistAPIHandler:
+    """
+    Awaitable view of a logged in MistAPIHandler. Every public method of the wrapped handler
+    (get_site_devices, config_site_device, assign_inventory_to_site, ...) can be awaited with the
+    same arguments. Calls run on worker threads that share the handler's pooled session and at
+    most max_in_flight requests are outstanding at any time. Keep the handler's pool_maxsize at
+    least as large as max_in_flight so every worker gets a keep-alive connection.
+    """
+
+    def __init__(self, handler:MistAPIHandler, max_in_flight:int=8):
+        if max_in_flight < 1:
+            raise ValueError('max_in_flight must be at least 1.')
+        self.handler = handler
+        self.max_in_flight = max_in_flight
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    async def run(self, function, *args, **kwargs):
+        """ Run any blocking callable, like consuming one of the handler's iter_ generators, within the in-flight limit. """
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, functools.partial(function, *args, **kwargs))
+
+    def __getattr__(self, name:str):
+        attribute = getattr(self.handler, name)
+        if name.startswith('_') or not callable(attribute):
+            return attribute
+
+        async def call(*args, **kwargs):
+            return await self.run(attribute, *args, **kwargs)
+
+        return call
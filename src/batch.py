@@ -0,0 +1,137 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List
+import contextlib
+import traceback
+import hashlib
+import time
+import sys
+import os
+from api import MistAPIHandler
+from file_ops import ConfigReader, ExcelWriter, EkahauWriter
+import tasks
+
+# the files a run keeps its own state in, relative paths to them are moved into the state_dir of a batch config
+STATE_FILES = {
+    'sites' : ['device_index_file'],
+    'api' : ['cache_file', 'latency_file', 'metrics_file', 'metrics_textfile', 'session_file']
+}
+
+def run_name(config_file:str) -> str:
+    """ The config's name plus a hash of its full path, so configs with the same name in different folders stay apart. """
+    config_name = os.path.splitext(os.path.basename(config_file))[0]
+    path_hash = hashlib.sha1(os.path.abspath(config_file).encode('utf-8')).hexdigest()[:8]
+    return f'{config_name}-{path_hash}'
+
+def isolate_state_files(config:Dict, state_dir:str):
+    for section, keys in STATE_FILES.items():
+        options = config.get(section) or {}
+        for key in keys:
+            if options.get(key) and not os.path.isabs(options[key]):
+                options[key] = os.path.join(state_dir, options[key])
+                os.makedirs(os.path.dirname(options[key]), exist_ok=True)
+
+def needs_two_factor_prompt(config:Dict) -> bool:
+    login = config.get('login') or {}
+    return 'api_token' not in login and 'two_factor' in login and login['two_factor'] is None
+
+def failed_summary(config_file:str, error:str) -> Dict:
+    return {'config':config_file, 'status':'failed', 'error':error, 'seconds':0.0, 'results':[], 'task_seconds':{}, 'api_requests':0}
+
+def run_config(config_file:str, log_dir:str = None, state_dir:str = None) -> Dict:
+    """
+    Run the TaskManager pipeline of one config file. Anything it prints goes to <log_dir>/<run_name>.log
+    when log_dir is given, and its state files are kept under state_dir when it is given. Failures are
+    reported in the result instead of raised, so one bad config does not stop the rest of a batch.
+
+    {
+        "config" : str,
+        "status" : "ok" || "failed",
+        "error" : str || None,
+        "seconds" : float,
+        "results" : [{"task" : str, ...}, ...],
+        "task_seconds" : {task : float, ...},
+        "api_requests" : int
+    }
+    """
+    summary = {'config':config_file, 'status':'ok', 'error':None, 'seconds':0.0, 'results':[], 'task_seconds':{}, 'api_requests':0}
+    started = time.perf_counter()
+    with contextlib.ExitStack() as stack:
+        if log_dir is not None:
+            os.makedirs(log_dir, exist_ok=True)
+            log = stack.enter_context(open(os.path.join(log_dir, f'{run_name(config_file)}.log'), 'w'))
+            stack.enter_context(contextlib.redirect_stdout(log))
+        try:
+            config = ConfigReader(config_file).extract_information_from_file()
+            if state_dir is not None:
+                isolate_state_files(config, state_dir)
+            task_manager = tasks.TaskManager(config=config, handler=MistAPIHandler, writer=ExcelWriter, esx_writer=EkahauWriter(config))
+            task_manager.create_tasks()
+            task_manager.execute_tasks()
+            summary['results'] = task_manager.results
+            summary['task_seconds'] = task_manager.run_stats['task_seconds']
+            if task_manager.handler is not None:
+                summary['api_requests'] = task_manager.handler.scheduler.requests_sent
+        except (Exception, SystemExit) as e:
+            # TaskManager exits when a data structure cannot be built, that only ends this config
+            traceback.print_exc(file=sys.stdout)
+            summary['status'] = 'failed'
+            summary['error'] = f'{type(e).__name__}: {e}'
+    summary['seconds'] = time.perf_counter() - started
+    return summary
+
+def run_batch(config_files:List[str], max_workers:int = 4, log_dir:str = None, state_dir:str = os.path.join('data', 'batch')) -> Dict:
+    """
+    Run many config files in a pool of at most max_workers processes. Each config gets its own
+    process, so its handler, login and request pacing are its own, and its own folder under state_dir
+    for its state files. Every org's hourly budget is counted separately by the API, max_workers only
+    caps how many run at once. Configs that would ask for a two factor code fail before the pool starts,
+    a worker has no terminal to ask on.
+
+    {
+        "configs" : [<run_config result>, ...],
+        "succeeded" : int,
+        "failed" : int,
+        "seconds" : float
+    }
+    """
+    started = time.perf_counter()
+    configs = [None] * len(config_files)
+    runnable = []
+    for num, config_file in enumerate(config_files):
+        try:
+            config = ConfigReader(config_file).extract_information_from_file()
+        except Exception:
+            # run_config reports configs that cannot be read
+            config = {}
+        if needs_two_factor_prompt(config):
+            configs[num] = failed_summary(config_file, 'ValueError: two_factor must be given in the config to run in a batch')
+            print(f"{config_file}: {configs[num]['status']}, {configs[num]['error']}")
+        else:
+            runnable.append(num)
+    with ProcessPoolExecutor(max_workers=max(1, min(max_workers, len(runnable)))) as executor:
+        futures = {executor.submit(run_config, config_files[num], log_dir, os.path.join(state_dir, run_name(config_files[num]))):num for num in runnable}
+        for future in as_completed(futures):
+            num = futures[future]
+            try:
+                configs[num] = future.result()
+            except Exception as e:
+                # the worker process itself died, run_config catches everything else
+                configs[num] = failed_summary(config_files[num], f'{type(e).__name__}: {e}')
+            print(f"{config_files[num]}: {configs[num]['status']} in {configs[num]['seconds']:.1f}s")
+    return {
+        'configs' : configs,
+        'succeeded' : sum(1 for summary in configs if summary['status'] == 'ok'),
+        'failed' : sum(1 for summary in configs if summary['status'] == 'failed'),
+        'seconds' : time.perf_counter() - started
+    }
+
+def format_summary(batch:Dict) -> str:
+    lines = []
+    for summary in batch['configs']:
+        if summary['status'] == 'ok':
+            task_times = ', '.join(f'{task} {seconds:.1f}s' for task, seconds in summary['task_seconds'].items())
+            lines.append(f"{summary['config']}: ok in {summary['seconds']:.1f}s, {summary['api_requests']} api requests ({task_times})")
+        else:
+            lines.append(f"{summary['config']}: failed in {summary['seconds']:.1f}s, {summary['error']}")
+    lines.append(f"{batch['succeeded']} succeeded, {batch['failed']} failed, {len(batch['configs'])} configs in {batch['seconds']:.1f}s")
+    return '\n'.join(lines)
@@ -0,0 +1,103 @@
+from api import MistAPIHandler
+from typing import Dict, List
+import threading
+import json
+import time
+import os
+
+class DeviceIndex:
+    """
+    Org wide index of device MAC to site_id, device id and current name, built from one paginated
+    inventory pull per run so the tasks resolve devices without reading every site. Assignments and
+    names pushed during the run are recorded in it. It can be saved to disk with the time it was
+    refreshed, dry runs plan from the saved index.
+
+    {
+        "org_id" : str,
+        "refreshed_at" : float, unix time of the last full or site refresh
+        "devices" : {
+            mac : {"site_id" : str || None, "id" : str, "name" : str || None},
+            ...
+        }
+    }
+    """
+
+    def __init__(self, org_id:str = None, devices:Dict[str, Dict[str,str]] = None, refreshed_at:float = 0.0):
+        self.org_id = org_id
+        self.devices = devices if devices is not None else {}
+        self.refreshed_at = refreshed_at
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, index_file:str, org_id:str):
+        """ Returns the index saved in index_file, or None if there is none for this org. """
+        if not os.path.exists(index_file):
+            return None
+        try:
+            with open(index_file) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if saved.get('org_id') != org_id:
+            return None
+        return cls(org_id, saved['devices'], saved['refreshed_at'])
+
+    def save(self, index_file:str):
+        with self._lock:
+            saved = {'org_id':self.org_id, 'refreshed_at':self.refreshed_at, 'devices':self.devices}
+            if os.path.dirname(index_file):
+                os.makedirs(os.path.dirname(index_file), exist_ok=True)
+            temp_file = f'{index_file}.tmp'
+            with open(temp_file, 'w') as f:
+                json.dump(saved, f)
+            os.replace(temp_file, index_file)
+
+    def refresh(self, handler:MistAPIHandler):
+        """ Rebuild the whole index from the org inventory. """
+        devices = {}
+        for device in handler.iter_inventory(self.org_id, prefetch=True):
+            devices[device['mac'].lower()] = self._entry(device)
+        with self._lock:
+            self.devices = devices
+            self.refreshed_at = time.time()
+
+    def update_site(self, site_id:str, devices:List[Dict]):
+        """ Replace the index's view of a site with the devices just read from it. """
+        site_devices = {device['mac'].lower():self._entry(device, site_id) for device in devices}
+        with self._lock:
+            for mac, entry in self.devices.items():
+                if entry['site_id'] == site_id and mac not in site_devices:
+                    entry['site_id'] = None
+            self.devices.update(site_devices)
+
+    def lookup(self, mac:str) -> Dict[str,str]:
+        return self.devices.get(mac.lower())
+
+    def get_site_device(self, mac:str, site_id:str) -> Dict[str,str]:
+        """ The entry of mac if the index has it in site_id with a known device id. """
+        entry = self.lookup(mac)
+        if entry is None or entry['site_id'] != site_id or entry['id'] is None:
+            return None
+        return entry
+
+    def assign_to_site(self, macs:List[str], site_id:str):
+        with self._lock:
+            for mac in macs:
+                entry = self.devices.setdefault(mac.lower(), {'site_id':None, 'id':None, 'name':None})
+                entry['site_id'] = site_id
+
+    def set_name(self, mac:str, name:str):
+        with self._lock:
+            entry = self.devices.get(mac.lower())
+            if entry is not None:
+                entry['name'] = name
+
+    def __len__(self) -> int:
+        return len(self.devices)
+
+    def _entry(self, device:Dict, site_id:str = None) -> Dict[str,str]:
+        return {
+            'site_id' : device.get('site_id', site_id),
+            'id' : device.get('id'),
+            'name' : device.get('name')
+        }
@@ -8,8 +8,156 @@ import yaml
 import re
 import os
 import copy
+import threading
+import hashlib
+import io
+import openpyxl
 import excel
 
+class SheetCache:
+    """
+    Parsed workbook sheets of this process, keyed by (path, mtime, size, sheet) so every reader of the
+    installer workbook in a run shares one parse of each sheet. A changed workbook gets a new key and
+    its old sheets are dropped. Callers get their own copy of the DataFrame to change as they like.
+
+    With sidecar set, a sheet missing from memory is looked up in a JSON sidecar file of the workbook
+    in sidecar_dir before it is parsed, and saved there after. The sidecar is keyed by the sha256 of
+    the workbook contents, so a later run against the same workbook skips parsing it altogether. It
+    is plain JSON so reading it can never run code, whoever wrote it.
+
+    {
+        "sha256" : str,
+        "sheets" : [{"key" : [sheet, columns || None, required || None], "frame" : DataFrame.to_json(orient='split')}, ...]
+    }
+    """
+
+    def __init__(self, sidecar_dir:str = os.path.join('data', 'workbook_cache')):
+        self.sidecar_dir = sidecar_dir
+        self.sheets = {}
+        self.hits = 0
+        self.misses = 0
+        self.sidecar_hits = 0
+        self._lock = threading.Lock()
+
+    def read_excel(self, path:str, sheet_name = 0, sidecar:bool = False) -> pandas.DataFrame:
+        sheet_name = sheet_name if sheet_name not in (None, '') else 0
+        path = os.path.abspath(path)
+        return self._read(path, (sheet_name, None, None), lambda: pandas.read_excel(path, sheet_name=sheet_name), sidecar)
+
+    def read_columns(self, path:str, sheet_name, columns:List[str], required:str = None, sidecar:bool = False) -> pandas.DataFrame:
+        """ Only the given columns of the sheet, streamed with iter_sheet_records and cached like whole sheets. """
+        sheet_name = sheet_name if sheet_name not in (None, '') else 0
+        path = os.path.abspath(path)
+        parse = lambda: pandas.DataFrame.from_records(list(iter_sheet_records(path, columns, sheet_name, required)), columns=columns)
+        return self._read(path, (sheet_name, tuple(columns), required), parse, sidecar)
+
+    def clear(self):
+        with self._lock:
+            self.sheets = {}
+
+    def _read(self, path:str, sheet_key:Tuple, parse, sidecar:bool) -> pandas.DataFrame:
+        stat = os.stat(path)
+        key = (path, stat.st_mtime_ns, stat.st_size) + sheet_key
+        with self._lock:
+            dataframe = self.sheets.get(key)
+            if dataframe is None:
+                self.misses += 1
+                digest = self._hash_file(path) if sidecar else None
+                dataframe = self._load_sidecar(path, digest, sheet_key) if sidecar else None
+                if dataframe is None:
+                    dataframe = parse()
+                    if sidecar:
+                        self._save_sidecar(path, digest, sheet_key, dataframe)
+                else:
+                    self.sidecar_hits += 1
+                self.sheets = {cached_key:sheet for cached_key, sheet in self.sheets.items() if cached_key[0] != path or cached_key[1:3] == key[1:3]}
+                self.sheets[key] = dataframe
+            else:
+                self.hits += 1
+        return dataframe.copy()
+
+    def _hash_file(self, path:str) -> str:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(2 ** 20), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def sidecar_file(self, path:str) -> str:
+        """ One sidecar per workbook path, named by its hash so the workbook's folder is never written to. """
+        return os.path.join(self.sidecar_dir, f"{hashlib.sha256(path.encode('utf-8')).hexdigest()[:16]}.json")
+
+    def _read_sidecar(self, path:str, digest:str) -> Dict:
+        try:
+            with open(self.sidecar_file(path)) as f:
+                sidecar = json.load(f)
+        except (OSError, ValueError):
+            # missing or half written, the workbook is parsed instead
+            return {'sha256':digest, 'sheets':[]}
+        if not isinstance(sidecar, dict) or sidecar.get('sha256') != digest or not isinstance(sidecar.get('sheets'), list):
+            return {'sha256':digest, 'sheets':[]}
+        return sidecar
+
+    def _load_sidecar(self, path:str, digest:str, sheet_key:Tuple) -> pandas.DataFrame:
+        for sheet in self._read_sidecar(path, digest)['sheets']:
+            if sheet.get('key') == self._json_key(sheet_key):
+                try:
+                    return pandas.read_json(io.StringIO(sheet['frame']), orient='split', dtype=False, convert_dates=False)
+                except (KeyError, TypeError, ValueError):
+                    return None
+        return None
+
+    def _save_sidecar(self, path:str, digest:str, sheet_key:Tuple, dataframe:pandas.DataFrame):
+        sidecar = self._read_sidecar(path, digest)
+        json_key = self._json_key(sheet_key)
+        sidecar['sheets'] = [sheet for sheet in sidecar['sheets'] if sheet.get('key') != json_key]
+        sidecar['sheets'].append({'key':json_key, 'frame':dataframe.to_json(orient='split', date_format='iso')})
+        sidecar_file = self.sidecar_file(path)
+        temp_file = f'{sidecar_file}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(self.sidecar_dir, exist_ok=True)
+            with open(temp_file, 'w') as f:
+                json.dump(sidecar, f)
+            os.replace(temp_file, sidecar_file)
+        except OSError as e:
+            print(f'Could not save the sheet cache of {path}: {e}')
+
+    def _json_key(self, sheet_key:Tuple) -> List:
+        sheet_name, columns, required = sheet_key
+        return [sheet_name, list(columns) if columns is not None else None, required]
+
+sheet_cache = SheetCache()
+
+def iter_sheet_records(path:str, columns:List[str], sheet_name = 0, required:str = None, header_search_rows:int = 50):
+    """
+    Stream the rows of a sheet with openpyxl in read only mode and yield a tuple with the values of
+    columns for each of them, so only those columns are ever held in memory. The header row is the
+    first of the top header_search_rows rows that holds every column name. Rows where the required
+    column is empty, and rows where every projected column is empty, are skipped.
+    """
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        worksheet = workbook[sheet_name] if isinstance(sheet_name, str) else workbook.worksheets[sheet_name]
+        rows = worksheet.iter_rows(values_only=True)
+        indexes = None
+        for _, row in zip(range(header_search_rows), rows):
+            names = list(row)
+            if all(column in names for column in columns):
+                indexes = [names.index(column) for column in columns]
+                break
+        if indexes is None:
+            raise ValueError(f'No row with the columns {columns} in the first {header_search_rows} rows of {path}.')
+        required_index = indexes[columns.index(required)] if required is not None else None
+        for row in rows:
+            if required_index is not None and (required_index >= len(row) or row[required_index] in (None, '')):
+                continue
+            record = tuple(row[index] if index < len(row) else None for index in indexes)
+            if all(value is None for value in record):
+                continue
+            yield record
+    finally:
+        workbook.close()
+
 class IOReader:
     def __init__(self, file:str):
         try:
@@ -19,17 +167,20 @@ class IOReader:
             raise IOError('Could not open file. Check the path/name.')
 
 class ExcelReader(IOReader):
-    def __init__(self, file:str):
+    def __init__(self, file:str, stream:bool = False, sidecar:bool = False):
         super().__init__(file)
         self.file = file
+        self.stream = stream
+        self.sidecar = sidecar
 
     def extract_table_from_file(self, headers:List[str], dropset:List[str] = [], groupby:str = '', worksheet:str='') -> List[List[str]]:
-        if worksheet != '':
-            ex_excel = pandas.read_excel(rf'{self.file}', sheet_name=worksheet)
-        else:
-            ex_excel = pandas.read_excel(rf'{self.file}')
+        if self.stream:
+            # only the header columns are read and rows without a dropset value are skipped while reading
+            to_process = sheet_cache.read_columns(self.file, worksheet, headers, dropset[0] if dropset else None, self.sidecar)
+            return to_process.groupby(groupby) if groupby != '' else to_process
+        ex_excel = sheet_cache.read_excel(self.file, worksheet, self.sidecar)
         to_process = ex_excel.dropna(subset=['New WAP \nMAC Address']) if dropset != '' else ex_excel
-        values = to_process.loc[:,headers].groupby(groupby) if groupby != '' else to_process[:,headers]
+        values = to_process.loc[:,headers].groupby(groupby) if groupby != '' else to_process.loc[:,headers]
         return values
 
 class ConfigReader(IOReader):
@@ -40,7 +191,7 @@ class ConfigReader(IOReader):
 
     def extract_information_from_file(self):
         
-        with open('config.yml') as f:
+        with open(self.file) as f:
             config_lines = f.read()
             for task in self.process_tasks:
                 config_lines = task(config_lines)
@@ -344,26 +495,31 @@ class EkahauWriter:
         return (esx_old_filepath, esx_new_filepath)
 
     def ap_names_are_unique_throughout_excel_file(self) -> bool:
-        excel_file = self.config['sites']['ap_excel_file']
-        sheet_name = self.config['sites']['sheet_name']
         esx_ap_column = self.config['sites']['header_column_names']['esx_ap_name'].replace('\\n', '\n')
-        df = pandas.read_excel(excel_file, sheet_name=sheet_name).dropna(subset=[esx_ap_column])
+        df = self._read_installer_sheet().dropna(subset=[esx_ap_column])
         aps = df[esx_ap_column].values.tolist()
         for ap in aps:
             if aps.count(ap) > 1:
                 return False
         return True
 
+    def _read_installer_sheet(self) -> pandas.DataFrame:
+        sites = self.config['sites']
+        sidecar = sites.get('workbook_cache', False)
+        if sites.get('excel_reader', 'pandas') != 'stream':
+            return sheet_cache.read_excel(sites['ap_excel_file'], sites['sheet_name'], sidecar)
+        header_column_names = sites['header_column_names']
+        columns = [header_column_names['esx_ap_name'].replace('\\n', '\n'), header_column_names['ap_name'], header_column_names['site_name'].replace('\\n', '\n')]
+        return sheet_cache.read_columns(sites['ap_excel_file'], sites['sheet_name'], columns, sidecar=sidecar)
+
     def create_ap_naming_dict(self, floor_dependent_naming:bool=False) -> Dict[str, str]:
-        excel_filepath = self.config['sites']['ap_excel_file']
-        sheet_name = self.config['sites']['sheet_name']
         lowercase_name = self.config['sites']['lowercase_ap_names']
         excel_columns_to_read = [
             self.config['sites']['header_column_names']['esx_ap_name'].replace('\\n','\n'),
             self.config['sites']['header_column_names']['ap_name']
             ]
         site_column = self.config['sites']['header_column_names']['site_name'].replace('\\n','\n')
-        df = pandas.read_excel(excel_filepath, sheet_name=sheet_name)
+        df = self._read_installer_sheet()
         df_without_empty_names = df.dropna(subset=['New WAP Name'])
         ap_naming_dict = {}
         if floor_dependent_naming:
@@ -1,26 +1,22 @@
 from api import MistAPIHandler
 import excel
+import functools
 import pandas
 import re
 from typing import List, Dict, Tuple
+from mac import normalize_macs, try_parse_mac
+
+FLOOR_PATTERNS = [re.compile(r'Flr-\d+$'), re.compile(r'\d(st|nd|rd|th) Flr')]
 
 def inventory_devices(handler:MistAPIHandler, org_id:str):
     try:
-        print('Gathering inventory...')
-        response_json = handler.get_inventory(org_id)
-        print('Inventory gathered.')
-        sites = {}
+        site_index = handler.get_site_index(org_id)
         devices = [['NAME', 'MODEL', 'MAC', 'SITE', 'CONNECTED']]
-        print('Populating tables...')
-        for device in response_json:
+        print('Gathering inventory and populating tables...')
+        for device in handler.iter_inventory(org_id, prefetch=True):
             device_siteid = device['site_id']
             if device_siteid is not None:
-                if device_siteid not in sites:
-                    site_response = handler.get_sites(org_id)
-                    for site in site_response:
-                        if site['id'] == device_siteid:
-                            sites[device_siteid] = site['name']
-                device['site'] = sites[device_siteid]
+                device['site'] = site_index.get_name(device_siteid, '')
             else:
                 device['site'] = ''
             devices.append([device['name'],device['model'],device['mac'],device['site'],'UP' if device['connected'] else 'DOWN'])
@@ -49,25 +45,55 @@ def create_site_to_ap_name_mac_from_dataframe(dataframe:pandas.DataFrame, header
         It's expected that the dataframe has dropped the all rows with ap mac == na
     """
     #first header should be site name
-    values = dataframe.loc[:,header_names].groupby(header_names[0])
+    site, ap_name, ap_mac = header_names
+    frame = dataframe.loc[:,header_names]
+    frame[ap_mac] = normalize_macs(frame[ap_mac])
     site_mac_name = {}
-    for name, group in values:
-        site_mac_name[name] = {}
-        for item in group.values:
-            _, ap_name, ap_mac = item
-            site_mac_name[name][ap_mac.lower()] = ap_name
+    for name, group in frame.dropna(subset=[ap_mac]).groupby(site):
+        site_mac_name[name] = dict(zip(group[ap_mac], group[ap_name]))
     return site_mac_name
 
 def remove_floor_from_site_name(site:str) -> str:
-    site_formats = ['Flr-\d+$', '\d(st|nd|rd|th) Flr']
-    for site_format in site_formats:
-        floor = re.compile(r''+site_format)
+    for floor in FLOOR_PATTERNS:
         floor_match = floor.search(site)
         if floor_match:
             start = floor_match.start()
             return site[:start-1]
     raise ValueError('Site does not conform to SITE Flr-xx format.')
 
+def remove_floor_from_site_names(sites:pandas.Series) -> pandas.Series:
+    """ remove_floor_from_site_name of every site, sites without a floor keep their name. Each distinct site is matched once. """
+    site_wo_floor = {}
+    for site in sites.unique():
+        try:
+            site_wo_floor[site] = remove_floor_from_site_name(site)
+        except (ValueError, TypeError):
+            site_wo_floor[site] = site
+    return sites.map(site_wo_floor)
+
+def split_site_mac_frame(dataframe:pandas.DataFrame, header_names:List[str]) -> Tuple[pandas.DataFrame, pandas.Series]:
+    """
+        header_names are the site, ap name and ap mac columns, like ['site', 'ap name', 'ap mac'].
+        returns: the rows with a site, their site names without the floor and their MACs in the form the Mist API uses, in the order
+                 a groupby on the site column visits them, and a mask of the rows whose MAC is valid. Invalid MACs are kept as read.
+    """
+    site, _, ap_mac = header_names
+    frame = dataframe.loc[:, header_names].dropna(subset=[site]).sort_values(site, kind='stable')
+    normalized = normalize_macs(frame[ap_mac])
+    valid = normalized.notna()
+    frame[ap_mac] = normalized.where(valid, frame[ap_mac].astype(str).str.strip())
+    frame[site] = remove_floor_from_site_names(frame[site])
+    return frame, valid
+
+def report_invalid_macs(invalid:pandas.DataFrame):
+    """ One report of every row of invalid, whose columns are the site, ap name and ap mac. """
+    if len(invalid) == 0:
+        return
+    lines = [f'Found {len(invalid)} invalid AP MACs, these APs are skipped:']
+    for site, ap_name, ap_mac in invalid.itertuples(index=False):
+        lines.append(f'    {site}: {ap_name} {ap_mac}')
+    print('\n'.join(lines))
+
 def create_assign_json(site:Tuple[str, Dict[str, str]], site_name_to_id:Dict[str, str], name_association:Dict[str, str] = None) -> Dict:
     """
         param: site is a dictionary of name to a list of dictionaries with ap macs as keys and ap names as values.
@@ -100,23 +126,18 @@ def create_assign_json(site:Tuple[str, Dict[str, str]], site_name_to_id:Dict[str
 
     return assign_json
 
-def remove_invalid_macs(macs:List[str], delimiter:str = '') -> List[str]:
-    base_match_string = '^[a-fA-F0-9]{2}' + f'({delimiter}[a-fA-F0-9]'
-    match_string = base_match_string + '{2}){5}$'
-    mac_pattern = re.compile(r''+match_string)
-    valid_macs = []
-    for mac in macs:
-        if mac_pattern.match(mac):
-            valid_macs.append(mac)
-    return valid_macs
-
-def is_valid_mac(mac:str, delimiter:str = '') -> bool:
-    mac_regex = '^[a-fA-F0-9]{2}' + f'({delimiter}[a-fA-F0-9]' + '{2}){5}$'
-    mac_pattern = re.compile(r''+mac_regex)
-    if mac_pattern.match(mac):
-        return True
-    else:
-        return False 
+@functools.lru_cache(maxsize=None)
+def mac_pattern(delimiter:str = '') -> re.Pattern:
+    return re.compile(r'^[a-fA-F0-9]{2}' + f'({re.escape(delimiter)}[a-fA-F0-9]' + '{2}){5}$')
+
+def remove_invalid_macs(macs:List[str], delimiter:str = None) -> List[str]:
+    """ Without a delimiter MACs in any format mac.parse_mac reads are valid, with one only MACs delimited by it. """
+    return [mac for mac in macs if is_valid_mac(mac, delimiter)]
+
+def is_valid_mac(mac:str, delimiter:str = None) -> bool:
+    if delimiter is None:
+        return try_parse_mac(mac) is not None
+    return mac_pattern(delimiter).match(mac) is not None
 
 def create_assigned_aps_txt(assign_jsons:List[Dict]):
     for assign_json in assign_jsons:
@@ -128,20 +149,14 @@ def create_assigned_aps_txt(assign_jsons:List[Dict]):
             assigned_aps_f.writelines(lines)
 
 def create_site_to_mac_dict(values:pandas.DataFrame) -> Dict:
-    site_mac_name = {} 
-    for name, group in values:
-        try:
-            name_wo_floor = remove_floor_from_site_name(name)
-        except ValueError:
-            name_wo_floor = name
-        if name_wo_floor not in site_mac_name:
-            site_mac_name[name_wo_floor] = {}
-        for item in group.values:
-            _, ap_name, ap_mac = item
-            if is_valid_mac(ap_mac):
-                site_mac_name[name_wo_floor][ap_mac.lower()] = ap_name
-            else:
-                print('Found invalid mac for ap {}'.format(ap_name))
+    """ values is the site, ap name and ap mac columns of the installer sheet, or a groupby of them on the site column. """
+    dataframe = getattr(values, 'obj', values)
+    frame, valid = split_site_mac_frame(dataframe, list(dataframe.columns[:3]))
+    site, ap_name, ap_mac = frame.columns
+    report_invalid_macs(frame[~valid])
+    site_mac_name = {name_wo_floor:{} for name_wo_floor in frame[site].unique()}
+    for name_wo_floor, group in frame[valid].groupby(site, sort=False):
+        site_mac_name[name_wo_floor] = dict(zip(group[ap_mac], group[ap_name]))
     return site_mac_name
 
 def convert_site_mac_dict_to_tuples(site_mac_name:Dict) -> Tuple:
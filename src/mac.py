@@ -0,0 +1,56 @@
+import numbers
+import pandas
+import re
+
+# bare (aabbccddeeff), colon or dash (aa:bb:cc:dd:ee:ff, aa-bb-cc-dd-ee-ff) and dotted Cisco (aabb.ccdd.eeff), any case
+MAC_PATTERN = re.compile(r'^(?:[0-9a-f]{12}|[0-9a-f]{2}([:-])[0-9a-f]{2}(?:\1[0-9a-f]{2}){4}|[0-9a-f]{4}\.[0-9a-f]{4}\.[0-9a-f]{4})$', re.IGNORECASE)
+DELIMITERS = str.maketrans('', '', ':-.')
+
+def parse_mac(mac:str) -> int:
+    """ The 48 bit integer of a MAC in any of the formats of MAC_PATTERN. Surrounding blanks are ignored. """
+    if not isinstance(mac, str):
+        raise ValueError(f'{mac!r} is not a MAC address.')
+    mac = mac.strip()
+    if not MAC_PATTERN.match(mac):
+        raise ValueError(f'{mac!r} is not a MAC address.')
+    return int(mac.translate(DELIMITERS), 16)
+
+def try_parse_mac(mac:str) -> int:
+    """ parse_mac, or None when mac is not a MAC. """
+    try:
+        return parse_mac(mac)
+    except ValueError:
+        return None
+
+def sheet_mac_text(value) -> str:
+    """
+    The text of a cell read by pandas, which reads MACs made only of digits as numbers and drops their
+    leading zeros. A blank cell in the column makes those numbers floats. None when the cell holds neither.
+    """
+    if isinstance(value, str):
+        return value.strip()
+    if isinstance(value, numbers.Real) and not isinstance(value, bool) and value == value and float(value).is_integer() and 0 <= value < 10 ** 12:
+        return str(int(value)).zfill(12)
+    return None
+
+def parse_sheet_mac(value) -> int:
+    """ try_parse_mac of a cell read by pandas. """
+    return try_parse_mac(sheet_mac_text(value))
+
+def format_mac(mac:int, delimiter:str = '') -> str:
+    """ mac in lowercase, the format the Mist API uses. With ':' or '-' the bytes are delimited, with '.' it is the dotted Cisco format. """
+    digits = f'{mac:012x}'
+    if delimiter == '':
+        return digits
+    width = 4 if delimiter == '.' else 2
+    return delimiter.join(digits[start:start + width] for start in range(0, 12, width))
+
+def normalize_mac(mac:str) -> str:
+    return format_mac(parse_mac(mac))
+
+def normalize_macs(macs:pandas.Series) -> pandas.Series:
+    """ normalize_mac of every MAC of macs at once, missing where the value is not a MAC. Cells are read like parse_sheet_mac reads them. """
+    stripped = macs.map(sheet_mac_text).fillna('').astype(str)
+    valid = stripped.str.match(MAC_PATTERN.pattern, flags=re.IGNORECASE)
+    normalized = stripped.str.lower().str.replace(r'[:.\-]', '', regex=True)
+    return normalized.where(valid, None)
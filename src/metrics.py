@@ -0,0 +1,127 @@
+from typing import Dict, List
+import threading
+import bisect
+import json
+import os
+
+# upper bounds in seconds of the latency histogram buckets, roughly 1.5x apart from 1ms to 60s
+LATENCY_BUCKETS:List[float] = [
+    0.001, 0.0015, 0.0025, 0.004, 0.006, 0.01, 0.015, 0.025, 0.04, 0.06, 0.1, 0.15, 0.25, 0.4, 0.6,
+    1.0, 1.5, 2.5, 4.0, 6.0, 10.0, 15.0, 25.0, 40.0, 60.0
+]
+
+class APIMetrics:
+    """
+    Call counters and latency histograms of one run, kept per logical endpoint name (site_devices,
+    device_config, ...) rather than per URL. Percentiles are read from the histogram, so they are
+    exact to the bucket they fall in. Time a request spent waiting for the rate limiter or a 429's
+    Retry-After is kept apart in wait_seconds and is not part of its latency.
+    """
+
+    def __init__(self, buckets:List[float] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.endpoints = {}
+        self._lock = threading.Lock()
+
+    def observe(self, api_endpoint:str, seconds:float, error:bool = False, bytes_in:int = 0, bytes_out:int = 0, wait_seconds:float = 0.0):
+        with self._lock:
+            endpoint = self.endpoints.get(api_endpoint)
+            if endpoint is None:
+                endpoint = {'count':0, 'errors':0, 'bytes_in':0, 'bytes_out':0, 'seconds':0.0, 'wait_seconds':0.0, 'buckets':[0] * (len(self.buckets) + 1)}
+                self.endpoints[api_endpoint] = endpoint
+            endpoint['count'] += 1
+            endpoint['errors'] += 1 if error else 0
+            endpoint['bytes_in'] += bytes_in
+            endpoint['bytes_out'] += bytes_out
+            endpoint['seconds'] += seconds
+            endpoint['wait_seconds'] += wait_seconds
+            endpoint['buckets'][bisect.bisect_left(self.buckets, seconds)] += 1
+
+    def percentile(self, api_endpoint:str, quantile:float) -> float:
+        """ Latency below which quantile of the endpoint's calls fell, interpolated inside its bucket. """
+        with self._lock:
+            endpoint = self.endpoints.get(api_endpoint)
+            if endpoint is None or endpoint['count'] == 0:
+                return None
+            rank = quantile * endpoint['count']
+            seen = 0
+            for index, bucket_count in enumerate(endpoint['buckets']):
+                if bucket_count and seen + bucket_count >= rank:
+                    lower = self.buckets[index - 1] if index > 0 else 0.0
+                    upper = self.buckets[index] if index < len(self.buckets) else self.buckets[-1]
+                    return lower + (upper - lower) * (rank - seen) / bucket_count
+                seen += bucket_count
+            return self.buckets[-1]
+
+    def to_json(self) -> Dict[str, Dict]:
+        """
+        {
+            endpoint : {
+                "count" : int, "errors" : int, "bytes_in" : int, "bytes_out" : int, "total_seconds" : float,
+                "wait_seconds" : float, "p50" : float, "p95" : float, "p99" : float
+            },
+            ...
+        }
+        """
+        summary = {}
+        # pool threads may still be adding endpoints, so the counters are copied under the lock first
+        for api_endpoint, endpoint in self._snapshot().items():
+            summary[api_endpoint] = {
+                'count' : endpoint['count'],
+                'errors' : endpoint['errors'],
+                'bytes_in' : endpoint['bytes_in'],
+                'bytes_out' : endpoint['bytes_out'],
+                'total_seconds' : endpoint['seconds'],
+                'wait_seconds' : endpoint['wait_seconds'],
+                'p50' : self.percentile(api_endpoint, 0.50),
+                'p95' : self.percentile(api_endpoint, 0.95),
+                'p99' : self.percentile(api_endpoint, 0.99)
+            }
+        return summary
+
+    def to_prometheus(self) -> str:
+        """ The metrics in the Prometheus text exposition format, for the node_exporter textfile collector. """
+        lines = []
+        counters = [
+            ('mist_api_requests_total', 'Requests sent to the Mist API.', 'count'),
+            ('mist_api_request_errors_total', 'Requests that failed or returned an error status.', 'errors'),
+            ('mist_api_response_bytes_total', 'Bytes of response bodies received.', 'bytes_in'),
+            ('mist_api_request_bytes_total', 'Bytes of request bodies sent.', 'bytes_out'),
+            ('mist_api_request_wait_seconds_total', 'Seconds requests waited for the rate limiter or a Retry-After before being sent.', 'wait_seconds')
+        ]
+        endpoints = self._snapshot()
+        for name, help_text, key in counters:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} counter')
+            for api_endpoint, endpoint in endpoints.items():
+                lines.append(f'{name}{{endpoint="{api_endpoint}"}} {endpoint[key]}')
+        name = 'mist_api_request_duration_seconds'
+        lines.append(f'# HELP {name} Seconds from sending a request to reading its response.')
+        lines.append(f'# TYPE {name} histogram')
+        for api_endpoint, endpoint in endpoints.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, endpoint['buckets']):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{{endpoint="{api_endpoint}",le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{endpoint="{api_endpoint}",le="+Inf"}} {endpoint["count"]}')
+            lines.append(f'{name}_sum{{endpoint="{api_endpoint}"}} {endpoint["seconds"]}')
+            lines.append(f'{name}_count{{endpoint="{api_endpoint}"}} {endpoint["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def _snapshot(self) -> Dict[str, Dict]:
+        """ A copy of every endpoint's counters, sorted by endpoint, taken while observe() cannot change them. """
+        with self._lock:
+            return {api_endpoint:dict(self.endpoints[api_endpoint], buckets=list(self.endpoints[api_endpoint]['buckets'])) for api_endpoint in sorted(self.endpoints)}
+
+    def save_json(self, metrics_file:str):
+        self._write(metrics_file, json.dumps(self.to_json(), indent=2))
+
+    def save_prometheus(self, textfile:str):
+        self._write(textfile, self.to_prometheus())
+
+    def _write(self, path:str, contents:str):
+        # the textfile collector may read at any moment, so the file is swapped in whole
+        temp_file = f'{path}.tmp'
+        with open(temp_file, 'w') as f:
+            f.write(contents)
+        os.replace(temp_file, path)
@@ -0,0 +1,307 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from api import MistAPIHandler
+from typing import Dict, List, Tuple
+import argparse
+import threading
+import random
+import json
+import time
+import uuid
+import re
+
+class SyntheticOrg:
+    """
+    In memory org served by MistStubServer. Every AP is in the org inventory, the first
+    aps_per_site * site_count of them are assigned to a site and the rest are unassigned.
+
+    {
+        "sites" : [{"id" : str, "name" : str}, ...],
+        "devices" : {mac : {"mac" : str, "id" : str, "site_id" : str || None, "name" : str, "model" : str, "type" : "ap"}, ...},
+        "device_profiles" : [{"id" : str, "name" : str, "type" : "ap"}, ...]
+    }
+    """
+
+    def __init__(self, org_name:str = 'Stub Org', site_count:int = 10, aps_per_site:int = 50, unassigned_aps:int = 0, seed:int = 0, first_mac:int = 0):
+        self.org_name = org_name
+        self.random = random.Random(seed)
+        self.org_id = self._make_id()
+        self.sites = [{'id':self._make_id(), 'name':f'site{num}'} for num in range(site_count)]
+        self.devices = {}
+        for num in range(site_count * aps_per_site + unassigned_aps):
+            mac = f'{first_mac + num:012x}'
+            site_id = self.sites[num // aps_per_site]['id'] if num < site_count * aps_per_site else None
+            self.devices[mac] = {
+                'mac' : mac,
+                'id' : f'00000000-0000-0000-1000-{mac}',
+                'site_id' : site_id,
+                'name' : mac,
+                'model' : 'AP43',
+                'type' : 'ap'
+            }
+        self.device_profiles = [{'id':self._make_id(), 'name':'default', 'type':'ap'}]
+        self.lock = threading.Lock()
+
+    def site_devices(self, site_id:str) -> List[Dict]:
+        return [device for device in self.devices.values() if device['site_id'] == site_id]
+
+    def _make_id(self) -> str:
+        return str(uuid.UUID(int=self.random.getrandbits(128), version=4))
+
+def make_latency(spec) -> callable:
+    """
+    Returns a function that draws one response delay in seconds from spec, which is either a number of
+    seconds or one of
+        {"distribution" : "uniform", "low" : float, "high" : float}
+        {"distribution" : "normal", "mean" : float, "stddev" : float}
+        {"distribution" : "lognormal", "median" : float, "sigma" : float}
+    """
+    if spec is None:
+        spec = 0.0
+    if isinstance(spec, (int, float)):
+        return lambda rng: float(spec)
+    distribution = spec.get('distribution')
+    if distribution == 'uniform':
+        return lambda rng: rng.uniform(spec['low'], spec['high'])
+    if distribution == 'normal':
+        return lambda rng: max(0.0, rng.gauss(spec['mean'], spec['stddev']))
+    if distribution == 'lognormal':
+        return lambda rng: spec['median'] * rng.lognormvariate(0.0, spec['sigma'])
+    raise ValueError(f'Unknown latency distribution: {distribution}')
+
+class MistStubRequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # headers and body go out in separate writes, without this every keep-alive response waits for a delayed ACK
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self._handle()
+
+    def do_POST(self):
+        self._handle()
+
+    def do_PUT(self):
+        self._handle()
+
+    def do_DELETE(self):
+        self._handle()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _handle(self):
+        stub = self.server.stub
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length > 0 else b''
+        path, _, query = self.path.partition('?')
+        params = dict(param.split('=', 1) for param in query.split('&') if '=' in param)
+        api_endpoint, api_params = stub.route(path[len(stub.path_prefix):])
+        stub.count_request(api_endpoint)
+        time.sleep(stub.draw_latency(api_endpoint))
+        injected = stub.draw_injected_status()
+        if injected == 429:
+            self._send_json(429, {}, {'Retry-After':str(stub.retry_after)})
+            return
+        if injected is not None:
+            self._send_json(injected, {})
+            return
+        if api_endpoint is None:
+            self._send_json(404, {'detail':'not found'})
+            return
+        status, response = stub.respond(self.command, api_endpoint, api_params, body)
+        headers = {}
+        if isinstance(response, list) and 'limit' in params:
+            limit = int(params['limit'])
+            start = (int(params.get('page', 1)) - 1) * limit
+            headers['X-Page-Total'] = str(len(response))
+            response = response[start:start + limit]
+        self._send_json(status, response, headers, set_session=api_endpoint == 'login')
+
+    def _send_json(self, status:int, response, headers:Dict[str,str] = {}, set_session:bool = False):
+        data = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for header in headers:
+            self.send_header(header, headers[header])
+        if set_session:
+            self.send_header('Set-Cookie', 'csrftoken=stub-csrftoken; Path=/')
+            self.send_header('Set-Cookie', 'sessionid=stub-session; Path=/')
+        self.end_headers()
+        self.wfile.write(data)
+
+class MistStubServer:
+    """
+    Local HTTP stand-in for the Mist API that serves a SyntheticOrg on the paths in
+    MistAPIHandler.api_endpoints. Point a handler at it with base_url=server.base_url to run the real
+    request path end to end offline. Every response is delayed by a draw from latency (or the
+    endpoint's entry in endpoint_latency), throttle_rate of the requests are answered with 429 and
+    error_rate of them with one of error_statuses.
+    """
+
+    def __init__(self, org:SyntheticOrg = None, latency = 0.0, endpoint_latency:Dict = None, throttle_rate:float = 0.0, retry_after:int = 0,
+                 error_rate:float = 0.0, error_statuses:Tuple[int] = (503,), seed:int = None, host:str = '127.0.0.1', port:int = 0):
+        self.org = org if org is not None else SyntheticOrg()
+        self.latency = make_latency(latency)
+        self.endpoint_latency = {endpoint:make_latency(spec) for endpoint, spec in (endpoint_latency or {}).items()}
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.error_rate = error_rate
+        self.error_statuses = error_statuses
+        self.path_prefix = '/api/v1/'
+        self.request_counts = {}
+        self.routes = self._make_routes()
+        self._random = random.Random(seed)
+        self._throttle_next = 0
+        self._fail_next = 0
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), MistStubRequestHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.stub = self
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f'http://{host}:{port}{self.path_prefix}'
+
+    def start(self) -> str:
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self.base_url
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def serve_forever(self):
+        self._httpd.serve_forever()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def throttle_next(self, count:int):
+        """ Answer the next count requests with 429, on top of throttle_rate. """
+        with self._lock:
+            self._throttle_next += count
+
+    def fail_next(self, count:int):
+        """ Answer the next count requests with the first of error_statuses, on top of error_rate. """
+        with self._lock:
+            self._fail_next += count
+
+    def count_request(self, api_endpoint:str):
+        with self._lock:
+            self.request_counts[api_endpoint] = self.request_counts.get(api_endpoint, 0) + 1
+
+    def draw_latency(self, api_endpoint:str) -> float:
+        latency = self.endpoint_latency.get(api_endpoint, self.latency)
+        with self._lock:
+            return latency(self._random)
+
+    def draw_injected_status(self) -> int:
+        with self._lock:
+            if self._throttle_next > 0:
+                self._throttle_next -= 1
+                return 429
+            if self._fail_next > 0:
+                self._fail_next -= 1
+                return self.error_statuses[0]
+            draw = self._random.random()
+            if draw < self.throttle_rate:
+                return 429
+            if draw < self.throttle_rate + self.error_rate:
+                return self._random.choice(self.error_statuses)
+            return None
+
+    def route(self, path:str) -> Tuple[str, List[str]]:
+        """ Returns the api_endpoints name and path parameters of a request path, or (None, []). """
+        for api_endpoint, pattern in self.routes:
+            match = pattern.fullmatch(path)
+            if match is not None:
+                return api_endpoint, list(match.groups())
+        return None, []
+
+    def respond(self, action:str, api_endpoint:str, api_params:List[str], body:bytes) -> Tuple[int, object]:
+        org = self.org
+        with org.lock:
+            if api_endpoint == 'login' and action == 'POST':
+                return 200, {'email':'stub@example.com'}
+            if api_endpoint == 'check_login' and action == 'GET':
+                return 200, {'privileges':[{'scope':'org', 'name':org.org_name, 'org_id':org.org_id, 'role':'admin'}]}
+            if api_endpoint == 'sites' and action == 'GET':
+                return 200, [dict(site) for site in org.sites]
+            if api_endpoint == 'sites' and action == 'POST':
+                site = dict(json.loads(body), id=org._make_id())
+                org.sites.append(site)
+                return 200, site
+            if api_endpoint == 'site_devices' and action == 'GET':
+                return 200, [dict(device) for device in org.site_devices(api_params[0])]
+            if api_endpoint == 'device_config' and action in ('GET', 'PUT'):
+                devices = [device for device in org.site_devices(api_params[0]) if device['id'] == api_params[1]]
+                if len(devices) == 0:
+                    return 404, {'detail':'device not found'}
+                if action == 'PUT':
+                    devices[0].update(json.loads(body))
+                return 200, dict(devices[0])
+            if api_endpoint == 'inventory' and action == 'GET':
+                return 200, [dict(device) for device in org.devices.values()]
+            if api_endpoint == 'inventory' and action == 'PUT':
+                return 200, self._update_inventory(json.loads(body))
+            if api_endpoint == 'device_profiles' and action == 'GET':
+                return 200, [dict(profile) for profile in org.device_profiles]
+            if api_endpoint == 'assign_to_device_profile' and action == 'POST':
+                macs = json.loads(body)['macs']
+                return 200, {'success':[mac for mac in macs if mac in org.devices]}
+            if api_endpoint in ('import_map', 'org_import_map') and action == 'POST':
+                return 200, {'id':org._make_id()}
+        return 405, {'detail':f'{action} is not supported on {api_endpoint}'}
+
+    def _update_inventory(self, inventory_info:Dict) -> Dict:
+        success = []
+        error = []
+        for mac in inventory_info['macs']:
+            device = self.org.devices.get(mac.lower())
+            if device is None or (inventory_info.get('no_reassign') and device['site_id'] is not None):
+                error.append(mac)
+                continue
+            device['site_id'] = inventory_info.get('site_id') if inventory_info['op'] == 'assign' else None
+            success.append(mac)
+        return {'op':inventory_info['op'], 'success':success, 'error':error, 'reason':['not in inventory'] * len(error)}
+
+    def _make_routes(self) -> List[Tuple[str, re.Pattern]]:
+        routes = []
+        for api_endpoint, api_path in MistAPIHandler.api_endpoints.items():
+            api_path = api_path.partition('?')[0]
+            pattern = re.escape(api_path).replace(re.escape('{}'), '([^/]+)')
+            routes.append((api_endpoint, re.compile(pattern)))
+        return routes
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a synthetic Mist org on a local port.')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--org-name', default='Stub Org')
+    parser.add_argument('--sites', type=int, default=10)
+    parser.add_argument('--aps-per-site', type=int, default=50)
+    parser.add_argument('--unassigned-aps', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='share of requests answered with 429')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered with 503')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    org = SyntheticOrg(args.org_name, args.sites, args.aps_per_site, args.unassigned_aps, args.seed)
+    server = MistStubServer(org, args.latency, throttle_rate=args.throttle_rate, error_rate=args.error_rate, seed=args.seed, port=args.port)
+    print(f'serving {args.org_name} at {server.base_url}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
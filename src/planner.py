@@ -0,0 +1,205 @@
+from api import MistAPIHandler, ResponseCache
+from device_index import DeviceIndex
+from tasks import TaskManager
+from typing import Dict, List
+import contextlib
+import functools
+import threading
+import math
+import io
+
+class DryRunAPIHandler(MistAPIHandler):
+    """
+    MistAPIHandler that never sends a request. Reads are answered from the org state saved by earlier
+    runs: the response cache_file and the device index file. Writes return the response Mist would
+    send back. Every request a real run would make is counted per endpoint instead, reads that the
+    response cache would still serve are not counted. Without a saved device index the workbook APs
+    can be taken as the org's devices with assume_workbook_devices.
+    """
+
+    # seconds per request assumed for endpoints without a measured latency
+    default_latency = 0.5
+
+    def __init__(self, login_method:str, login_params:Dict[str,str], device_index_file:str = None, **handler_options) -> None:
+        self.planned_calls = {}
+        self._planned_lock = threading.Lock()
+        self.device_index_file = device_index_file
+        self.saved_index_found = False
+        self._saved_index = None
+        super().__init__(login_method, login_params, **handler_options)
+        # same entries as the cache, but none of them expire
+        self.saved_state = ResponseCache(self.cache.ttls, self.cache.cache_file, self.cache.namespace, clock=lambda: 0.0)
+
+    def _login_usr_pw(self, login_params:Dict[str,str]) -> bool:
+        self._count_call('login')
+        return True
+
+    def _resume_session(self, login_params:Dict[str,str]) -> bool:
+        # a real run might reuse a saved session, but planning for the login keeps the estimate on the safe side
+        return False
+
+    def _save_session(self, login_params:Dict[str,str]):
+        pass
+
+    def take_planned_calls(self) -> Dict[str,int]:
+        """ Returns the calls counted since the last take and starts counting again. """
+        with self._planned_lock:
+            planned_calls = self.planned_calls
+            self.planned_calls = {}
+        return planned_calls
+
+    def get_latency(self, api_endpoint:str) -> float:
+        return self.get_latency_stats().get(api_endpoint, self.default_latency)
+
+    def _action_api_endpoint(self, api_endpoint:str, api_params:list[str], call_body:Dict[str,str]={}, action:str='get', multi:bool=False, custom_headers:Dict={}) -> Dict[str,str]:
+        full_api_path = self._make_full_api_uri(api_endpoint, api_params)
+        if action == 'get' and not multi:
+            cached, response = self.cache.get(api_endpoint, full_api_path)
+            if cached:
+                return response
+            self._count_call(api_endpoint)
+            saved, response = self.saved_state.get(api_endpoint, full_api_path)
+            if not saved:
+                raise ValueError(f'No saved {api_endpoint} response to plan from. Run once with api.cache_file set and try again.')
+            return response
+        self._count_call(api_endpoint)
+        return self._planned_response(api_endpoint, api_params, call_body)
+
+    def iter_api_endpoint(self, api_endpoint:str, api_params:list[str], page_limit:int=None, prefetch:bool=None):
+        if api_endpoint not in self.list_endpoints:
+            raise ValueError(f'{api_endpoint} is not a list endpoint.')
+        page_limit = page_limit if page_limit is not None else self.page_limit
+        items = self._saved_items(api_endpoint, api_params)
+        self._count_call(api_endpoint, max(1, math.ceil(len(items) / page_limit)))
+        yield from items
+
+    def _saved_items(self, api_endpoint:str, api_params:list[str]) -> List[Dict]:
+        if api_endpoint == 'inventory':
+            return [dict(entry, mac=mac) for mac, entry in self._get_saved_index().devices.items()]
+        if api_endpoint == 'site_devices':
+            return [dict(entry, mac=mac) for mac, entry in self._get_saved_index().devices.items() if entry['site_id'] == api_params[0]]
+        saved, response = self.saved_state.get(api_endpoint, self._make_full_api_uri(api_endpoint, api_params))
+        return response if saved else []
+
+    def _planned_response(self, api_endpoint:str, api_params:list[str], call_body) -> Dict:
+        if api_endpoint == 'inventory' and call_body.get('op') == 'assign':
+            saved_index = self._get_saved_index()
+            known = [mac for mac in call_body['macs'] if saved_index.lookup(mac) is not None]
+            saved_index.assign_to_site(known, call_body['site_id'])
+            return {'success':known, 'error':[mac for mac in call_body['macs'] if mac not in known]}
+        if api_endpoint == 'device_config':
+            device_id = api_params[1]
+            macs = [mac for mac, entry in self._get_saved_index().devices.items() if entry['id'] == device_id]
+            return dict(call_body, id=device_id, mac=macs[0] if macs else None)
+        return dict(call_body) if isinstance(call_body, dict) else {}
+
+    def assume_workbook_devices(self, site_macs:Dict[str, List[str]]):
+        """ Take every AP of site_macs (site_id -> MACs) to be in its site and not named yet, so every assign and name push is planned. """
+        saved_index = self._get_saved_index()
+        for site_id, macs in site_macs.items():
+            for mac in macs:
+                saved_index.devices.setdefault(mac.lower(), {'site_id':site_id, 'id':f'planned-{mac.lower()}', 'name':None})
+
+    def _get_saved_index(self) -> DeviceIndex:
+        if self._saved_index is None:
+            saved_index = DeviceIndex.load(self.device_index_file, self.org_id) if self.device_index_file else None
+            self.saved_index_found = saved_index is not None
+            self._saved_index = saved_index if saved_index is not None else DeviceIndex(self.org_id)
+        return self._saved_index
+
+    def _count_call(self, api_endpoint:str, calls:int = 1):
+        with self._planned_lock:
+            self.planned_calls[api_endpoint] = self.planned_calls.get(api_endpoint, 0) + calls
+
+class DryRunPlanner:
+    """
+    Builds the execution plan of a run without sending any write request. The tasks run against a
+    DryRunAPIHandler and the calls they make are timed with the latencies measured by earlier runs,
+    the task concurrency and the request rate limit.
+
+    {
+        "setup" : {"calls" : {endpoint : int, ...}, "seconds" : float},
+        "tasks" : [
+            {"task" : str, "calls" : {endpoint : int, ...}, "max_in_flight" : int, "seconds" : float},
+            ...
+        ],
+        "calls" : {endpoint : int, ...},
+        "total_calls" : int,
+        "estimated_seconds" : float,
+        "warnings" : [str, ...]
+    }
+    """
+
+    def __init__(self, config:Dict):
+        self.config = config
+
+    def plan(self) -> Dict:
+        handler_class = functools.partial(DryRunAPIHandler, device_index_file=self.config['sites'].get('device_index_file'))
+        task_manager = TaskManager(config=self.config, handler=handler_class, dry_run=True)
+        handler = task_manager.handler
+        if handler is None:
+            return {'setup':{'calls':{}, 'seconds':0.0}, 'tasks':[], 'calls':{}, 'total_calls':0, 'estimated_seconds':0.0, 'warnings':[]}
+        setup_calls = handler.take_planned_calls()
+        plan = {'setup':{'calls':setup_calls, 'seconds':self._latency_bound(handler, setup_calls, 1)}, 'tasks':[], 'warnings':[]}
+        handler._get_saved_index()
+        if not handler.saved_index_found and set(task_manager.tasks) & {'assign ap', 'name ap', 'assign aps to device profile'}:
+            # without saved device state every workbook AP is planned as a push, nothing is known to be done already
+            plan['warnings'].append('No saved device index to plan from (set sites.device_index_file and run once). Every AP of the workbook is planned as assigned and renamed, and the inventory pull is counted as one page.')
+            handler.assume_workbook_devices(self._workbook_site_macs(task_manager))
+        task_manager.create_tasks()
+        task_manager.execute_queue.sort(key=lambda o: o.order)
+        for task in task_manager.execute_queue:
+            if not hasattr(task, 'handler'):
+                continue
+            with contextlib.redirect_stdout(io.StringIO()):
+                result = task.perform_task()
+            task_calls = handler.take_planned_calls()
+            max_in_flight = getattr(task, 'max_in_flight', 1)
+            plan['tasks'].append({
+                'task' : result['task'],
+                'calls' : task_calls,
+                'max_in_flight' : max_in_flight,
+                'seconds' : self._latency_bound(handler, task_calls, max_in_flight)
+            })
+        calls = dict(setup_calls)
+        for task_plan in plan['tasks']:
+            for api_endpoint, count in task_plan['calls'].items():
+                calls[api_endpoint] = calls.get(api_endpoint, 0) + count
+        plan['calls'] = calls
+        plan['total_calls'] = sum(calls.values())
+        latency_bound = plan['setup']['seconds'] + sum(task_plan['seconds'] for task_plan in plan['tasks'])
+        plan['estimated_seconds'] = max(latency_bound, self._rate_bound(handler, plan['total_calls']))
+        return plan
+
+    def _workbook_site_macs(self, task_manager:TaskManager) -> Dict[str, List[str]]:
+        site_macs = {}
+        name_association = task_manager.data_structures.get('name_association', {})
+        for data_structure in ('site_to_mac', 'site_mac_name'):
+            for site, macs in task_manager.data_structures.get(data_structure, {}).items():
+                site_id = task_manager.site_name_to_id.get(name_association.get(site))
+                if site_id is not None:
+                    site_macs.setdefault(site_id, []).extend(macs)
+        return site_macs
+
+    def _latency_bound(self, handler:DryRunAPIHandler, calls:Dict[str,int], max_in_flight:int) -> float:
+        """ Seconds the calls take back to back, spread over max_in_flight workers. """
+        seconds = sum(count * handler.get_latency(api_endpoint) for api_endpoint, count in calls.items())
+        return seconds / max(1, max_in_flight)
+
+    def _rate_bound(self, handler:DryRunAPIHandler, total_calls:int) -> float:
+        """ Least seconds the scheduler's token bucket needs to let total_calls through. """
+        scheduler = handler.scheduler
+        return max(0.0, (total_calls - scheduler.burst) / scheduler.rate)
+
+def format_plan(plan:Dict) -> str:
+    lines = ['dry run plan:']
+    for warning in plan.get('warnings', []):
+        lines.append(f'  WARNING: {warning}')
+    lines.append(f"  setup: {sum(plan['setup']['calls'].values())} calls, {plan['setup']['seconds']:.1f} seconds")
+    for task_plan in plan['tasks']:
+        lines.append(f"  {task_plan['task']}: {sum(task_plan['calls'].values())} calls with {task_plan['max_in_flight']} in flight, {task_plan['seconds']:.1f} seconds")
+    lines.append('  calls per endpoint:')
+    for api_endpoint, count in sorted(plan['calls'].items()):
+        lines.append(f'    {api_endpoint}: {count}')
+    lines.append(f"  total: {plan['total_calls']} calls, estimated {plan['estimated_seconds']:.1f} seconds")
+    return '\n'.join(lines)
@@ -0,0 +1,68 @@
+from typing import Dict
+import json
+import os
+try:
+    from cryptography.fernet import Fernet, InvalidToken
+except ImportError:
+    Fernet = None
+
+class SessionStore:
+    """
+    Keeps the session cookies of a logged in handler encrypted on disk so the next run can reuse them
+    instead of logging in (and answering a two factor prompt) again. The Fernet key comes from the
+    MIST_SESSION_KEY environment variable and is never written to disk. Needs the optional cryptography
+    package and the key, without either nothing is saved and every run logs in.
+
+    {
+        "username" : str,
+        "base_url" : str,
+        "cookies" : {"sessionid" : str, "csrftoken" : str}
+    }
+    """
+
+    key_variable = 'MIST_SESSION_KEY'
+
+    def __init__(self, session_file:str):
+        self.session_file = session_file
+        self.fernet = None
+        if Fernet is None:
+            print('Install the cryptography package to keep login sessions between runs.')
+            return
+        key = os.getenv(self.key_variable)
+        if key is None:
+            print(f'Set {self.key_variable} to a Fernet key to keep login sessions between runs.')
+            return
+        try:
+            self.fernet = Fernet(key)
+        except ValueError:
+            print(f'{self.key_variable} is not a Fernet key, login sessions are not kept between runs.')
+
+    @property
+    def enabled(self) -> bool:
+        return self.fernet is not None
+
+    def load(self) -> Dict:
+        """ Returns the saved session, or None if there is none or it cannot be decrypted with the current key. """
+        if not self.enabled or not os.path.exists(self.session_file):
+            return None
+        try:
+            with open(self.session_file, 'rb') as f:
+                return json.loads(self.fernet.decrypt(f.read()))
+        except (OSError, ValueError, InvalidToken):
+            return None
+
+    def save(self, session:Dict):
+        if not self.enabled:
+            return
+        temp_file = f'{self.session_file}.tmp'
+        self._write_private(temp_file, self.fernet.encrypt(json.dumps(session).encode('utf-8')))
+        os.replace(temp_file, self.session_file)
+
+    def clear(self):
+        if os.path.exists(self.session_file):
+            os.remove(self.session_file)
+
+    def _write_private(self, path:str, data:bytes):
+        file_descriptor = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(file_descriptor, 'wb') as f:
+            f.write(data)
@@ -1,10 +1,16 @@
 import inventory_devices
+import threading
+import asyncio
+import time
 import re
 import pandas
 import os
 import sys
 from api import MistAPIHandler
-from file_ops import EkahauWriter, ExcelReader, ConfigReader, ExcelWriter
+from async_api import AsyncMistAPIHandler
+from device_index import DeviceIndex
+from file_ops import EkahauWriter, ExcelReader, ExcelWriter
+from mac import parse_sheet_mac, try_parse_mac
 from typing import List, Tuple, Dict
 
 #suppress warnings from writing to ekahau file
@@ -12,9 +18,6 @@ if not sys.warnoptions:
     import warnings
     warnings.simplefilter('ignore')
 
-config_reader = ConfigReader('config.yml')
-config = config_reader.extract_information_from_file()
-
 class NameAssoc:
 
     config_sites:Dict
@@ -51,47 +54,29 @@ class SiteMacName:
 
     def __init__(self, config:Dict):
         self.config_sites = config['sites']
-        self.excel_reader = ExcelReader(self.config_sites['ap_excel_file'])
+        self.excel_reader = ExcelReader(self.config_sites['ap_excel_file'], self.config_sites.get('excel_reader', 'pandas') == 'stream', self.config_sites.get('workbook_cache', False))
 
     def get_data_structure(self) -> Dict:
         headers = []
         header_items = ['site_name', 'ap_name', 'ap_mac']
         for item in header_items:
             headers.append(self.config_sites['header_column_names'][item].replace('\\n', '\n'))
-        values = self.excel_reader.extract_table_from_file(headers, dropset=[self.config_sites['dropna_header'].replace('\\n', '\n')], groupby=self.config_sites['groupby'].replace('\\n', '\n'), worksheet=self.config_sites['sheet_name'])
-        self.site_mac_name = {} 
-        for name, group in values:
-            try:
-                name_wo_floor = self._remove_floor_from_site_name(name)
-            except ValueError:
-                name_wo_floor = name
-            if name_wo_floor not in self.site_mac_name:
-                self.site_mac_name[name_wo_floor] = {}
-            for item in group.values:
-                _, ap_name, ap_mac = item
-                if self.is_valid_mac(ap_mac):
-                    self.site_mac_name[name_wo_floor][ap_mac.lower()] = ap_name
-                else:
-                    print('Found invalid mac for ap {}: {}'.format(ap_name, ap_mac))
+        # APs are grouped into sites by the groupby column, the site name column unless configured otherwise
+        headers[0] = self.config_sites.get('groupby', headers[0]).replace('\\n', '\n')
+        dataframe = self.excel_reader.extract_table_from_file(headers, dropset=[self.config_sites['dropna_header'].replace('\\n', '\n')], worksheet=self.config_sites['sheet_name'])
+        frame, valid = inventory_devices.split_site_mac_frame(dataframe, headers)
+        site, ap_name, ap_mac = headers
+        inventory_devices.report_invalid_macs(frame[~valid])
+        self.site_mac_name = {name_wo_floor:{} for name_wo_floor in frame[site].unique()}
+        for name_wo_floor, group in frame[valid].groupby(site, sort=False):
+            self.site_mac_name[name_wo_floor] = dict(zip(group[ap_mac], group[ap_name]))
         return self.site_mac_name
-    
+
     def _remove_floor_from_site_name(self, site:str) -> str:
-        site_formats = ['Flr-\d+$', '\d(st|nd|rd|th) Flr']
-        for site_format in site_formats:
-            floor = re.compile(r''+site_format)
-            floor_match = floor.search(site)
-            if floor_match:
-                start = floor_match.start()
-                return site[:start-1]
-        raise ValueError('Site does not conform to SITE Flr-xx format.')
-
-    def is_valid_mac(self, mac:str, delimiter:str = '') -> bool:
-        mac_regex = '^[a-fA-F0-9]{2}' + f'({delimiter}[a-fA-F0-9]' + '{2}){5}$'
-        mac_pattern = re.compile(r''+mac_regex)
-        if mac_pattern.match(mac):
-            return True
-        else:
-            return False 
+        return inventory_devices.remove_floor_from_site_name(site)
+
+    def is_valid_mac(self, mac:str, delimiter:str = None) -> bool:
+        return inventory_devices.is_valid_mac(mac, delimiter)
 
     def __str__(self):
         return 'site_mac_name'
@@ -103,134 +88,188 @@ class SiteMac:
 
     def __init__(self, config:Dict):
         self.config_sites = config['sites']
-        self.reader = ExcelReader(self.config_sites['ap_excel_file'])
+        self.reader = ExcelReader(self.config_sites['ap_excel_file'], self.config_sites.get('excel_reader', 'pandas') == 'stream', self.config_sites.get('workbook_cache', False))
 
     def get_data_structure(self) -> Dict:
         headers = []
         header_items = ['site_name', 'ap_name', 'ap_mac']
         for item in header_items:
             headers.append(self.config_sites['header_column_names'][item].replace('\\n', '\n'))
-        values = self.reader.extract_table_from_file(headers, dropset=[self.config_sites['dropna_header'].replace('\\n', '\n')], groupby=self.config_sites['groupby'].replace('\\n', '\n'), worksheet=self.config_sites['sheet_name'])
-        self.site_to_mac= {} 
-        for name, group in values:
-            try:
-                name_wo_floor = self._remove_floor_from_site_name(name)
-            except ValueError:
-                name_wo_floor = name
-            if name_wo_floor not in self.site_to_mac:
-                self.site_to_mac[name_wo_floor] = [] 
-            for item in group.values:
-                _, _, ap_mac = item
-                if self.is_valid_mac(ap_mac):
-                    self.site_to_mac[name_wo_floor].append(ap_mac)
-                else:
-                    print('Found invalid mac for ap : {}'.format(ap_mac))
+        # APs are grouped into sites by the groupby column, the site name column unless configured otherwise
+        headers[0] = self.config_sites.get('groupby', headers[0]).replace('\\n', '\n')
+        dataframe = self.reader.extract_table_from_file(headers, dropset=[self.config_sites['dropna_header'].replace('\\n', '\n')], worksheet=self.config_sites['sheet_name'])
+        frame, valid = inventory_devices.split_site_mac_frame(dataframe, headers)
+        site, _, ap_mac = headers
+        inventory_devices.report_invalid_macs(frame[~valid])
+        self.site_to_mac = {name_wo_floor:[] for name_wo_floor in frame[site].unique()}
+        # MACs are in one form by now, so a MAC listed twice for a site is assigned once
+        for name_wo_floor, macs in frame[valid].drop_duplicates(subset=[site, ap_mac]).groupby(site, sort=False)[ap_mac]:
+            self.site_to_mac[name_wo_floor] = macs.tolist()
         return self.site_to_mac
 
     def _remove_floor_from_site_name(self, site:str) -> str:
-        site_formats = ['Flr-\d+$', '\d(st|nd|rd|th) Flr']
-        for site_format in site_formats:
-            floor = re.compile(r''+site_format)
-            floor_match = floor.search(site)
-            if floor_match:
-                start = floor_match.start()
-                return site[:start-1]
-        raise ValueError('Site does not conform to SITE Flr-xx format.')
-
-    def is_valid_mac(self, mac:str, delimiter:str = '') -> bool:
-        mac_regex = '^[a-fA-F0-9]{2}' + f'({delimiter}[a-fA-F0-9]' + '{2}){5}$'
-        mac_pattern = re.compile(r''+mac_regex)
-        if mac_pattern.match(mac):
-            return True
-        else:
-            return False 
+        return inventory_devices.remove_floor_from_site_name(site)
+
+    def is_valid_mac(self, mac:str, delimiter:str = None) -> bool:
+        return inventory_devices.is_valid_mac(mac, delimiter)
 
     def __str__(self):
         return 'site_to_mac'
 
+class MacChunks:
+    """
+    Splits the MAC list of a site into request bodies of at most chunk_size MACs. A chunk that fails
+    only reports its own MACs as errors, retrying a failed request is left to the API handler.
+    """
+
+    def __init__(self, chunk_size:int = 100):
+        if chunk_size < 1:
+            raise ValueError('mac_chunk_size must be at least 1.')
+        self.chunk_size = chunk_size
+
+    def split(self, macs:List[str]) -> List[List[str]]:
+        return [macs[start:start + self.chunk_size] for start in range(0, len(macs), self.chunk_size)]
+
 class AssignDeviceProfileTask:
 
-    def __init__(self, site_mac:Dict, deviceprofile_id:str, handler:MistAPIHandler):
+    def __init__(self, site_mac:Dict, deviceprofile_id:str, handler:MistAPIHandler, device_index:DeviceIndex = None, max_in_flight:int = 1, mac_chunks:MacChunks = None):
         self.smn = site_mac
         self.deviceprofile_id = deviceprofile_id
         self.handler = handler
+        self.device_index = device_index
+        self.max_in_flight = max_in_flight
+        self.mac_chunks = mac_chunks if mac_chunks is not None else MacChunks()
         self.order = 1
 
     def perform_task(self):
 
-        assign_jsons = []
+        if self.max_in_flight > 1:
+            return asyncio.run(self._perform_task_async())
         sites = {'task':'assign aps to device profile'}
         for site in self.smn:
-            try:
-                site_macs = self.smn[site]
-                assign_json = {
-                    'op' : 'assign to device profile',
-                    'macs' : site_macs
-                }
-                assign_jsons.append(assign_json)
-            except KeyError:
-                pass
-        
-        for assign_json in assign_jsons:
             sites[site] = {'success':[], 'error':[]}
-            if len(assign_json['macs']) > 0:
+            site_macs = self.smn[site]
+            if len(site_macs) > 0:
                 print('Assigning APs to Device Profile')
-                try:
-                    mac_payload = {'macs':assign_json['macs']}
-                    self.handler.assign_devices_to_device_profile(self.handler.org_id, self.deviceprofile_id, mac_payload)
-                except Exception as e:
-                    print(e)
+                for chunk in self.mac_chunks.split(site_macs):
+                    try:
+                        self._send_chunk(chunk)
+                        sites[site]['success'].extend(chunk)
+                    except Exception as e:
+                        print(e)
+                        sites[site]['error'].extend(chunk)
             else:
                 print('No MACs to assign to device profile')
-                sites[site]['success'] = []
-                sites[site]['error'] = []
         
         return sites
 
+    async def _perform_task_async(self):
+        sites = {'task':'assign aps to device profile'}
+        async with AsyncMistAPIHandler(self.handler, self.max_in_flight) as handler:
+            send = lambda chunk: handler.run(self._send_chunk, chunk)
+            submissions = []
+            for site in self.smn:
+                sites[site] = {'success':[], 'error':[]}
+                for chunk in self.mac_chunks.split(self.smn[site]):
+                    submissions.append((site, chunk, send(chunk)))
+            responses = await asyncio.gather(*[submission for _, _, submission in submissions], return_exceptions=True)
+        for (site, chunk, _), response in zip(submissions, responses):
+            if isinstance(response, Exception):
+                print(response)
+                sites[site]['error'].extend(chunk)
+            else:
+                sites[site]['success'].extend(chunk)
+        return sites
+
+    def _send_chunk(self, chunk:List[str]):
+        return self.handler.assign_devices_to_device_profile(self.handler.org_id, self.deviceprofile_id, {'macs':chunk})
 
 class AssignTask:
 
-    def __init__(self, site_mac:Dict, site_name_to_id:Dict[str, str], name_association:Dict[str,str], handler:MistAPIHandler):
+    def __init__(self, site_mac:Dict, site_name_to_id:Dict[str, str], name_association:Dict[str,str], handler:MistAPIHandler, max_in_flight:int=1, device_index:DeviceIndex = None, mac_chunks:MacChunks = None):
         self.smn = site_mac
         self.sn_id = site_name_to_id
         self.name_assoc = name_association
         self.handler = handler
+        self.max_in_flight = max_in_flight
+        self.device_index = device_index
+        self.mac_chunks = mac_chunks if mac_chunks is not None else MacChunks()
         self.order = 0
 
     def perform_task(self) -> Dict[str, Dict[str, str]]:
         
-        assign_jsons = []
+        assign_jsons = self._create_assign_jsons()
+        if self.max_in_flight > 1:
+            return asyncio.run(self._perform_task_async(assign_jsons))
         sites = {'task':'assign ap'}
-        for site in self.smn:
-            try:    
-                site_id = self.sn_id[self.name_assoc[site]]
-                site_macs = self.smn[site]
-                assign_json = {
-                    'op' : 'assign',
-                    'site_id' : site_id,
-                    'macs' : site_macs,
-                    'no_reassign' : False
-                }
-                assign_jsons.append(assign_json)
-            except KeyError:
-                pass
-         
-        for assign_json,site in zip(assign_jsons, self.smn.keys()):
+        for site, assign_json in assign_jsons:
             sites[site] = {'success':[], 'error':[]}
             if len(assign_json['macs']) > 0:
                 print(f'assigning APs to site: {self.name_assoc[site]}')
-                try:
-                    response = self.handler.assign_inventory_to_site(assign_json)
-                    sites[site]['success'] = response['success']
-                    sites[site]['error'] = response['error']
-                except Exception as e:
-                    print(e)
+                send = lambda chunk: self.handler.assign_inventory_to_site(dict(assign_json, macs=chunk))
+                for chunk in self.mac_chunks.split(assign_json['macs']):
+                    try:
+                        response = send(chunk)
+                        self._record_assignment(assign_json['site_id'], response, sites[site])
+                    except Exception as e:
+                        print(e)
+                        sites[site]['error'].extend(chunk)
             else:
                 print(f'No new MACs to assign to site: {self.name_assoc[site]}')
-                sites[site]['success'] = []
-                sites[site]['error'] = []
         return sites
 
+    async def _perform_task_async(self, assign_jsons:List[Tuple[str, Dict]]) -> Dict[str, Dict[str, str]]:
+        sites = {'task':'assign ap'}
+        async with AsyncMistAPIHandler(self.handler, self.max_in_flight) as handler:
+            assignments = []
+            for site, assign_json in assign_jsons:
+                sites[site] = {'success':[], 'error':[]}
+                assignments.append(self._assign_site_async(handler, site, assign_json, sites[site]))
+            await asyncio.gather(*assignments)
+        return sites
+
+    async def _assign_site_async(self, handler:AsyncMistAPIHandler, site:str, assign_json:Dict, site_result:Dict[str, List[str]]):
+        if len(assign_json['macs']) > 0:
+            print(f'assigning APs to site: {self.name_assoc[site]}')
+            send = lambda chunk: handler.assign_inventory_to_site(dict(assign_json, macs=chunk))
+            chunks = self.mac_chunks.split(assign_json['macs'])
+            # chunks go out side by side, their results are merged back in MAC order
+            responses = await asyncio.gather(*[send(chunk) for chunk in chunks], return_exceptions=True)
+            for chunk, response in zip(chunks, responses):
+                if isinstance(response, Exception):
+                    print(response)
+                    site_result['error'].extend(chunk)
+                else:
+                    self._record_assignment(assign_json['site_id'], response, site_result)
+        else:
+            print(f'No new MACs to assign to site: {self.name_assoc[site]}')
+
+    def _record_assignment(self, site_id:str, response:Dict, site_result:Dict[str, List[str]]):
+        site_result['success'].extend(response['success'])
+        site_result['error'].extend(response['error'])
+        if self.device_index is not None:
+            self.device_index.assign_to_site(response['success'], site_id)
+
+    def _create_assign_jsons(self) -> List[Tuple[str, Dict]]:
+        """
+        Returns (site, assign json) for every known site. Every MAC is sent, even one the device index has in
+        the site already, since the index may be older than changes made in the dashboard.
+        """
+        assign_jsons = []
+        for site in self.smn:
+            try:    
+                site_id = self.sn_id[self.name_assoc[site]]
+            except KeyError:
+                continue
+            assign_json = {
+                'op' : 'assign',
+                'site_id' : site_id,
+                'macs' : list(self.smn[site]),
+                'no_reassign' : False
+            }
+            assign_jsons.append((site, assign_json))
+        return assign_jsons
+
     def _convert_site_mac_dict_to_tuples(self, site_mac_name:Dict) -> Tuple:
         sites_to_aps_tuples = []
         for site in site_mac_name:
@@ -240,40 +279,44 @@ class AssignTask:
 
 class NameAPTask:
 
-    def __init__(self, site_mac_name:Dict[str, Dict[str,str]], name_association:Dict[str,str], handler:MistAPIHandler):
+    def __init__(self, site_mac_name:Dict[str, Dict[str,str]], name_association:Dict[str,str], handler:MistAPIHandler, max_in_flight:int=1, device_index:DeviceIndex = None):
         self.smn = site_mac_name
         self.name_assoc = name_association
         self.handler = handler
+        self.max_in_flight = max_in_flight
+        # without an index pulled from the org inventory every site is read once and kept here
+        self.device_index = device_index if device_index is not None else DeviceIndex()
+        self.calls_saved = 0
+        self._calls_saved_lock = threading.Lock()
+        # per site, the macs a read of the site already looked for, they are not read for again
+        self._macs_read_for = {}
+        self._site_locks = {}
+        self._site_locks_lock = threading.Lock()
         self.order = 1
     
     def perform_task(self) -> Dict[str, Dict[str, List[str]]]:
-        id_to_name = {}
+        self.calls_saved = 0
+        if self.max_in_flight > 1:
+            return asyncio.run(self._perform_task_async())
         results = {'task':'name ap'}
         for site in self.smn:
             print(f'naming APs for site: {self.name_assoc[site]}')
             site_id = self.handler.sites[self.name_assoc[site]]
             results[site] = {'success':[], 'error':[]}
             try:
-                site_devices = self.handler.get_site_devices(site_id)
+                id_to_name, unchanged = self._plan_site(site, site_id)
             except Exception as e:
                 print(e)
                 exit()
-            mac_to_id = {}
-            for device in site_devices:
-                mac_to_id[device['mac']] = device['id']
-            id_to_name = {}
-            site_aps = self.smn[site]
-            for ap in site_aps:
-                if ap in mac_to_id:
-                 id_to_name[mac_to_id[ap]] = site_aps[ap]
             error = []
-            success = []
+            success = list(unchanged)
             for device_id in id_to_name:
                 try:
                     print(f'pushing ap name {id_to_name[device_id]}...')
                     response = self.handler.config_site_device(site_id, device_id, {'name':id_to_name[device_id]})
                     print('name pushed to site')
                     success.append([response['name'], response['mac']])
+                    self._record_name(response)
                 except Exception as e:
                     print(e)
                     error.append(id_to_name[device_id])
@@ -281,6 +324,279 @@ class NameAPTask:
             results[site]['error'] = error
         return results
 
+    async def _perform_task_async(self) -> Dict[str, Dict[str, List[str]]]:
+        results = {'task':'name ap'}
+        async with AsyncMistAPIHandler(self.handler, self.max_in_flight) as handler:
+            site_namings = []
+            for site in self.smn:
+                results[site] = {'success':[], 'error':[]}
+                site_namings.append(self._name_site_aps_async(handler, site, results[site]))
+            await asyncio.gather(*site_namings)
+        return results
+
+    async def _name_site_aps_async(self, handler:AsyncMistAPIHandler, site:str, site_result:Dict[str, List[str]]):
+        print(f'naming APs for site: {self.name_assoc[site]}')
+        site_id = self.handler.sites[self.name_assoc[site]]
+        try:
+            id_to_name, unchanged = await handler.run(self._plan_site, site, site_id)
+        except Exception as e:
+            print(e)
+            exit()
+        site_result['success'].extend(unchanged)
+        pushes = [self._push_ap_name_async(handler, site_id, device_id, id_to_name[device_id]) for device_id in id_to_name]
+        for pushed, failed in await asyncio.gather(*pushes):
+            if failed is None:
+                site_result['success'].append(pushed)
+            else:
+                site_result['error'].append(failed)
+
+    async def _push_ap_name_async(self, handler:AsyncMistAPIHandler, site_id:str, device_id:str, ap_name:str) -> Tuple[List[str], str]:
+        try:
+            print(f'pushing ap name {ap_name}...')
+            response = await handler.config_site_device(site_id, device_id, {'name':ap_name})
+            print('name pushed to site')
+            self._record_name(response)
+            return [response['name'], response['mac']], None
+        except Exception as e:
+            print(e)
+            return None, ap_name
+
+    def plan(self) -> Dict[str, Dict]:
+        """
+        Naming plan for every site without pushing anything.
+        {
+            site : {
+                "site_id" : str,
+                "push" : {device_id : new_name, ...},
+                "unchanged" : [[name, mac], ...]
+            },
+            ...
+        }
+        """
+        naming_plan = {}
+        for site in self.smn:
+            site_id = self.handler.sites[self.name_assoc[site]]
+            id_to_name, unchanged = self._plan_site(site, site_id)
+            naming_plan[site] = {'site_id':site_id, 'push':id_to_name, 'unchanged':unchanged}
+        return naming_plan
+
+    def _plan_site(self, site:str, site_id:str, site_aps:Dict[str, str] = None) -> Tuple[Dict[str, str], List[List[str]]]:
+        """ Split the site's APs (or the given mac -> name subset of them) into device id -> new name pushes and [name, mac] pairs already named in Mist. """
+        site_aps = site_aps if site_aps is not None else self.smn[site]
+        live_devices = self._get_live_devices(site, site_id, site_aps)
+        id_to_name = {}
+        unchanged = []
+        for ap in site_aps:
+            device = live_devices.get(ap.lower())
+            if device is None:
+                continue
+            if device['name'] == site_aps[ap]:
+                unchanged.append([site_aps[ap], ap])
+            else:
+                id_to_name[device['id']] = site_aps[ap]
+        if unchanged:
+            print(f'{len(unchanged)} APs already named in {self.name_assoc[site]}, skipping them.')
+        with self._calls_saved_lock:
+            self.calls_saved += len(unchanged)
+        return id_to_name, unchanged
+
+    def _get_live_devices(self, site:str, site_id:str, site_aps:Dict[str, str]) -> Dict[str, Dict[str, str]]:
+        """
+        mac -> {"id", "name"} of the given APs that are in the site, resolved through the device index, which
+        holds the inventory pulled in this run, the sites read since and the assignments made since. The site
+        is only read when some of the APs are not in the index and no earlier read of it looked for them, so
+        batches of the same site share one read.
+        """
+        if any(self.device_index.get_site_device(ap, site_id) is None for ap in site_aps):
+            with self._site_lock(site_id):
+                macs_read_for = self._macs_read_for.setdefault(site_id, set())
+                # another batch may have read the site while this one waited for the lock
+                missing = [ap.lower() for ap in site_aps if self.device_index.get_site_device(ap, site_id) is None]
+                if any(ap not in macs_read_for for ap in missing):
+                    self.device_index.update_site(site_id, list(self.handler.iter_site_devices(site_id)))
+                    macs_read_for.update(missing)
+        live_devices = {}
+        for ap in site_aps:
+            device = self.device_index.get_site_device(ap, site_id)
+            if device is not None:
+                live_devices[ap.lower()] = {'id':device['id'], 'name':device['name']}
+        return live_devices
+
+    def _site_lock(self, site_id:str) -> threading.Lock:
+        with self._site_locks_lock:
+            return self._site_locks.setdefault(site_id, threading.Lock())
+
+    def _record_name(self, response:Dict):
+        self.device_index.set_name(response['mac'], response['name'])
+
+class AssignNamePipeline:
+    """
+    Runs assign ap, name ap and, if given, assign aps to device profile as one pipeline instead of
+    one task after the other. Every chunk of MACs that was assigned to its site is handed to the
+    naming workers through a bounded queue, and every named batch to the device profile workers, so
+    the stages send their requests at the same time and the first sites are done long before the
+    last ones are assigned. All stages share the max_in_flight limit. APs of a site that never came
+    through the assign stage (already assigned in an earlier run, or not in the assign list) are
+    queued once the site's assignment has finished, so the results match a run without the pipeline.
+    """
+
+    def __init__(self, assign_task:AssignTask, name_task:NameAPTask, profile_task:AssignDeviceProfileTask = None, max_in_flight:int = 1, queue_size:int = 8):
+        self.assign_task = assign_task
+        self.name_task = name_task
+        self.profile_task = profile_task
+        self.handler = assign_task.handler
+        self.max_in_flight = max_in_flight
+        self.queue_size = queue_size
+        self.site_done_seconds = {}
+
+    def perform_tasks(self) -> List[Dict]:
+        """ Returns the assign ap, name ap and assign aps to device profile results, in the shapes the tasks return them. """
+        return asyncio.run(self._perform_tasks_async())
+
+    async def _perform_tasks_async(self) -> List[Dict]:
+        self.started = time.perf_counter()
+        self.site_done_seconds = {}
+        self.name_task.calls_saved = 0
+        self.assign_results = {'task':'assign ap'}
+        self.name_results = {'task':'name ap'}
+        self.name_results.update({site:{'success':[], 'error':[]} for site in self.name_task.smn})
+        self.profile_results = {'task':'assign aps to device profile'}
+        profile_sites = self.profile_task.smn if self.profile_task is not None else {}
+        self.profile_results.update({site:{'success':[], 'error':[]} for site in profile_sites})
+        sites = list(dict.fromkeys(list(self.assign_task.smn) + list(self.name_task.smn) + list(profile_sites)))
+        # macs queued for naming per site, batches of a site still in the pipeline and sites that get no more batches
+        self.queued = {site:set() for site in sites}
+        self.pending = {site:0 for site in sites}
+        self.closed = set()
+        self.name_queue = asyncio.Queue(self.queue_size)
+        self.profile_queue = asyncio.Queue(self.queue_size) if self.profile_task is not None else None
+        async with AsyncMistAPIHandler(self.handler, self.max_in_flight) as handler:
+            namers = [asyncio.create_task(self._name_worker(handler)) for _ in range(self.max_in_flight)]
+            profilers = [asyncio.create_task(self._profile_worker(handler)) for _ in range(self.max_in_flight)] if self.profile_queue is not None else []
+            assign_jsons = self.assign_task._create_assign_jsons()
+            assigned_sites = {site for site, _ in assign_jsons}
+            await asyncio.gather(*[self._assign_site(handler, site, assign_json) for site, assign_json in assign_jsons])
+            for site in sites:
+                if site not in assigned_sites:
+                    await self._close_site(site)
+            await self._finish(self.name_queue, namers)
+            if self.profile_queue is not None:
+                await self._finish(self.profile_queue, profilers)
+        results = [self.assign_results, self.name_results]
+        if self.profile_task is not None:
+            results.append(self.profile_results)
+        return results
+
+    async def _assign_site(self, handler:AsyncMistAPIHandler, site:str, assign_json:Dict):
+        self.assign_results[site] = {'success':[], 'error':[]}
+        chunks = self.assign_task.mac_chunks.split(assign_json['macs'])
+        await asyncio.gather(*[self._assign_chunk(handler, site, assign_json, chunk) for chunk in chunks])
+        await self._close_site(site)
+
+    async def _assign_chunk(self, handler:AsyncMistAPIHandler, site:str, assign_json:Dict, chunk:List[str]):
+        send = lambda macs: handler.assign_inventory_to_site(dict(assign_json, macs=macs))
+        try:
+            response = await send(chunk)
+        except Exception as e:
+            print(e)
+            self.assign_results[site]['error'].extend(chunk)
+            return
+        self.assign_task._record_assignment(assign_json['site_id'], response, self.assign_results[site])
+        if response['success']:
+            await self._queue_for_naming(site, response['success'])
+
+    async def _close_site(self, site:str):
+        """ Queue the APs of the site that did not come through the assign stage, after which no more batches of the site follow. """
+        left_to_name = [ap for ap in self.name_task.smn.get(site, {}) if try_parse_mac(ap) not in self.queued[site]]
+        if left_to_name:
+            await self._queue_for_naming(site, left_to_name)
+        if self.profile_queue is not None:
+            left_to_profile = [mac for mac in self.profile_task.smn.get(site, []) if try_parse_mac(mac) not in self.queued[site]]
+            if left_to_profile:
+                self.pending[site] += 1
+                await self.profile_queue.put((site, left_to_profile))
+        self.closed.add(site)
+        self._check_site_done(site)
+
+    async def _queue_for_naming(self, site:str, macs:List[str]):
+        self.queued[site].update(mac for mac in map(try_parse_mac, macs) if mac is not None)
+        self.pending[site] += 1
+        await self.name_queue.put((site, list(macs)))
+
+    async def _name_worker(self, handler:AsyncMistAPIHandler):
+        while True:
+            batch = await self.name_queue.get()
+            if batch is None:
+                return
+            site, macs = batch
+            if site in self.name_task.smn:
+                await self._name_batch(handler, site, macs)
+            if self.profile_queue is not None:
+                await self.profile_queue.put(batch)
+            else:
+                self._batch_done(site)
+
+    async def _name_batch(self, handler:AsyncMistAPIHandler, site:str, macs:List[str]):
+        site_macs = self.name_task.smn[site]
+        site_aps = {mac.lower():site_macs[mac.lower()] for mac in macs if mac.lower() in site_macs}
+        if not site_aps:
+            return
+        site_result = self.name_results[site]
+        try:
+            site_id = self.handler.sites[self.name_task.name_assoc[site]]
+            id_to_name, unchanged = await handler.run(self.name_task._plan_site, site, site_id, site_aps)
+        except Exception as e:
+            print(e)
+            site_result['error'].extend(site_aps.values())
+            return
+        site_result['success'].extend(unchanged)
+        pushes = [self.name_task._push_ap_name_async(handler, site_id, device_id, id_to_name[device_id]) for device_id in id_to_name]
+        for pushed, failed in await asyncio.gather(*pushes):
+            if failed is None:
+                site_result['success'].append(pushed)
+            else:
+                site_result['error'].append(failed)
+
+    async def _profile_worker(self, handler:AsyncMistAPIHandler):
+        while True:
+            batch = await self.profile_queue.get()
+            if batch is None:
+                return
+            site, macs = batch
+            if site in self.profile_task.smn:
+                await self._profile_batch(handler, site, macs)
+            self._batch_done(site)
+
+    async def _profile_batch(self, handler:AsyncMistAPIHandler, site:str, macs:List[str]):
+        site_macs = {mac.lower():mac for mac in self.profile_task.smn[site]}
+        batch_macs = [site_macs[mac.lower()] for mac in macs if mac.lower() in site_macs]
+        if not batch_macs:
+            return
+        site_result = self.profile_results[site]
+        send = lambda chunk: handler.run(self.profile_task._send_chunk, chunk)
+        chunks = self.profile_task.mac_chunks.split(batch_macs)
+        responses = await asyncio.gather(*[send(chunk) for chunk in chunks], return_exceptions=True)
+        for chunk, response in zip(chunks, responses):
+            if isinstance(response, Exception):
+                print(response)
+                site_result['error'].extend(chunk)
+            else:
+                site_result['success'].extend(chunk)
+
+    def _batch_done(self, site:str):
+        self.pending[site] -= 1
+        self._check_site_done(site)
+
+    def _check_site_done(self, site:str):
+        if site in self.closed and self.pending[site] == 0 and site not in self.site_done_seconds:
+            self.site_done_seconds[site] = time.perf_counter() - self.started
+            print(f'site {site} configured')
+
+    async def _finish(self, queue:asyncio.Queue, workers:List[asyncio.Task]):
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+
 class RenameAPEsxTask:
 
     def __init__(self, esx_writer:EkahauWriter):
@@ -368,22 +684,31 @@ class TaskManager:
         'assign aps to device profile' : [NameAssoc, SiteMac],
     }
 
-    def __init__(self, config:Dict = {}, handler:MistAPIHandler = None, writer:ExcelWriter = None, esx_writer:EkahauWriter = None):
+    def __init__(self, config:Dict = {}, handler:MistAPIHandler = None, writer:ExcelWriter = None, esx_writer:EkahauWriter = None, dry_run:bool = False):
         self.config = config
+        self.dry_run = dry_run
         self.tasks = config['sites']['tasks']
         self.writer = writer
         self.esx_writer = esx_writer
         self.ekahau_only = set(self.tasks) <= self.EKAHU_ONLY_TASKS
 
         if not self.ekahau_only:
-            username = config['login']['username']
-            password = config['login']['password']
-            login_params = {
-                'username':username,
-                'password':password
-                }
+            if 'api_token' in config['login']:
+                login_method = 'api_token'
+                login_params = {'api_token':config['login']['api_token']}
+            else:
+                login_method = 'usr_pw'
+                username = config['login']['username']
+                password = config['login']['password']
+                login_params = {
+                    'username':username,
+                    'password':password
+                    }
+                if 'two_factor' in config['login']:
+                    login_params['two_factor'] = config['login']['two_factor']
+            handler_options = config.get('api', {})
             print('logging in...')
-            self.handler = handler('usr_pw', login_params)
+            self.handler = handler(login_method, login_params, **handler_options)
             self.handler.save_org_id_by_name(config['org'])
             self.handler.populate_site_id_dict()
             self.site_name_to_id = self.handler.sites
@@ -414,6 +739,13 @@ class TaskManager:
         print('validating data...')
         self._validate_data_structures()
 
+        self.device_index = None
+        if not self.ekahau_only and 'name ap' in self.tasks:
+            # one inventory pull instead of a read of every site the names go to
+            print('pulling the org inventory...')
+            self.device_index = DeviceIndex(self.handler.org_id)
+            self.device_index.refresh(self.handler)
+
     def _create_data_structures(self):
         data_objects = [] 
         data_structures = {}
@@ -469,14 +801,12 @@ class TaskManager:
                     named_aps = pandas.read_excel(saved_filename, sheet_name='name ap').values.tolist()
                 except:
                     named_aps = []
+                named_ap_names = {}
+                for ap_name, ap_mac in named_aps:
+                    named_ap_names.setdefault(parse_sheet_mac(ap_mac), set()).add(ap_name)
                 site_mac_name = ds[site]
-                site_mac_name_copy = site_mac_name.copy()
-                for mac in site_mac_name:
-                    mac_to_name_pair = [site_mac_name[mac], mac]
-                    if mac_to_name_pair in named_aps:
-                        site_mac_name_copy.pop(mac)
-                ds[site] = site_mac_name_copy
-            return ds
+                ds[site] = {ap_mac:ap_name for ap_mac, ap_name in site_mac_name.items() if ap_name not in named_ap_names.get(try_parse_mac(ap_mac), ())}
+        return ds
 
     def _validate_site_to_mac_ds(self, ds:Dict) -> Dict:
         """ Remove devices that were already assigned to sites previously. """
@@ -487,24 +817,21 @@ class TaskManager:
             saved_filename = os.path.join(os.getcwd(), 'data', excel_base_name.format(site_id))
             if os.path.exists(saved_filename):
                 try:
-                    assigned_mac = pandas.read_excel(saved_filename, sheet_name='assign ap')['MAC'].values.tolist()
+                    assigned_macs = set(map(parse_sheet_mac, pandas.read_excel(saved_filename, sheet_name='assign ap')['MAC'].values.tolist())) - {None}
                 except:
-                    assigned_mac = []
-                site_macs = ds[site]
-                site_macs_copy = site_macs.copy()
-                for mac in site_macs:
-                    if mac.lower() in assigned_mac :
-                        site_macs_copy.remove(mac)
-                ds[site] = site_macs_copy
-            return ds
+                    assigned_macs = set()
+                ds[site] = [ap_mac for ap_mac in ds[site] if try_parse_mac(ap_mac) not in assigned_macs]
+        return ds
 
     def create_tasks(self):
         self.execute_queue = []
+        max_in_flight = self.config['sites'].get('max_in_flight', 1)
+        mac_chunks = MacChunks(self.config['sites'].get('mac_chunk_size', 100))
         for task in self.tasks:
             if task == 'assign ap':
-                task_instance = AssignTask(self.data_structures['site_to_mac'], self.site_name_to_id, self.data_structures['name_association'], self.handler)
+                task_instance = AssignTask(self.data_structures['site_to_mac'], self.site_name_to_id, self.data_structures['name_association'], self.handler, max_in_flight, self.device_index, mac_chunks)
             elif task == 'name ap':
-                task_instance = NameAPTask(self.data_structures['site_mac_name'], self.data_structures['name_association'], self.handler)
+                task_instance = NameAPTask(self.data_structures['site_mac_name'], self.data_structures['name_association'], self.handler, max_in_flight, self.device_index)
             elif task == 'rename esx ap':
                 task_instance = RenameAPEsxTask(self.esx_writer)
             elif task == 'create per floor esx files':
@@ -512,7 +839,7 @@ class TaskManager:
             elif task == 'export ekahau aps':
                 task_instance = ExportEkahauAPsTask(self.esx_writer)
             elif task == 'assign aps to device profile':
-                task_instance = AssignDeviceProfileTask(self.data_structures['site_to_mac'], self.deviceprofile_id, self.handler)
+                task_instance = AssignDeviceProfileTask(self.data_structures['site_to_mac'], self.deviceprofile_id, self.handler, self.device_index, max_in_flight, mac_chunks)
             else:
                 raise ValueError(f'Unknown task: {task}. Available tasks are:\nassign ap\nname ap\nrename esx ap\ncreate per floor esx files\nexport ekahau aps\n')
             self.execute_queue.append(task_instance)
@@ -520,9 +847,63 @@ class TaskManager:
     def execute_tasks(self):
         self.results = []
         self.execute_queue.sort(key=lambda o: o.order)
+        self.task_seconds = []
+        self.pipeline = self._create_pipeline()
+        pipelined = self._get_pipelined_tasks() if self.pipeline is not None else []
+        pipeline_results = []
         for task in self.execute_queue:
+            if task in pipelined:
+                if not pipeline_results:
+                    started = time.perf_counter()
+                    pipeline_results = self.pipeline.perform_tasks()
+                    pipeline_seconds = time.perf_counter() - started
+                # the pipelined tasks ran together and share its run time
+                self.task_seconds.append(pipeline_seconds)
+                self.results.append(pipeline_results[pipelined.index(task)])
+                continue
+            started = time.perf_counter()
             result = task.perform_task()
+            self.task_seconds.append(time.perf_counter() - started)
             self.results.append(result)
+        self.run_stats = self._collect_run_stats()
+        if self.handler is not None:
+            self.handler.save_metrics()
+        index_file = self.config['sites'].get('device_index_file')
+        if self.device_index is not None and index_file and not self.dry_run:
+            self.device_index.save(index_file)
+
+    def _get_pipelined_tasks(self) -> List:
+        """ The assign ap, name ap and assign aps to device profile tasks of the queue, in the order the pipeline returns their results. """
+        by_type = {type(task):task for task in self.execute_queue}
+        pipelined = [by_type.get(AssignTask), by_type.get(NameAPTask), by_type.get(AssignDeviceProfileTask)]
+        return [task for task in pipelined if task is not None]
+
+    def _create_pipeline(self) -> AssignNamePipeline:
+        """ With sites.pipeline set, assign ap and name ap (and assign aps to device profile) run as one AssignNamePipeline. """
+        if not self.config['sites'].get('pipeline', False):
+            return None
+        by_type = {type(task):task for task in self.execute_queue}
+        if AssignTask not in by_type or NameAPTask not in by_type:
+            return None
+        return AssignNamePipeline(
+            by_type[AssignTask], by_type[NameAPTask], by_type.get(AssignDeviceProfileTask),
+            self.config['sites'].get('max_in_flight', 1), self.config['sites'].get('pipeline_queue_size', 8)
+        )
+
+    def _collect_run_stats(self) -> Dict:
+        run_stats = {}
+        if self.handler is not None:
+            run_stats['api_retries'] = dict(self.handler.retry_counts)
+            run_stats['api_coalesced'] = dict(self.handler.coalesced_counts)
+        run_stats['calls_saved'] = {}
+        run_stats['task_seconds'] = {}
+        for task, result, seconds in zip(self.execute_queue, self.results, self.task_seconds):
+            if hasattr(task, 'calls_saved'):
+                run_stats['calls_saved'][result['task']] = task.calls_saved
+            run_stats['task_seconds'][result['task']] = seconds
+        if self.pipeline is not None and self.pipeline.site_done_seconds:
+            run_stats['first_site_seconds'] = min(self.pipeline.site_done_seconds.values())
+        return run_stats
 
     def save_success_configs_to_file(self):
         self.writer = self.writer(self.results, self.site_name_to_id, self.data_structures['name_association'])
@@ -3,15 +3,32 @@ import os
 from webbrowser import get
 src_path = os.getenv('MistAPIHandler')
 sys.path.append(src_path)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
 import inventory_devices
+import mac
 import tasks
+import api
+import device_index
+import planner
+import mist_stub_server
+import benchmarks
+import baselines
+import metrics
+import batch
+import synthetic
+import yaml
+import openpyxl
 import pytest
 import random
 import pandas
 import file_ops
 import json
+import requests
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from zipfile import ZipFile
-from typing import Dict, List
+from typing import Dict, List, Tuple
 
 
 class FakeAPIHandler:
@@ -28,7 +45,9 @@ class FakeAPIHandler:
         }
         self.username = username
         self.password = password
-    
+        self.retry_counts = {}
+        self.coalesced_counts = {}
+
     def assign_inventory_to_site(self, request_body:Dict) -> Dict:
         self.data.append(request_body)
         assign_macs = request_body['macs']
@@ -49,6 +68,17 @@ class FakeAPIHandler:
 
     def get_site_devices(self, site_id:str) -> Dict:
         return self.site_devices[site_id] 
+
+    def iter_site_devices(self, site_id:str):
+        yield from self.site_devices[site_id]
+
+    def save_metrics(self):
+        pass
+
+    def iter_inventory(self, org_id:str = '', prefetch:bool = None):
+        for site_id in self.site_devices:
+            for device in self.site_devices[site_id]:
+                yield {'mac':device['mac'], 'id':device['id'], 'site_id':site_id, 'name':device.get('name')}
     
     def save_org_id_by_name(self, org_name:str):
         self.org_id = '001'
@@ -62,6 +92,68 @@ class FakeAPIHandler:
         ]
         return self.org_inventory
 
+class LocalMistRequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    responses_to_throttle = 0
+    responses_to_fail = 0
+    responses_to_stall = 0
+    requests_seen = []
+    get_responses = {}
+
+    def _respond(self, body, headers:Dict = {}):
+        LocalMistRequestHandler.requests_seen.append((self.command, self.path))
+        length = int(self.headers.get('Content-Length', 0))
+        if length > 0:
+            self.rfile.read(length)
+        if LocalMistRequestHandler.responses_to_stall > 0:
+            LocalMistRequestHandler.responses_to_stall -= 1
+            time.sleep(0.5)
+        if LocalMistRequestHandler.responses_to_throttle > 0:
+            LocalMistRequestHandler.responses_to_throttle -= 1
+            self.send_response(429)
+            self.send_header('Retry-After', '0')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if LocalMistRequestHandler.responses_to_fail > 0:
+            LocalMistRequestHandler.responses_to_fail -= 1
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for header in headers:
+            self.send_header(header, headers[header])
+        if self.path.endswith('login'):
+            self.send_header('Set-Cookie', 'csrftoken=token; Path=/')
+            self.send_header('Set-Cookie', 'sessionid=session; Path=/')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        body = LocalMistRequestHandler.get_responses.get(path, [{'id':'dev_id0', 'mac':'mac0'}])
+        params = dict(param.split('=') for param in query.split('&') if '=' in param)
+        if 'page' in params and 'limit' in params:
+            limit = int(params['limit'])
+            start = (int(params['page']) - 1) * limit
+            self._respond(body[start:start + limit], headers={'X-Page-Total':str(len(body))})
+        else:
+            self._respond(body)
+
+    def do_POST(self):
+        self._respond({'email':'username'})
+
+    def do_PUT(self):
+        self._respond({'name':'ap', 'mac':'mac0'})
+
+    def log_message(self, format, *args):
+        pass
+
 def generate_random_mac():
     mac = ''
     length = 12
@@ -105,6 +197,22 @@ def get_test_config_data() -> Dict:
         }
      }
 
+@pytest.fixture
+def local_mist_server(monkeypatch) -> str:
+    server = ThreadingHTTPServer(('127.0.0.1', 0), LocalMistRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base_url = f'http://127.0.0.1:{server.server_address[1]}/api/v1/'
+    monkeypatch.setattr(api.MistAPIHandler, 'BASE_URL', base_url)
+    yield base_url
+    LocalMistRequestHandler.responses_to_throttle = 0
+    LocalMistRequestHandler.responses_to_fail = 0
+    LocalMistRequestHandler.responses_to_stall = 0
+    LocalMistRequestHandler.requests_seen = []
+    LocalMistRequestHandler.get_responses = {}
+    server.shutdown()
+    server.server_close()
+
 @pytest.fixture
 def site_mac_name() -> Dict[str, Dict[str,str]]:
     return {
@@ -607,6 +715,13 @@ def test_is_valid_mac_returns_false_for_valid_mac_with_colon_delims():
     generated = inventory_devices.is_valid_mac(test_data, ':')
     assert False == generated
 
+def test_SiteMac_and_SiteMacName_accept_macs_in_any_format_by_default(create_temp_excel_data):
+    config = get_test_config_data()
+    config['sites']['ap_excel_file'] = create_temp_excel_data
+    for data_structure in [tasks.SiteMac(config), tasks.SiteMacName(config)]:
+        assert all(data_structure.is_valid_mac(mac) for mac in ['aabbccddeeff', 'AA:BB:CC:DD:EE:FF', 'aa-bb-cc-dd-ee-ff', 'aabb.ccdd.eeff'])
+        assert not data_structure.is_valid_mac('aa:bb:cc:dd:ee:ff', '')
+
 def test_get_site_names_from_config_creates_full_list_of_sites():
     test_data = {
         'ap_excel_file' : 'somefile',
@@ -669,6 +784,44 @@ def test_NameAPTask_creates_device_jsons_and_pushes_to_handler(static_site_mac_n
     response = name_ap_task.perform_task()
     assert response == {'site0':{'success':[['site0-ap-01','mac0']], 'error':[]}, 'site1':{'success':[['site1-ap-01','mac1']], 'error':[]}, 'task':'name ap'}
 
+def test_AssignTask_with_max_in_flight_returns_same_results_as_sequential(site_to_mac, site_name_to_id, name_association):
+    handler = FakeAPIHandler()
+    assign_task = tasks.AssignTask(site_to_mac, site_name_to_id, name_association, handler, max_in_flight=4)
+    sites = assign_task.perform_task()
+    assert sites == {'site0':{'success':site_to_mac['site0'], 'error':[]}, 'site1':{'success':site_to_mac['site1'], 'error':[]}, 'task' :'assign ap'}
+
+def test_NameAPTask_with_max_in_flight_overlaps_pushes_and_returns_same_results(name_association):
+    class SlowFakeAPIHandler(FakeAPIHandler):
+        def __init__(self):
+            super().__init__()
+            self.site_devices = {
+                'id0' : [{'id':f'dev_id{num}', 'mac':f'mac{num}'} for num in range(4)],
+                'id1' : [{'id':'dev_id9', 'mac':'mac9'}]
+            }
+            self.lock = threading.Lock()
+            self.in_flight = 0
+            self.max_seen_in_flight = 0
+        def config_site_device(self, site_id:str, device_id:str, request_body:Dict) -> Dict:
+            with self.lock:
+                self.in_flight += 1
+                self.max_seen_in_flight = max(self.max_seen_in_flight, self.in_flight)
+            time.sleep(0.05)
+            with self.lock:
+                self.in_flight -= 1
+            return {'name':request_body['name'], 'id':device_id, 'mac':device_id.replace('dev_id', 'mac')}
+    site_mac_name = {
+        'site0' : {f'mac{num}':f'site0-ap-0{num}' for num in range(4)},
+        'site1' : {'mac9':'site1-ap-01'}
+    }
+    handler = SlowFakeAPIHandler()
+    response = tasks.NameAPTask(site_mac_name, name_association, handler, max_in_flight=3).perform_task()
+    assert response == {
+        'task':'name ap',
+        'site0':{'success':[[f'site0-ap-0{num}', f'mac{num}'] for num in range(4)], 'error':[]},
+        'site1':{'success':[['site1-ap-01', 'mac9']], 'error':[]}
+    }
+    assert handler.max_seen_in_flight == 3
+
 def test_validate_data_structure_removes_macs_already_assigned_macs_from_site_mac_name_dict(create_temp_site_excel, create_temp_excel_data):
     expected = {
         'site1' : [
@@ -1344,4 +1497,855 @@ def test_create_tasks_includes_export_ekahau_aps_task(create_temp_esx_file):
   assert task_manager.handler is None
   task_manager.create_tasks()
   assert len(task_manager.execute_queue) == 1
-  assert isinstance(task_manager.execute_queue[0], tasks.ExportEkahauAPsTask)
\ No newline at end of file
+  assert isinstance(task_manager.execute_queue[0], tasks.ExportEkahauAPsTask)
+def test_MistAPIHandler_reuses_pooled_connections_across_calls(local_mist_server):
+  handler = api.MistAPIHandler('usr_pw', {'username':'username', 'password':'password'}, pool_maxsize=2)
+  for num in range(5):
+    handler.config_site_device('id0', f'dev_id{num}', {'name':f'ap-{num}'})
+  handler.get_site_devices('id0')
+  stats = handler.get_connection_stats()
+  assert stats['requests'] == 7
+  assert stats['connections_opened'] == 1
+  assert stats['connections_reused'] == 6
+
+def test_RequestScheduler_paces_requests_once_burst_is_used_up():
+  now = [0.0]
+  def sleep(seconds):
+    now[0] += seconds
+  scheduler = api.RequestScheduler(requests_per_hour=3600, burst=2, clock=lambda: now[0], sleep=sleep)
+  for _ in range(5):
+    scheduler.acquire()
+  assert now[0] == pytest.approx(3.0)
+  assert scheduler.get_stats()['remaining_budget'] == 3595
+
+def test_RequestScheduler_never_sends_more_than_requests_per_hour_in_one_window():
+  now = [0.0]
+  def sleep(seconds):
+    now[0] += seconds
+  scheduler = api.RequestScheduler(requests_per_hour=10, burst=10, clock=lambda: now[0], sleep=sleep)
+  assert api.RequestScheduler(requests_per_hour=5000).burst == 20
+  for _ in range(10):
+    scheduler.acquire()
+  assert now[0] == 0.0
+  # the bucket refills to 10 tokens within the hour, the window still holds 10 requests
+  now[0] = 3599.0
+  scheduler.acquire()
+  assert now[0] == pytest.approx(3600.0)
+  assert scheduler.get_stats()['remaining_budget'] == 9
+
+def test_parse_retry_after_accepts_seconds_and_http_dates():
+  assert api.parse_retry_after('12') == 12.0
+  assert api.parse_retry_after(None, default=3.0) == 3.0
+  assert api.parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT') == 0.0
+
+def test_MistAPIHandler_waits_and_resends_after_429(local_mist_server):
+  handler = api.MistAPIHandler('usr_pw', {'username':'username', 'password':'password'})
+  LocalMistRequestHandler.responses_to_throttle = 2
+  response = handler.get_site_devices('id0')
+  assert response == [{'id':'dev_id0', 'mac':'mac0'}]
+  assert handler.scheduler.throttled == 2
+
+def test_MistAPIHandler_retries_idempotent_endpoints_on_5xx(local_mist_server):
+  handler = api.MistAPIHandler('usr_pw', {'username':'username', 'password':'password'}, retry_backoff_base=0)
+  LocalMistRequestHandler.responses_to_fail = 2
+  response = handler.config_site_device('id0', 'dev_id0', {'name':'ap'})
+  assert response == {'name':'ap', 'mac':'mac0'}
+  assert handler.retry_counts == {'device_config':2}
+  assert handler.retry_budget == 98
+
+def test_MistAPIHandler_does_not_retry_non_idempotent_posts(local_mist_server):
+  handler = api.MistAPIHandler('usr_pw', {'username':'username', 'password':'password'}, retry_backoff_base=0)
+  LocalMistRequestHandler.responses_to_fail = 1
+  with pytest.raises(api.APIRequestError) as e:
+    handler.claim_mistedge('org', {'code':'135-145-678'})
+  assert e.value.status_code == 503
+  assert handler.retry_counts == {}
+
+def test_MistAPIHandler_retries_device_profile_assignments(local_mist_server):
+  handler = api.MistAPIHandler('usr_pw', {'username':'username', 'password':'password'}, retry_backoff_base=0)
+  LocalMistRequestHandler.responses_to_fail = 1
+  handler.assign_devices_to_device_profile('org', 'profile', {'macs':['aabbccddeeff']})
+  assert handler.retry_counts == {'assign_to_device_profile':1}
+  assert handler.retry_budget == 99
+
+def test_MistAPIHandler_retries_a_read_that_timed_out(local_mist_server):
+  handler = api.MistAPIHandler('usr_pw', {'username':'username', 'password':'password'}, retry_backoff_base=0, request_timeout=0.2)
+  LocalMistRequestHandler.responses_to_stall = 1
+  assert handler.get_site_devices('id0') == [{'id':'dev_id0', 'mac':'mac0'}]
+  assert handler.retry_counts == {'site_devices':1}
+
+def test_MistAPIHandler_stops_retrying_when_retry_budget_is_spent(local_mist_server):
+  handler = api.MistAPIHandler('usr_pw', {'username':'username', 'password':'password'}, retry_backoff_base=0, retry_budget=1)
+  LocalMistRequestHandler.responses_to_fail = 2
+  with pytest.raises(api.APIRequestError):
+    handler.get_site_devices('id0')
+  assert handler.retry_counts == {'site_devices':1}
+
+def test_MistAPIHandler_caches_org_metadata_until_a_write_invalidates_it(local_mist_server):
+  handler = api.MistAPIHandler('usr_pw', {'username':'username', 'password':'password'})
+  LocalMistRequestHandler.requests_seen = []
+  handler.get_sites('org')
+  handler.get_sites('org')
+  handler.get_device_profiles('org')
+  handler.get_device_profiles('org')
+  assert LocalMistRequestHandler.requests_seen == [('GET', '/api/v1/orgs/org/sites'), ('GET', '/api/v1/orgs/org/deviceprofiles?type=ap')]
+  handler.update_site('site_id', {'name':'site'})
+  handler.get_sites('org')
+  assert LocalMistRequestHandler.requests_seen[-1] == ('GET', '/api/v1/orgs/org/sites')
+  assert handler.cache.hits == 2
+
+def test_MistAPIHandler_reuses_cache_file_across_runs(local_mist_server, tmp_path):
+  cache_file = str(tmp_path / 'api_cache.json')
+  handler = api.MistAPIHandler('usr_pw', {'username':'username', 'password':'password'}, cache_file=cache_file)
+  sites = handler.get_sites('org')
+  LocalMistRequestHandler.requests_seen = []
+  next_run_handler = api.MistAPIHandler('usr_pw', {'username':'username', 'password':'password'}, cache_file=cache_file)
+  assert next_run_handler.get_sites('org') == sites
+  assert LocalMistRequestHandler.requests_seen == [('POST', '/api/v1/login')]
+
+def test_ResponseCache_expires_entries_after_endpoint_ttl():
+  now = [0.0]
+  cache = api.ResponseCache({'sites':10}, clock=lambda: now[0])
+  cache.set('sites', 'orgs/org/sites', [{'id':'id0'}])
+  cache.set('site_devices', 'sites/id0/devices', [])
+  assert cache.get('sites', 'orgs/org/sites') == (True, [{'id':'id0'}])
+  assert cache.get('site_devices', 'sites/id0/devices') == (False, None)
+  now[0] = 10.0
+  assert cache.get('sites', 'orgs/org/sites') == (False, None)
+
+def test_inventory_devices_fetches_the_site_list_once(local_mist_server):
+  LocalMistRequestHandler.get_responses = {
+    '/api/v1/orgs/org/inventory' : [
+      {'name':f'ap-{num}', 'model':'AP43', 'mac':f'mac{num}', 'site_id':f'id{num % 3}', 'connected':True} for num in range(9)
+    ] + [{'name':'spare', 'model':'AP43', 'mac':'mac9', 'site_id':None, 'connected':False}],
+    '/api/v1/orgs/org/sites' : [{'id':f'id{num}', 'name':f'site{num}'} for num in range(3)]
+  }
+  handler = api.MistAPIHandler('usr_pw', {'username':'username', 'password':'password'}, cache_ttls={'sites':0})
+  output_file = os.path.join(os.getcwd(), 'AP Status.xlsx')
+  try:
+    inventory_devices.inventory_devices(handler, 'org')
+    site_requests = [request for request in LocalMistRequestHandler.requests_seen if request[1] == '/api/v1/orgs/org/sites']
+    assert len(site_requests) == 1
+    report = pandas.read_excel(output_file)
+    assert report['SITE'].fillna('').tolist() == [f'site{num % 3}' for num in range(9)] + ['']
+  finally:
+    if os.path.exists(output_file):
+      os.remove(output_file)
+
+def test_SiteIndex_looks_up_sites_by_id_and_name():
+  site_index = api.SiteIndex([{'id':'id0', 'name':'site0'}, {'id':'id1', 'name':'site1'}])
+  assert site_index.get_name('id1') == 'site1'
+  assert site_index.get_id('site0') == 'id0'
+  assert site_index.get_name('id9', '') == ''
+  assert len(site_index) == 2
+
+def test_iter_inventory_follows_pages_until_total_is_reached(local_mist_server):
+  inventory = [{'mac':f'mac{num}'} for num in range(25)]
+  LocalMistRequestHandler.get_responses = {'/api/v1/orgs/org/inventory' : inventory}
+  handler = api.MistAPIHandler('usr_pw', {'username':'username', 'password':'password'}, page_limit=10)
+  LocalMistRequestHandler.requests_seen = []
+  assert list(handler.iter_inventory('org')) == inventory
+  assert [request[1] for request in LocalMistRequestHandler.requests_seen] == [f'/api/v1/orgs/org/inventory?limit=10&page={page}' for page in range(1, 4)]
+  assert list(handler.iter_inventory('org', prefetch=True)) == inventory
+
+def test_iter_api_endpoint_rejects_endpoints_that_are_not_lists(local_mist_server):
+  handler = api.MistAPIHandler('usr_pw', {'username':'username', 'password':'password'})
+  with pytest.raises(ValueError):
+    next(handler.iter_api_endpoint('device_config', ['id0', 'dev_id0']))
+
+def test_DeviceIndex_is_saved_with_a_timestamp_and_updated_per_site(tmp_path):
+  handler = FakeAPIHandler()
+  index = device_index.DeviceIndex('001')
+  index.refresh(handler)
+  assert index.get_site_device('MAC0', 'id0')['id'] == 'dev_id0'
+  assert index.get_site_device('mac0', 'id1') is None
+  index_file = str(tmp_path / 'device_index.json')
+  index.save(index_file)
+  loaded = device_index.DeviceIndex.load(index_file, '001')
+  assert loaded.devices == index.devices and loaded.refreshed_at == index.refreshed_at
+  assert device_index.DeviceIndex.load(index_file, 'other org') is None
+  loaded.update_site('id1', [{'id':'dev_id2', 'mac':'mac2'}])
+  assert loaded.get_site_device('mac2', 'id1')['id'] == 'dev_id2'
+  assert loaded.lookup('mac1')['site_id'] is None
+
+def test_NameAPTask_resolves_devices_through_the_inventory_index_without_reading_sites(static_site_mac_name, name_association):
+  class CountingFakeAPIHandler(FakeAPIHandler):
+    def iter_site_devices(self, site_id:str):
+      self.site_reads = getattr(self, 'site_reads', []) + [site_id]
+      yield from super().iter_site_devices(site_id)
+  handler = CountingFakeAPIHandler()
+  handler.site_devices['id0'] = [{'id':'dev_id0', 'mac':'mac0', 'name':'site0-ap-01'}]
+  index = device_index.DeviceIndex('001')
+  index.refresh(handler)
+  # site1's AP was assigned after the inventory pull and is not in the index yet, so only site1 is read
+  index.devices.pop('mac1')
+  task = tasks.NameAPTask(static_site_mac_name, name_association, handler, device_index=index)
+  response = task.perform_task()
+  assert response == {'site0':{'success':[['site0-ap-01','mac0']], 'error':[]}, 'site1':{'success':[['site1-ap-01','mac1']], 'error':[]}, 'task':'name ap'}
+  assert handler.data == [{'name':'site1-ap-01'}]
+  assert task.calls_saved == 1
+  assert handler.site_reads == ['id1']
+  assert index.lookup('mac1') == {'site_id':'id1', 'id':'dev_id1', 'name':'site1-ap-01'}
+
+def test_NameAPTask_reads_a_site_once_for_every_batch_of_it(name_association):
+  class CountingFakeAPIHandler(FakeAPIHandler):
+    def iter_site_devices(self, site_id:str):
+      self.site_reads = getattr(self, 'site_reads', []) + [site_id]
+      yield from super().iter_site_devices(site_id)
+  handler = CountingFakeAPIHandler()
+  handler.site_devices['id0'] = [{'id':f'dev_id{num}', 'mac':f'mac{num}', 'name':None} for num in range(6)]
+  site_mac_name = {'site0':{f'mac{num}':f'site0-ap-0{num}' for num in range(6)}}
+  task = tasks.NameAPTask(site_mac_name, name_association, handler)
+  for start in range(0, 6, 2):
+    id_to_name, _ = task._plan_site('site0', 'id0', {f'mac{num}':f'site0-ap-0{num}' for num in range(start, start + 2)})
+    assert len(id_to_name) == 2
+  assert handler.site_reads == ['id0']
+  # a mac the site did not have is read for once, not again on every batch
+  task._plan_site('site0', 'id0', {'mac9':'site0-ap-09'})
+  task._plan_site('site0', 'id0', {'mac9':'site0-ap-09'})
+  assert handler.site_reads == ['id0', 'id0']
+
+def test_AssignTask_sends_macs_the_device_index_already_has_in_the_site(static_site_to_mac, site_name_to_id, name_association):
+  handler = FakeAPIHandler()
+  index = device_index.DeviceIndex('001')
+  index.refresh(handler)
+  static_site_to_mac['site1'].append('mac7')
+  tasks.AssignTask(static_site_to_mac, site_name_to_id, name_association, handler, device_index=index).perform_task()
+  assert [assign_json['macs'] for assign_json in handler.data] == [['mac0'], ['mac1', 'mac7']]
+  assert index.lookup('mac7')['site_id'] == 'id1'
+
+def test_DeviceIndex_save_creates_the_folder_of_the_index_file(tmp_path):
+  index_file = str(tmp_path / 'data' / 'device_index.json')
+  device_index.DeviceIndex('001').save(index_file)
+  assert device_index.DeviceIndex.load(index_file, '001') is not None
+
+def test_NameAPTask_only_pushes_names_that_differ_from_the_live_names(name_association):
+  handler = FakeAPIHandler()
+  handler.site_devices['id0'] = [{'id':'dev_id2', 'mac':'mac2', 'name':'old name'}, {'id':'dev_id0', 'mac':'mac0', 'name':'site0-ap-01'}]
+  site_mac_name = {'site0':{'mac0':'site0-ap-01', 'mac2':'site0-ap-02'}}
+  task = tasks.NameAPTask(site_mac_name, name_association, handler)
+  assert task.plan() == {'site0':{'site_id':'id0', 'push':{'dev_id2':'site0-ap-02'}, 'unchanged':[['site0-ap-01', 'mac0']]}}
+  response = task.perform_task()
+  assert handler.data == [{'name':'site0-ap-02'}]
+  assert response == {'task':'name ap', 'site0':{'success':[['site0-ap-01', 'mac0'], ['site0-ap-02', 'mac2']], 'error':[]}}
+  assert task.calls_saved == 1
+
+def test_MistAPIHandler_saves_measured_latency_for_the_next_run(local_mist_server, tmp_path):
+  latency_file = str(tmp_path / 'latency.json')
+  LocalMistRequestHandler.get_responses = {'/api/v1/self':{'privileges':[]}}
+  handler = api.MistAPIHandler('usr_pw', {'username':'user', 'password':'pw'}, latency_file=latency_file)
+  handler.check_login()
+  handler.save_latency_stats()
+  handler = api.MistAPIHandler('usr_pw', {'username':'user', 'password':'pw'}, latency_file=latency_file)
+  assert handler.latencies['check_login']['count'] == 1
+  assert 'check_login' in handler.get_latency_stats()
+
+def test_DryRunPlanner_counts_calls_from_saved_state_without_writing(create_temp_excel_data, tmp_path):
+  cache_file = str(tmp_path / 'api_cache.json')
+  index_file = str(tmp_path / 'device_index.json')
+  latency_file = str(tmp_path / 'latency.json')
+  cache = api.ResponseCache({'check_login':1, 'sites':1}, cache_file, 'username', clock=lambda: 0.0)
+  cache.set('check_login', f'{api.MistAPIHandler.BASE_URL}self', {'privileges':[{'scope':'org', 'name':'org', 'org_id':'001'}]})
+  cache.set('sites', f'{api.MistAPIHandler.BASE_URL}orgs/001/sites', [{'name':'site1', 'id':'id1'}])
+  devices = {
+    'aabbccddeef0' : {'site_id':'id1', 'id':'dev0', 'name':'ap-0'},
+    'aabbccddeef1' : {'site_id':'id1', 'id':'dev1', 'name':'old-name'},
+    'aabbccddeef2' : {'site_id':None, 'id':'dev2', 'name':None}
+  }
+  device_index.DeviceIndex('001', devices, time.time()).save(index_file)
+  with open(latency_file, 'w') as f:
+    json.dump({'inventory':{'count':2, 'total':2.0}, 'device_config':{'count':4, 'total':1.0}}, f)
+  config = get_test_config_data()
+  config['sites']['ap_excel_file'] = create_temp_excel_data
+  config['sites']['tasks'] = ['assign ap', 'name ap']
+  config['sites']['device_index_file'] = index_file
+  config['api'] = {'cache_file':cache_file, 'latency_file':latency_file, 'requests_per_hour':3600, 'burst':2}
+  with open(index_file) as f:
+    saved_index = f.read()
+  plan = planner.DryRunPlanner(config).plan()
+  assert plan['setup']['calls'] == {'login':1, 'check_login':1, 'sites':1, 'inventory':1}
+  assert plan['tasks'][0] == {'task':'assign ap', 'calls':{'inventory':1}, 'max_in_flight':1, 'seconds':1.0}
+  assert plan['tasks'][1]['calls'] == {'site_devices':1, 'device_config':2}
+  assert plan['tasks'][1]['seconds'] == 1.0
+  assert plan['total_calls'] == 8
+  assert plan['estimated_seconds'] == 6.0
+  with open(index_file) as f:
+    assert f.read() == saved_index
+
+def test_DryRunPlanner_plans_every_workbook_ap_without_a_saved_device_index(tmp_path):
+  workbook = synthetic.write_installer_workbook(str(tmp_path / 'installer.xlsx'), 20, 2, floors_per_site=1, first_mac=0xa00000000000)
+  config = synthetic.make_config(workbook, 2, ['assign ap', 'name ap'])
+  cache_file = str(tmp_path / 'api_cache.json')
+  cache = api.ResponseCache({'check_login':1, 'sites':1}, cache_file, 'benchmark', clock=lambda: 0.0)
+  cache.set('check_login', f'{api.MistAPIHandler.BASE_URL}self', {'privileges':[{'scope':'org', 'name':'Stub Org', 'org_id':'001'}]})
+  cache.set('sites', f'{api.MistAPIHandler.BASE_URL}orgs/001/sites', [{'name':'site0', 'id':'id0'}, {'name':'site1', 'id':'id1'}])
+  config['api'] = {'cache_file':cache_file}
+  plan = planner.DryRunPlanner(config).plan()
+  assert plan['tasks'][0]['calls'] == {'inventory':2}
+  assert plan['tasks'][1]['calls'] == {'site_devices':2, 'device_config':20}
+  assert len(plan['warnings']) == 1
+  assert 'WARNING: No saved device index' in planner.format_plan(plan)
+
+@pytest.fixture
+def mist_stub() -> mist_stub_server.MistStubServer:
+  org = mist_stub_server.SyntheticOrg('org', site_count=2, aps_per_site=3, unassigned_aps=2)
+  with mist_stub_server.MistStubServer(org) as server:
+    yield server
+
+def test_MistStubServer_serves_a_synthetic_org_to_the_real_handler(mist_stub):
+  handler = api.MistAPIHandler('usr_pw', {'username':'user', 'password':'pw'}, base_url=mist_stub.base_url, page_limit=2)
+  handler.save_org_id_by_name('org')
+  assert handler.org_id == mist_stub.org.org_id
+  site_id = handler.get_site_index().get_id('site1')
+  assert [device['mac'] for device in handler.iter_site_devices(site_id)] == ['000000000003', '000000000004', '000000000005']
+  response = handler.assign_inventory_to_site({'op':'assign', 'site_id':site_id, 'macs':['000000000006', 'ffffffffffff'], 'no_reassign':False})
+  assert response['success'] == ['000000000006'] and response['error'] == ['ffffffffffff']
+  device = handler.config_site_device(site_id, '00000000-0000-0000-1000-000000000006', {'name':'site1-ap-04'})
+  assert device['name'] == 'site1-ap-04'
+  assert mist_stub.org.devices['000000000006']['site_id'] == site_id
+  assert mist_stub.request_counts['site_devices'] == 2
+
+def test_MistStubServer_injects_throttling_and_errors(mist_stub):
+  handler = api.MistAPIHandler('usr_pw', {'username':'user', 'password':'pw'}, base_url=mist_stub.base_url, retry_backoff_base=0.0)
+  mist_stub.throttle_next(1)
+  mist_stub.fail_next(1)
+  handler.save_org_id_by_name('org')
+  assert handler.scheduler.get_stats()['throttled'] == 1
+  assert handler.retry_counts == {'check_login':1}
+
+def test_make_latency_draws_from_the_configured_distribution():
+  rng = random.Random(0)
+  assert mist_stub_server.make_latency(0.25)(rng) == 0.25
+  assert all(0.1 <= mist_stub_server.make_latency({'distribution':'uniform', 'low':0.1, 'high':0.2})(rng) <= 0.2 for _ in range(20))
+  with pytest.raises(ValueError):
+    mist_stub_server.make_latency({'distribution':'pareto'})
+
+def test_run_benchmarks_times_every_group_on_small_synthetic_inputs(tmp_path):
+  report = benchmarks.run_benchmarks(str(tmp_path), ['workbook', 'esx', 'excel', 'api'], [40], [2], [20], [1, 4], 1, 0.0)
+  names = [(result['name'], result['params']) for result in report['benchmarks']]
+  assert names == [
+    ('workbook.site_mac', {'rows':40}),
+    ('workbook.site_mac_name', {'rows':40}),
+    ('workbook.all_readers', {'rows':40}),
+    ('workbook.site_mac_sidecar', {'rows':40}),
+    ('esx.create_floorplan_specific_esx_data', {'floors':2}),
+    ('esx.export_esx_folder_to_xlsx', {'projects':5, 'floors':2}),
+    ('excel.write_tables_to_excel_workbook', {'rows':40}),
+    ('task_manager.assign_and_name', {'aps':20, 'sites':1, 'max_in_flight':1}),
+    ('task_manager.assign_and_name', {'aps':20, 'sites':1, 'max_in_flight':4})
+  ]
+  assert all(len(result['seconds']) == 1 and result['min'] > 0 and result['peak_memory_bytes'] > 0 for result in report['benchmarks'])
+  json.dumps(report)
+
+def test_compare_reports_regressions_against_a_saved_baseline(tmp_path):
+  def result(name, median, peak_memory_bytes):
+    return {'name':name, 'params':{'rows':10}, 'seconds':[median], 'min':median, 'median':median, 'mean':median, 'peak_memory_bytes':peak_memory_bytes}
+  baselines.save_baseline({'benchmarks':[result('slower', 1.0, 100), result('fatter', 1.0, 100), result('faster', 1.0, 100), result('gone', 1.0, 100)]}, 'v1', str(tmp_path))
+  baseline = baselines.load_baseline('v1', str(tmp_path))
+  report = {'benchmarks':[result('slower', 1.2, 100), result('fatter', 1.05, 200), result('faster', 0.5, 90), result('added', 1.0, 100)]}
+  rows = baselines.compare(baseline, report, threshold=0.10, memory_threshold=0.25)
+  assert [(row['name'], row['status']) for row in rows] == [('slower', 'regressed'), ('fatter', 'regressed'), ('faster', 'improved'), ('added', 'new'), ('gone', 'missing')]
+  assert rows[0]['time_delta'] == pytest.approx(0.2)
+  assert rows[1]['memory_delta'] == pytest.approx(1.0)
+  assert '2 regression(s) in 5 benchmark(s)' in baselines.format_comparison(rows, 'v1')
+  with pytest.raises(ValueError):
+    baselines.load_baseline('v2', str(tmp_path))
+
+def test_APIMetrics_reads_percentiles_from_the_histogram_and_writes_prometheus_text():
+  api_metrics = metrics.APIMetrics(buckets=[0.1, 0.2, 0.5])
+  for seconds in [0.05] * 50 + [0.15] * 45 + [0.4] * 5:
+    api_metrics.observe('device_config', seconds, bytes_in=10, bytes_out=20)
+  api_metrics.observe('login', 1.0, error=True)
+  summary = api_metrics.to_json()
+  assert summary['device_config']['count'] == 100 and summary['device_config']['bytes_in'] == 1000 and summary['device_config']['bytes_out'] == 2000
+  assert summary['device_config']['p50'] == pytest.approx(0.1)
+  assert summary['device_config']['p95'] == pytest.approx(0.2)
+  assert 0.2 < summary['device_config']['p99'] <= 0.5
+  assert summary['login']['errors'] == 1
+  text = api_metrics.to_prometheus()
+  assert 'mist_api_requests_total{endpoint="device_config"} 100' in text
+  assert 'mist_api_request_duration_seconds_bucket{endpoint="device_config",le="0.2"} 95' in text
+  assert 'mist_api_request_duration_seconds_bucket{endpoint="login",le="+Inf"} 1' in text
+  assert 'mist_api_request_errors_total{endpoint="login"} 1' in text
+
+def test_APIMetrics_can_be_summarized_while_pool_threads_add_endpoints():
+  api_metrics = metrics.APIMetrics()
+  def observe_new_endpoints():
+    for index in range(20000):
+      api_metrics.observe(f'endpoint{index}', 0.01)
+  observer = threading.Thread(target=observe_new_endpoints)
+  observer.start()
+  while observer.is_alive():
+    api_metrics.to_json()
+    api_metrics.to_prometheus()
+  observer.join()
+  assert len(api_metrics.to_json()) == 20000
+
+def test_MistAPIHandler_records_metrics_per_endpoint_and_saves_them(local_mist_server, tmp_path):
+  metrics_file = str(tmp_path / 'metrics.json')
+  metrics_textfile = str(tmp_path / 'mist_api.prom')
+  handler = api.MistAPIHandler('usr_pw', {'username':'user', 'password':'pw'}, retry_backoff_base=0.0, metrics_file=metrics_file, metrics_textfile=metrics_textfile)
+  LocalMistRequestHandler.responses_to_fail = 1
+  handler.config_site_device('site', 'device', {'name':'ap'})
+  handler.save_metrics()
+  with open(metrics_file) as f:
+    saved = json.load(f)
+  assert saved['login']['count'] == 1
+  assert saved['device_config']['count'] == 2 and saved['device_config']['errors'] == 1
+  assert saved['device_config']['bytes_out'] == 2 * len(json.dumps({'name':'ap'}))
+  assert saved['device_config']['bytes_in'] == len(json.dumps({'name':'ap', 'mac':'mac0'}))
+  with open(metrics_textfile) as f:
+    assert 'mist_api_requests_total{endpoint="device_config"} 2' in f.read()
+
+def test_MistAPIHandler_keeps_rate_limit_waits_out_of_endpoint_latency(local_mist_server):
+  # one request every 0.2 seconds, so the device_config request waits for the login's token to refill
+  handler = api.MistAPIHandler('usr_pw', {'username':'user', 'password':'pw'}, requests_per_hour=18000, burst=1)
+  handler.config_site_device('site', 'device', {'name':'ap'})
+  summary = handler.metrics.to_json()
+  assert summary['device_config']['wait_seconds'] >= 0.1
+  assert summary['device_config']['total_seconds'] < summary['device_config']['wait_seconds']
+  assert handler.latencies['device_config']['total'] == pytest.approx(summary['device_config']['total_seconds'])
+  assert 'mist_api_request_wait_seconds_total{endpoint="device_config"}' in handler.metrics.to_prometheus()
+
+def test_MistAPIHandler_resumes_a_saved_session_instead_of_logging_in(mist_stub, tmp_path, monkeypatch):
+  fernet = pytest.importorskip('cryptography.fernet')
+  monkeypatch.setenv('MIST_SESSION_KEY', fernet.Fernet.generate_key().decode())
+  session_file = str(tmp_path / 'session.bin')
+  api.MistAPIHandler('usr_pw', {'username':'user', 'password':'pw'}, base_url=mist_stub.base_url, session_file=session_file)
+  with open(session_file, 'rb') as f:
+    assert b'stub-session' not in f.read()
+  assert os.stat(session_file).st_mode & 0o777 == 0o600
+  handler = api.MistAPIHandler('usr_pw', {'username':'user', 'password':'pw'}, base_url=mist_stub.base_url, session_file=session_file)
+  handler.save_org_id_by_name('org')
+  assert mist_stub.request_counts['login'] == 1
+  assert mist_stub.request_counts['check_login'] == 1
+  assert handler.cookies['sessionid'] == 'stub-session'
+  api.MistAPIHandler('usr_pw', {'username':'other', 'password':'pw'}, base_url=mist_stub.base_url, session_file=session_file)
+  assert mist_stub.request_counts['login'] == 2
+
+def test_MistAPIHandler_does_not_keep_a_session_without_MIST_SESSION_KEY(mist_stub, tmp_path, monkeypatch):
+  pytest.importorskip('cryptography')
+  monkeypatch.delenv('MIST_SESSION_KEY', raising=False)
+  session_file = str(tmp_path / 'session.bin')
+  api.MistAPIHandler('usr_pw', {'username':'user', 'password':'pw'}, base_url=mist_stub.base_url, session_file=session_file)
+  api.MistAPIHandler('usr_pw', {'username':'user', 'password':'pw'}, base_url=mist_stub.base_url, session_file=session_file)
+  assert mist_stub.request_counts['login'] == 2
+  assert os.listdir(str(tmp_path)) == []
+
+def test_MistAPIHandler_authenticates_with_an_api_token_without_logging_in(mist_stub):
+  handler = api.MistAPIHandler('api_token', {'api_token':'secret'}, base_url=mist_stub.base_url)
+  handler.save_org_id_by_name('org')
+  assert handler.org_id == mist_stub.org.org_id
+  assert 'login' not in mist_stub.request_counts
+  assert handler.headers['Authorization'] == 'Token secret'
+  assert 'Authorization' not in api.MistAPIHandler.default_headers
+  assert 'secret' not in handler.cache.namespace
+
+def test_MistAPIHandler_instances_keep_their_own_org_and_credentials_across_threads():
+  orgs = [mist_stub_server.SyntheticOrg(f'org{num}', site_count=2, aps_per_site=1, unassigned_aps=0, seed=num) for num in range(2)]
+  servers = [mist_stub_server.MistStubServer(org, latency=0.01) for org in orgs]
+  for server in servers:
+    server.start()
+  try:
+    handlers = [
+      api.MistAPIHandler('usr_pw', {'username':'user', 'password':'pw'}, base_url=servers[0].base_url),
+      api.MistAPIHandler('api_token', {'api_token':'token'}, base_url=servers[1].base_url)
+    ]
+    def load_org(num):
+      handlers[num].save_org_id_by_name(f'org{num}')
+      handlers[num].populate_site_id_dict()
+    threads = [threading.Thread(target=load_org, args=(num,)) for num in range(2)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+  finally:
+    for server in servers:
+      server.stop()
+  for handler, org in zip(handlers, orgs):
+    assert handler.org_id == org.org_id
+    assert handler.sites == {site['name']:site['id'] for site in org.sites}
+  assert handlers[0].cookies['sessionid'] == 'stub-session' and handlers[1].cookies['sessionid'] == ''
+  assert 'Authorization' not in handlers[0].headers
+
+def test_MistAPIHandler_multi_call_leaves_the_caller_headers_untouched(local_mist_server):
+  handler = api.MistAPIHandler('usr_pw', {'username':'user', 'password':'pw'})
+  custom_headers = {'Content-Type':'multipart/form-data'}
+  handler.import_map('site', b'map', custom_headers)
+  assert custom_headers == {'Content-Type':'multipart/form-data'}
+
+def test_ConfigReader_reads_the_file_it_was_given(tmp_path):
+  config_file = tmp_path / 'customer.yml'
+  config_file.write_text("org: 'customer'\nsites:\n    site:\n        name: 'a'\n    site:\n        name: 'b'\n")
+  config = file_ops.ConfigReader(str(config_file)).extract_information_from_file()
+  assert config['org'] == 'customer'
+  assert config['sites'] == {'site0':{'name':'a'}, 'site1':{'name':'b'}}
+
+def test_run_batch_runs_configs_in_parallel_and_reports_failures(tmp_path):
+  orgs = [mist_stub_server.SyntheticOrg('Stub Org', site_count=2, aps_per_site=0, unassigned_aps=4, first_mac=0xa00000000000) for _ in range(2)]
+  servers = [mist_stub_server.MistStubServer(org) for org in orgs]
+  config_files = []
+  for num, server in enumerate(servers):
+    server.start()
+    workbook = synthetic.write_installer_workbook(str(tmp_path / f'installer{num}.xlsx'), 4, 2, floors_per_site=1, first_mac=0xa00000000000)
+    config = synthetic.make_config(workbook, 2, ['assign ap', 'name ap'])
+    config['api'] = {'base_url':server.base_url, 'requests_per_hour':10 ** 9, 'metrics_file':'data/api_metrics.json'}
+    # the same file name in two folders, they still get their own log and state files
+    os.makedirs(str(tmp_path / f'folder{num}'))
+    config_files.append(str(tmp_path / f'folder{num}' / 'customer.yml'))
+    with open(config_files[-1], 'w') as f:
+      yaml.dump(config, f)
+  config_files.append(str(tmp_path / 'missing.yml'))
+  config['login']['two_factor'] = None
+  config_files.append(str(tmp_path / 'two_factor.yml'))
+  with open(config_files[-1], 'w') as f:
+    yaml.dump(config, f)
+  state_dir = str(tmp_path / 'state')
+  try:
+    result = batch.run_batch(config_files, max_workers=2, log_dir=str(tmp_path / 'logs'), state_dir=state_dir)
+  finally:
+    for server in servers:
+      server.stop()
+  assert result['succeeded'] == 2 and result['failed'] == 2
+  assert [summary['config'] for summary in result['configs']] == config_files
+  assert set(result['configs'][0]['task_seconds']) == {'assign ap', 'name ap'}
+  assert result['configs'][2]['error'].startswith('OSError')
+  assert 'two_factor' in result['configs'][3]['error']
+  for org in orgs:
+    assert all(device['site_id'] is not None for device in org.devices.values())
+  run_names = [batch.run_name(config_file) for config_file in config_files[:2]]
+  assert run_names[0] != run_names[1]
+  for name in run_names:
+    assert (tmp_path / 'logs' / f'{name}.log').exists()
+    assert os.path.exists(os.path.join(state_dir, name, 'data', 'api_metrics.json'))
+  assert not (tmp_path / 'logs' / f'{batch.run_name(config_files[3])}.log').exists()
+
+def test_MistAPIHandler_joins_identical_reads_that_are_in_flight():
+  org = mist_stub_server.SyntheticOrg('org', site_count=1, aps_per_site=3)
+  with mist_stub_server.MistStubServer(org, endpoint_latency={'site_devices':0.3}) as server:
+    handler = api.MistAPIHandler('usr_pw', {'username':'user', 'password':'pw'}, base_url=server.base_url)
+    site_id = org.sites[0]['id']
+    responses = []
+    threads = [threading.Thread(target=lambda: responses.append(handler.get_site_devices(site_id))) for _ in range(5)]
+    threads += [threading.Thread(target=lambda: responses.append(list(handler.iter_site_devices(site_id)))) for _ in range(3)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+  assert len(responses) == 8 and all(len(response) == 3 for response in responses)
+  assert server.request_counts['site_devices'] == 2
+  assert handler.coalesced_counts == {'site_devices':6}
+  responses[0][0]['name'] = 'changed'
+  assert all(response[0]['name'] != 'changed' for response in responses[1:])
+
+def test_SingleFlight_passes_the_leader_error_to_waiting_callers():
+  single_flight = api.SingleFlight()
+  started = threading.Event()
+  errors = []
+  def failing_call():
+    started.set()
+    time.sleep(0.2)
+    raise api.APIRequestError(503, 'Service Unavailable')
+  def join():
+    try:
+      single_flight.do('key', 'site_devices', failing_call)
+    except api.APIRequestError as e:
+      errors.append(e)
+  leader = threading.Thread(target=join)
+  leader.start()
+  started.wait()
+  follower = threading.Thread(target=join)
+  follower.start()
+  leader.join()
+  follower.join()
+  assert len(errors) == 2 and single_flight.coalesced == {'site_devices':1}
+  assert single_flight.do('key', 'site_devices', lambda: 'sent again') == 'sent again'
+
+def test_SingleFlight_followers_do_not_see_changes_the_leader_makes_to_its_response():
+  single_flight = api.SingleFlight()
+  started = threading.Event()
+  release = threading.Event()
+  responses = []
+  def leader_call():
+    started.set()
+    release.wait()
+    return [{'name':'ap1'}]
+  def lead():
+    response = single_flight.do('key', 'site_devices', leader_call)
+    response[0]['name'] = 'changed'
+    responses.append(response)
+  leader = threading.Thread(target=lead)
+  leader.start()
+  started.wait()
+  follower = threading.Thread(target=lambda: responses.append(single_flight.do('key', 'site_devices', lambda: [])))
+  follower.start()
+  while single_flight.coalesced.get('site_devices') != 1:
+    time.sleep(0.01)
+  release.set()
+  leader.join()
+  follower.join()
+  assert sorted(response[0]['name'] for response in responses) == ['ap1', 'changed']
+
+def test_SingleFlight_does_not_join_a_call_that_started_before_an_invalidation():
+  single_flight = api.SingleFlight()
+  started = threading.Event()
+  release = threading.Event()
+  responses = []
+  def before_write():
+    started.set()
+    release.wait()
+    return 'before write'
+  leader = threading.Thread(target=lambda: responses.append(single_flight.do('key', 'sites', before_write)))
+  leader.start()
+  started.wait()
+  single_flight.invalidate(['sites'])
+  assert single_flight.do('key', 'sites', lambda: 'after write') == 'after write'
+  release.set()
+  leader.join()
+  assert responses == ['before write'] and single_flight.coalesced == {}
+  assert single_flight.do('key', 'sites', lambda: 'sent again') == 'sent again'
+
+@pytest.mark.parametrize('max_in_flight', [1, 4])
+def test_AssignTask_sends_chunks_and_reports_only_the_failed_ones(site_name_to_id, name_association, max_in_flight):
+  class FlakyFakeAPIHandler(FakeAPIHandler):
+    def assign_inventory_to_site(self, request_body:Dict) -> Dict:
+      response = super().assign_inventory_to_site(request_body)
+      if 'mac4' in request_body['macs']:
+        raise api.APIRequestError(400, 'Bad Request')
+      return response
+  handler = FlakyFakeAPIHandler()
+  site_to_mac = {'site0':[f'mac{num}' for num in range(5)], 'site1':['mac9']}
+  assign_task = tasks.AssignTask(site_to_mac, site_name_to_id, name_association, handler, max_in_flight, mac_chunks=tasks.MacChunks(chunk_size=2))
+  sites = assign_task.perform_task()
+  assert sites == {'site0':{'success':['mac0', 'mac1', 'mac2', 'mac3'], 'error':['mac4']}, 'site1':{'success':['mac9'], 'error':[]}, 'task':'assign ap'}
+  # retries are the handler's job, the task sends every chunk exactly once
+  assert sorted(len(body['macs']) for body in handler.data) == [1, 1, 2, 2]
+  assert all(body['site_id'] == 'id0' for body in handler.data if body['macs'] != ['mac9'])
+
+def test_AssignDeviceProfileTask_splits_site_macs_into_chunks(site_name_to_id):
+  class ProfileFakeAPIHandler(FakeAPIHandler):
+    org_id = '001'
+    def assign_devices_to_device_profile(self, org_id:str, deviceprofile_id:str, devices:Dict):
+      self.data.append(devices)
+      return {}
+  handler = ProfileFakeAPIHandler()
+  site_to_mac = {'site0':[f'mac{num}' for num in range(5)]}
+  sites = tasks.AssignDeviceProfileTask(site_to_mac, 'profile', handler, max_in_flight=3, mac_chunks=tasks.MacChunks(chunk_size=2)).perform_task()
+  assert sites == {'site0':{'success':[f'mac{num}' for num in range(5)], 'error':[]}, 'task':'assign aps to device profile'}
+  assert sorted(body['macs'] for body in handler.data) == [['mac0', 'mac1'], ['mac2', 'mac3'], ['mac4']]
+
+def run_assign_name_profile(tmp_path, pipeline:bool) -> Tuple[tasks.TaskManager, mist_stub_server.SyntheticOrg]:
+  org = mist_stub_server.SyntheticOrg('Stub Org', site_count=3, aps_per_site=0, unassigned_aps=12, first_mac=0xa00000000000)
+  workbook = synthetic.write_installer_workbook(str(tmp_path / f'installer_{pipeline}.xlsx'), 12, 3, floors_per_site=1, first_mac=0xa00000000000)
+  config = synthetic.make_config(workbook, 3, ['assign ap', 'name ap', 'assign aps to device profile'])
+  config['sites'].update({'device_profile':'default', 'max_in_flight':4, 'mac_chunk_size':2, 'pipeline':pipeline, 'pipeline_queue_size':2})
+  with mist_stub_server.MistStubServer(org, latency=0.01) as server:
+    config['api'] = {'base_url':server.base_url, 'requests_per_hour':10 ** 9}
+    task_manager = tasks.TaskManager(config=config, handler=api.MistAPIHandler)
+    task_manager.create_tasks()
+    task_manager.execute_tasks()
+  return task_manager, org
+
+def test_pipeline_assigns_names_and_profiles_like_the_task_by_task_run(tmp_path):
+  sequential, _ = run_assign_name_profile(tmp_path, pipeline=False)
+  pipelined, org = run_assign_name_profile(tmp_path, pipeline=True)
+  assert [result['task'] for result in pipelined.results] == [result['task'] for result in sequential.results]
+  for expected, result in zip(sequential.results, pipelined.results):
+    assert set(result) == set(expected)
+    for site in expected:
+      if site != 'task':
+        assert sorted(map(str, result[site]['success'])) == sorted(map(str, expected[site]['success']))
+        assert result[site]['error'] == expected[site]['error'] == []
+  assert all(device['site_id'] is not None and device['name'].startswith('site') for device in org.devices.values())
+  assert len(pipelined.pipeline.site_done_seconds) == 3
+  assert pipelined.run_stats['first_site_seconds'] <= pipelined.run_stats['task_seconds']['name ap']
+
+def test_pipeline_reads_no_site_when_the_inventory_has_every_ap(tmp_path):
+  org = mist_stub_server.SyntheticOrg('Stub Org', site_count=1, aps_per_site=0, unassigned_aps=40, first_mac=0xa00000000000)
+  workbook = synthetic.write_installer_workbook(str(tmp_path / 'installer.xlsx'), 40, 1, floors_per_site=1, first_mac=0xa00000000000)
+  config = synthetic.make_config(workbook, 1, ['assign ap', 'name ap'])
+  config['sites'].update({'max_in_flight':4, 'mac_chunk_size':4, 'pipeline':True})
+  with mist_stub_server.MistStubServer(org) as server:
+    config['api'] = {'base_url':server.base_url, 'requests_per_hour':10 ** 9}
+    task_manager = tasks.TaskManager(config=config, handler=api.MistAPIHandler)
+    task_manager.create_tasks()
+    task_manager.execute_tasks()
+  assert server.request_counts.get('site_devices', 0) == 0
+  assert server.request_counts['device_config'] == 40
+  assert all(device['name'] is not None for device in org.devices.values())
+
+def test_pipeline_has_a_name_result_for_every_site_like_NameAPTask(site_name_to_id, name_association):
+  site_mac_name = {'site0':{'aabbccddee00':'site0-ap-01'}, 'site1':{}}
+  def make_handler():
+    handler = FakeAPIHandler()
+    handler.site_devices['id0'] = [{'id':'dev_id0', 'mac':'aabbccddee00'}]
+    return handler
+  expected = tasks.NameAPTask(site_mac_name, name_association, make_handler()).perform_task()
+  handler = make_handler()
+  assign_task = tasks.AssignTask({'site0':['aabbccddee00']}, site_name_to_id, name_association, handler)
+  name_task = tasks.NameAPTask(site_mac_name, name_association, handler)
+  _, name_results = tasks.AssignNamePipeline(assign_task, name_task, max_in_flight=2).perform_tasks()
+  assert name_results == expected == {'site0':{'success':[['site0-ap-01', 'aabbccddee00']], 'error':[]}, 'site1':{'success':[], 'error':[]}, 'task':'name ap'}
+
+def test_workbook_sheet_is_parsed_once_for_every_reader_until_it_changes(tmp_path):
+  workbook = synthetic.write_installer_workbook(str(tmp_path / 'installer.xlsx'), 20, 2, first_mac=0xa00000000000)
+  config = synthetic.make_config(workbook, 2, ['assign ap', 'name ap'])
+  file_ops.sheet_cache.clear()
+  misses = file_ops.sheet_cache.misses
+  site_to_mac = tasks.SiteMac(config).get_data_structure()
+  tasks.SiteMacName(config).get_data_structure()
+  esx_writer = file_ops.EkahauWriter(config)
+  assert esx_writer.ap_names_are_unique_throughout_excel_file()
+  assert len(esx_writer.create_ap_naming_dict()) == 20
+  assert file_ops.sheet_cache.misses - misses == 1
+  synthetic.write_installer_workbook(workbook, 30, 2, first_mac=0xa00000000000)
+  os.utime(workbook, ns=(os.stat(workbook).st_atime_ns, os.stat(workbook).st_mtime_ns + 10 ** 9))
+  assert sum(len(macs) for macs in tasks.SiteMac(config).get_data_structure().values()) == 30
+  assert file_ops.sheet_cache.misses - misses == 2 and len(file_ops.sheet_cache.sheets) == 1
+  assert sum(len(macs) for macs in site_to_mac.values()) == 20
+
+def test_stream_excel_reader_builds_the_same_data_structures_as_pandas(tmp_path):
+  workbook = synthetic.write_installer_workbook(str(tmp_path / 'installer.xlsx'), 60, 3, first_mac=0xa00000000000)
+  pandas_config = synthetic.make_config(workbook, 3, ['assign ap', 'name ap'])
+  stream_config = synthetic.make_config(workbook, 3, ['assign ap', 'name ap'])
+  stream_config['sites']['excel_reader'] = 'stream'
+  assert tasks.SiteMac(stream_config).get_data_structure() == tasks.SiteMac(pandas_config).get_data_structure()
+  assert tasks.SiteMacName(stream_config).get_data_structure() == tasks.SiteMacName(pandas_config).get_data_structure()
+  assert file_ops.EkahauWriter(stream_config).create_ap_naming_dict(True) == file_ops.EkahauWriter(pandas_config).create_ap_naming_dict(True)
+
+def test_iter_sheet_records_finds_the_header_and_projects_columns(tmp_path):
+  workbook = openpyxl.Workbook()
+  worksheet = workbook.active
+  worksheet.title = 'APs'
+  worksheet.append(['Installer AP list'])
+  worksheet.append([])
+  worksheet.append(['Notes', 'Site', 'Name', 'MAC'])
+  worksheet.append(['a', 'site0 Flr-01', 'ap-1', 'a00000000001'])
+  worksheet.append(['b', 'site0 Flr-01', 'ap-2', None])
+  worksheet.append([])
+  worksheet.append(['c', 'site1 Flr-02', 'ap-3', 'a00000000003'])
+  workbook.save(str(tmp_path / 'installer.xlsx'))
+  records = list(file_ops.iter_sheet_records(str(tmp_path / 'installer.xlsx'), ['Site', 'MAC'], 'APs', required='MAC'))
+  assert records == [('site0 Flr-01', 'a00000000001'), ('site1 Flr-02', 'a00000000003')]
+  with pytest.raises(ValueError):
+    list(file_ops.iter_sheet_records(str(tmp_path / 'installer.xlsx'), ['Site', 'Switch'], 'APs'))
+
+def test_workbook_sidecar_cache_skips_parsing_an_unchanged_workbook(tmp_path, monkeypatch):
+  workbook = synthetic.write_installer_workbook(str(tmp_path / 'installer.xlsx'), 20, 2, first_mac=0xa00000000000)
+  config = synthetic.make_config(workbook, 2, ['assign ap', 'name ap'])
+  config['sites']['workbook_cache'] = True
+  monkeypatch.setattr(file_ops.sheet_cache, 'sidecar_dir', str(tmp_path / 'data' / 'workbook_cache'))
+  file_ops.sheet_cache.clear()
+  site_to_mac = tasks.SiteMac(config).get_data_structure()
+  sidecar_file = file_ops.sheet_cache.sidecar_file(os.path.abspath(workbook))
+  assert os.path.dirname(sidecar_file) == str(tmp_path / 'data' / 'workbook_cache')
+  assert sorted(os.listdir(str(tmp_path))) == ['data', 'installer.xlsx']
+  with open(sidecar_file) as f:
+    assert json.load(f)['sha256']
+  file_ops.sheet_cache.clear()
+  sidecar_hits = file_ops.sheet_cache.sidecar_hits
+  with monkeypatch.context() as patched:
+    patched.setattr(file_ops.pandas, 'read_excel', lambda *args, **kwargs: pytest.fail('the workbook was parsed again'))
+    assert tasks.SiteMac(config).get_data_structure() == site_to_mac
+  assert file_ops.sheet_cache.sidecar_hits - sidecar_hits == 1
+  synthetic.write_installer_workbook(workbook, 30, 2, first_mac=0xa00000000000)
+  file_ops.sheet_cache.clear()
+  assert sum(len(macs) for macs in tasks.SiteMac(config).get_data_structure().values()) == 30
+  assert file_ops.sheet_cache.sidecar_hits - sidecar_hits == 1
+  with open(sidecar_file, 'w') as f:
+    f.write('not json')
+  file_ops.sheet_cache.clear()
+  assert sum(len(macs) for macs in tasks.SiteMac(config).get_data_structure().values()) == 30
+
+def test_site_mac_data_structures_skip_invalid_macs_with_one_report(tmp_path, capsys):
+  header_column_names = synthetic.HEADER_COLUMN_NAMES
+  rows = [
+    ('site1 Flr-02', 'ap-3', 'AABBCCDDEE03'),
+    ('site1 Flr-01', 'ap-1', ' aabbccddee01 '),
+    ('site1 Flr-01', 'ap-2', 'aabbccddee0'),
+    ('site2 1st Flr', 'ap-4', 'not a mac'),
+    ('site1 Flr-01', 'ap-5', 'aabbccddee05'),
+    ('site1 Flr-02', 'ap-6', 'aa:bb:cc:dd:ee:01'),
+  ]
+  workbook = str(tmp_path / 'installer.xlsx')
+  pandas.DataFrame(rows, columns=[header_column_names['site_name'], header_column_names['ap_name'], header_column_names['ap_mac']]).to_excel(workbook, sheet_name='APs', index=False)
+  config = synthetic.make_config(workbook, 2, ['assign ap', 'name ap'])
+  config['sites']['workbook_cache'] = False
+  assert tasks.SiteMac(config).get_data_structure() == {'site1':['aabbccddee01', 'aabbccddee05', 'aabbccddee03'], 'site2':[]}
+  assert tasks.SiteMacName(config).get_data_structure() == {'site1':{'aabbccddee01':'ap-6', 'aabbccddee05':'ap-5', 'aabbccddee03':'ap-3'}, 'site2':{}}
+  output = capsys.readouterr().out
+  assert output.count('Found 2 invalid AP MACs') == 2
+  assert 'site1: ap-2 aabbccddee0' in output and 'site2: ap-4 not a mac' in output
+
+@pytest.mark.parametrize('excel_reader', ['pandas', 'stream'])
+def test_site_mac_data_structures_group_sites_by_the_groupby_column(tmp_path, excel_reader):
+  header_column_names = synthetic.HEADER_COLUMN_NAMES
+  rows = [
+    ('site1 Flr-01', 'north Flr-01', 'ap-1', 'aabbccddee01'),
+    ('site1 Flr-02', 'south Flr-02', 'ap-2', 'aabbccddee02'),
+    ('site1 Flr-02', 'north Flr-02', 'ap-3', 'aabbccddee03'),
+  ]
+  workbook = str(tmp_path / 'installer.xlsx')
+  pandas.DataFrame(rows, columns=[header_column_names['site_name'], 'Building', header_column_names['ap_name'], header_column_names['ap_mac']]).to_excel(workbook, sheet_name='APs', index=False)
+  config = synthetic.make_config(workbook, 2, ['assign ap', 'name ap'])
+  config['sites'].update({'groupby':'Building', 'excel_reader':excel_reader})
+  assert tasks.SiteMac(config).get_data_structure() == {'north':['aabbccddee01', 'aabbccddee03'], 'south':['aabbccddee02']}
+  assert tasks.SiteMacName(config).get_data_structure() == {'north':{'aabbccddee01':'ap-1', 'aabbccddee03':'ap-3'}, 'south':{'aabbccddee02':'ap-2'}}
+
+def test_create_site_to_mac_dict_accepts_a_frame_or_its_groupby():
+  frame = pandas.DataFrame([('site1 Flr-01', 'ap-1', 'AABBCCDDEEFF'), ('site1 Flr-02', 'ap-2', 'aabbccddeef'), ('site2', 'ap-3', 'aabbccddeefe')], columns=['site', 'name', 'mac'])
+  expected = {'site1':{'aabbccddeeff':'ap-1'}, 'site2':{'aabbccddeefe':'ap-3'}}
+  assert inventory_devices.create_site_to_mac_dict(frame) == expected
+  assert inventory_devices.create_site_to_mac_dict(frame.groupby('site')) == expected
+
+def test_parse_mac_reads_every_common_format_into_one_integer():
+  formats = ['aabbccddeeff', 'AA:BB:CC:DD:EE:FF', 'aa-bb-cc-dd-ee-ff', 'aabb.ccdd.eeff', ' AaBbCcDdEeFf ']
+  assert {mac.parse_mac(mac_address) for mac_address in formats} == {0xaabbccddeeff}
+  for invalid in ['aabbccddeef', 'aa:bb-cc:dd:ee:ff', 'aabb.ccdd.eef', 'gabbccddeeff', None]:
+    assert mac.try_parse_mac(invalid) is None
+  assert mac.format_mac(0xaabbccddeeff, ':') == 'aa:bb:cc:dd:ee:ff'
+  assert mac.format_mac(0xaabbccddeeff, '.') == 'aabb.ccdd.eeff'
+  assert mac.parse_sheet_mac(12233445566) == 0x012233445566
+  assert mac.normalize_macs(pandas.Series(['AA-BB-CC-DD-EE-FF', 'no mac'])).tolist()[0] == 'aabbccddeeff'
+
+@pytest.mark.parametrize('cells', [
+  ['aabbccddeeff', 1122334455, 'not a mac', None],
+  [112233445566.0, 1122334455.0, float('nan'), 1.5],
+  [112233445566, 1122334455, -1, 10 ** 12],
+])
+def test_normalize_macs_reads_cells_like_parse_sheet_mac(cells):
+  series = pandas.Series(cells, dtype=object if isinstance(cells[0], str) else None)
+  expected = [mac.format_mac(mac.parse_sheet_mac(cell)) if mac.parse_sheet_mac(cell) is not None else None for cell in series]
+  normalized = mac.normalize_macs(series)
+  assert [value if pandas.notna(value) else None for value in normalized] == expected
+  assert expected[1] == '001122334455'
+
+def test_validate_site_to_mac_ds_checks_every_site_against_its_ledger(create_temp_excel_data):
+  config = get_test_config_data()
+  config['sites']['ap_excel_file'] = create_temp_excel_data
+  task_manager = tasks.TaskManager(config=config, handler=FakeAPIHandler, writer=file_ops.ExcelWriter)
+  task_manager.data_structures['name_association'] = {'site1':'site1', 'site2':'site1'}
+  ledger = os.path.join(os.getcwd(), 'data', f"{task_manager.site_name_to_id['site1']}.xlsx")
+  with pandas.ExcelWriter(ledger) as writer:
+    pandas.DataFrame({'MAC':['AA:BB:CC:DD:EE:F1', 'aabb.ccdd.eef2']}).to_excel(writer, sheet_name='assign ap', index=False)
+    pandas.DataFrame({'Name':['ap-2'], 'MAC':['aabbccddeef2']}).to_excel(writer, sheet_name='name ap', index=False)
+  try:
+    validated = task_manager._validate_site_to_mac_ds({'site1':['aabbccddeef1', 'aabbccddeef3'], 'site2':['aabbccddeef2']})
+    validated_names = task_manager._validate_site_mac_name_ds({'site1':{'aabbccddeef1':'ap-1'}, 'site2':{'aabbccddeef2':'ap-2'}})
+  finally:
+    os.remove(ledger)
+  assert validated == {'site1':['aabbccddeef3'], 'site2':[]}
+  assert validated_names == {'site1':{'aabbccddeef1':'ap-1'}, 'site2':{}}
+
+def test_validate_site_to_mac_ds_matches_ledger_macs_in_any_format(create_temp_excel_data):
+  config = get_test_config_data()
+  config['sites']['ap_excel_file'] = create_temp_excel_data
+  task_manager = tasks.TaskManager(config=config, handler=FakeAPIHandler, writer=file_ops.ExcelWriter)
+  ledger = os.path.join(os.getcwd(), 'data', f"{task_manager.site_name_to_id['site1']}.xlsx")
+  with pandas.ExcelWriter(ledger) as writer:
+    pandas.DataFrame({'MAC':['AA:BB:CC:DD:EE:F1', 'aabb.ccdd.eef2']}).to_excel(writer, sheet_name='assign ap', index=False)
+  try:
+    validated = task_manager._validate_site_to_mac_ds({'site1':['aabbccddeef1', 'aabbccddeef2', 'aabbccddeef3']})
+  finally:
+    os.remove(ledger)
+  assert validated == {'site1':['aabbccddeef3']}